@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+#
+# Reports the memory held by parse trees, in bytes per input character,
+# for the testdata pages and a synthetic 1 MB vital article list page.
+
+import parser
+
+import gc
+import glob
+import tracemalloc
+
+
+def synthetic_page(size=1 << 20):
+    lines = ["{{Vital articles|level=5}}\n== People ==\n"]
+    length = len(lines[0])
+    n = 0
+    while length < size:
+        n += 1
+        lines.append("# {{Icon|%s}} [[Example article %d|Example %d]] "
+                     "<!-- note %d --> &nbsp; ''(%d)''\n"
+                     % (("FA", "GA", "B", "C")[n % 4], n, n, n, n))
+        length += len(lines[-1])
+    return "".join(lines)
+
+
+def measure(name, text):
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    t = parser.WikiTokenizer(name, engine="regex")
+    t.tokenize(text, keep_tokens=False, keep_source=False)
+    gc.collect()
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("%-30s %9d chars %8.1f bytes/char (peak %8.1f)" % (
+        name, len(text), (after - before) / len(text), (peak - before) / len(text)))
+    return t
+
+
+def main():
+    for filename in sorted(glob.glob("testdata/*.dat")):
+        with open(filename) as f:
+            measure(filename, f.read())
+    measure("synthetic 1 MB page", synthetic_page())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+#
+# Category members, streamed from the API and kept in a snapshot per
+# category.  Later runs ask only for members added since the snapshot,
+# and check the category's size to see whether any were removed; only
+# then is the whole category listed again.  The size the wiki reports can
+# drift from the real count, so the difference found at the last full
+# listing is allowed for.
+
+import disk_cache
+
+import datetime
+import json
+import os
+import time
+
+API_URL = "https://en.wikipedia.org/w/api.php"
+CACHE_DIR = os.path.join(disk_cache.CACHE_ROOT, "categories")
+MAX_CACHE_BYTES = 64 << 20
+OVERLAP = 3600  # seconds before the newest member to list from again, for replica lag
+FULL_REFRESH_AGE = 7 * 86400  # seconds after which a category is listed in full anyway
+
+
+def iter_members(cat_name, session, start=None):
+    """Yields (title, timestamp added) for the members of cat_name.
+
+    With start (an API timestamp), only members added since then, oldest
+    first.
+    """
+    data = {
+        'format': 'json',
+        'action': 'query',
+        'list': 'categorymembers',
+        'cmtitle': cat_name,
+        'cmprop': 'title|timestamp',
+        'cmlimit': 'max',
+    }
+    if start is not None:
+        data.update(cmsort='timestamp', cmdir='newer', cmstart=start)
+    while True:
+        r = session.post(API_URL, data=data).json()
+        for x in r["query"]["categorymembers"]:
+            yield x["title"], x["timestamp"]
+        if "continue" not in r:
+            return
+        data = dict(data, **r["continue"])
+
+
+def category_size(cat_name, session):
+    """The number of members of cat_name, as the wiki counts them."""
+    r = session.post(API_URL, data={
+        'format': 'json',
+        'action': 'query',
+        'prop': 'categoryinfo',
+        'titles': cat_name,
+    }).json()
+    page = next(iter(r["query"]["pages"].values()))
+    return page.get("categoryinfo", {}).get("size", 0)
+
+
+def _before(timestamp, seconds):
+    when = datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ")
+    return (when - datetime.timedelta(seconds=seconds)).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class CategorySnapshots(object):
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+        self.files = disk_cache.DiskCache(directory, max_bytes, ".json")
+        self.full = 0  # categories listed in full
+        self.incremental = 0  # categories brought up to date from a snapshot
+
+    def _load(self, cat_name):
+        data = self.files.read(disk_cache.file_name(cat_name))
+        if data is None:
+            return None
+        return json.loads(data.decode("utf-8"))
+
+    def _save(self, cat_name, snapshot):
+        self.files.write(disk_cache.file_name(cat_name), json.dumps(snapshot).encode("utf-8"))
+
+    def members(self, cat_name, session):
+        """The titles in cat_name, now."""
+        snapshot = self._load(cat_name)
+        if snapshot is not None and time.time() - snapshot["listed"] < FULL_REFRESH_AGE:
+            members = dict(snapshot["members"])
+            start = _before(snapshot["newest"], OVERLAP) if snapshot["newest"] else None
+            members.update(iter_members(cat_name, session, start))
+            drift = snapshot.get("drift", 0)
+            if len(members) + drift == category_size(cat_name, session):  # nothing was removed
+                self.incremental += 1
+                self._store(cat_name, members, snapshot["listed"], drift)
+                return set(members)
+        self.full += 1
+        listed = time.time()
+        members = dict(iter_members(cat_name, session))
+        drift = category_size(cat_name, session) - len(members)
+        self._store(cat_name, members, listed, drift)
+        return set(members)
+
+    def _store(self, cat_name, members, listed, drift):
+        self._save(cat_name, {"members": members, "listed": listed, "drift": drift,
+                              "newest": max(members.values(), default=None)})
+
+
+_snapshots = None
+
+def default_snapshots():
+    global _snapshots
+    if _snapshots is None:
+        _snapshots = CategorySnapshots()
+    return _snapshots
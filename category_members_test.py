@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+
+import category_members
+import fakes
+
+import tempfile
+import unittest
+
+
+class FakeCategory(object):
+    """Answers categorymembers and categoryinfo queries, PAGE members at a time."""
+    PAGE = 2
+
+    def __init__(self):
+        self.members = {}  # title -> timestamp added
+        self.listed = []  # titles returned
+        self.drift = 0  # how far off the reported size is
+
+    def post(self, url, data):
+        if data.get("prop") == "categoryinfo":
+            size = len(self.members) + self.drift
+            return fakes.FakeResponse({"query": {"pages": {"1": {
+                "title": data["titles"], "categoryinfo": {"size": size}}}}})
+        assert data["cmlimit"] == "max"
+        members = sorted(self.members.items(), key=lambda x: (x[1], x[0]))
+        if "cmstart" in data:
+            members = [x for x in members if x[1] >= data["cmstart"]]
+        start = int(data.get("cmcontinue", 0))
+        page = members[start:start + self.PAGE]
+        self.listed.extend(title for title, _ in page)
+        result = {"query": {"categorymembers": [{"title": t, "timestamp": ts} for t, ts in page]}}
+        if start + self.PAGE < len(members):
+            result["continue"] = {"cmcontinue": str(start + self.PAGE), "continue": "-||"}
+        return fakes.FakeResponse(result)
+
+
+class CategorySnapshotsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.api = FakeCategory()
+        for i in range(5):
+            self.api.members["Talk:%d" % i] = "2020-01-0%dT00:00:00Z" % (i + 1)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def members(self):
+        snapshots = category_members.CategorySnapshots(self.tmp.name)
+        result = snapshots.members("Category:Vital", self.api)
+        return result, snapshots
+
+    def test_iter_members(self):
+        self.assertEqual(list(self.api.members.items()),
+                         list(category_members.iter_members("Category:Vital", self.api)))
+
+    def test_added(self):
+        members, snapshots = self.members()
+        self.assertEqual(set(self.api.members), members)
+        self.assertEqual(1, snapshots.full)
+
+        self.api.members["Talk:New"] = "2020-02-01T00:00:00Z"
+        self.api.listed = []
+        members, snapshots = self.members()
+        self.assertEqual(set(self.api.members), members)
+        self.assertEqual((0, 1), (snapshots.full, snapshots.incremental))
+        self.assertEqual(["Talk:4", "Talk:New"], self.api.listed)  # from OVERLAP before
+
+    def test_removed(self):
+        self.members()
+        del self.api.members["Talk:2"]
+        self.api.members["Talk:New"] = "2020-02-01T00:00:00Z"
+        members, snapshots = self.members()
+        self.assertEqual(set(self.api.members), members)
+        self.assertEqual(1, snapshots.full)
+
+    def test_drifted_size(self):
+        self.api.drift = 3
+        self.members()
+        self.api.members["Talk:New"] = "2020-02-01T00:00:00Z"
+        members, snapshots = self.members()
+        self.assertEqual(set(self.api.members), members)
+        self.assertEqual((0, 1), (snapshots.full, snapshots.incremental))
+
+        del self.api.members["Talk:2"]
+        members, snapshots = self.members()
+        self.assertEqual(set(self.api.members), members)
+        self.assertEqual(1, snapshots.full)
+
+    def test_overlap(self):
+        self.members()
+        # Added before the newest member, but seen only now (replica lag).
+        self.api.members["Talk:Late"] = "2020-01-04T23:30:00Z"
+        members, snapshots = self.members()
+        self.assertIn("Talk:Late", members)
+        self.assertEqual(1, snapshots.incremental)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+#
+# Files in a cache directory, removed least recently used first once the
+# directory grows past a size limit.  Used by parse_cache and page_cache.
+
+import hashlib
+import os
+import threading
+import time
+
+CACHE_ROOT = os.path.join(os.path.expanduser("~"), ".cache", "wiki_scripts")
+# Eviction goes down to this fraction of max_bytes, so that a full cache
+# isn't scanned again on every write.
+LOW_WATER = 0.9
+# Temporary files this old were left by a writer that died.
+STALE_TMP_SECONDS = 3600
+
+
+def file_name(*parts):
+    """A file name for a cache key made of parts (titles, revision ids...)."""
+    key = "\0".join(str(x) for x in parts)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+class DiskCache(object):
+    def __init__(self, directory, max_bytes, suffix):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self._lock = threading.Lock()  # the vital updates use caches from many threads
+        os.makedirs(directory, exist_ok=True)
+        self._sizes = {}
+        now = time.time()
+        for entry in os.scandir(directory):
+            if entry.name.endswith(suffix):
+                self._sizes[entry.name] = entry.stat().st_size
+            elif entry.name.endswith(".tmp"):
+                try:
+                    if entry.stat().st_mtime < now - STALE_TMP_SECONDS:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + self.suffix)
+
+    def total_bytes(self):
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def read(self, name):
+        """The contents of the file, or None if there is none."""
+        path = self._path(name)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # most recently used
+        except FileNotFoundError:
+            with self._lock:
+                self._sizes.pop(name + self.suffix, None)
+            return None
+        return data
+
+    def write(self, name, data):
+        path = self._path(name)
+        tmp = "%s.%d.tmp" % (path, threading.get_ident())
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            self._sizes[name + self.suffix] = len(data)
+            self._evict()
+
+    def remove(self, name):
+        with self._lock:
+            self._remove(name + self.suffix)
+
+    def _remove(self, filename):
+        try:
+            os.remove(os.path.join(self.directory, filename))
+        except FileNotFoundError:
+            pass
+        self._sizes.pop(filename, None)
+
+    def _evict(self):
+        total = sum(self._sizes.values())
+        if total <= self.max_bytes:
+            return
+        by_age = []
+        for filename in self._sizes:
+            try:
+                by_age.append((os.stat(os.path.join(self.directory, filename)).st_mtime,
+                               filename))
+            except FileNotFoundError:
+                by_age.append((0, filename))
+        low_water = self.max_bytes * LOW_WATER
+        for _, filename in sorted(by_age):
+            if total <= low_water:
+                break
+            total -= self._sizes[filename]
+            self._remove(filename)
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+#
+# Runs the vital article checks over MediaWiki XML dumps instead of the
+# live API.  Dumps are streamed, plain or bz2-compressed, and each page
+# is dropped once checked, so memory use does not grow with the dump.
+#
+#   python3 dump_scan.py enwiki-latest-pages-meta-current1.xml.bz2 ... > vital.tsv
+
+import parse_pool
+import parser
+import util
+import vital_update
+
+import bz2
+import collections
+import os
+import sys
+import xml.etree.ElementTree as ET
+
+TALK_NAMESPACE = 1
+
+TalkPageReport = collections.namedtuple(
+    "TalkPageReport", ["title", "level", "topic", "article_class", "bots_allowed"])
+
+
+def open_dump(filename):
+    if filename.endswith(".bz2"):
+        return bz2.open(filename, "rb")
+    return open(filename, "rb")
+
+
+def iter_pages(f, namespaces=None):
+    """Yields (title, namespace, text) for each page in the dump file f.
+
+    text is that of the last revision in the dump.  namespaces, if given,
+    is a set of namespace numbers to keep.
+    """
+    context = ET.iterparse(f, events=("start", "end"))
+    _, root = next(context)  # <mediawiki>, whose children are cleared as we go
+    xmlns = root.tag[:root.tag.index("}") + 1] if root.tag.startswith("{") else ""
+    page_tag = xmlns + "page"
+    for event, elem in context:
+        if event != "end" or elem.tag != page_tag:
+            continue
+        ns = int(elem.findtext(xmlns + "ns", "0"))
+        if namespaces is None or ns in namespaces:
+            text = None
+            for revision in elem.iter(xmlns + "revision"):
+                text = revision.findtext(xmlns + "text")
+            yield elem.findtext(xmlns + "title"), ns, text or ""
+        elem.clear()
+        root.clear()
+
+
+def _param(template, key):
+    if template.has_param(key):
+        return template.get_param(key).strip()
+    return None
+
+
+def check_talk_page(title, text):
+    """A TalkPageReport for a page with {{Vital article}}, else None."""
+    t = parser.WikiTokenizer(title)
+    t.tokenize(text, keep_tokens=False, keep_source=False)
+    classes = vital_update.class_query()
+    templates = parser.TemplatesOfKind("Vital article")
+    t.parsed_data.query(classes, templates)
+    if not templates.result["Vital article"]:
+        return None
+    vital = templates.result["Vital article"][0]
+    try:
+        article_class = vital_update.get_article_class(title, t, classes)
+    except Exception:
+        article_class = None
+    return TalkPageReport(title, _param(vital, "level"), _param(vital, "topic"),
+                          article_class, util.bot_check(title, parsed=t))
+
+
+def _talk_pages(filenames):
+    for filename in filenames:
+        with open_dump(filename) as f:
+            for title, _, text in iter_pages(f, {TALK_NAMESPACE}):
+                yield title, text
+
+
+def scan(filenames, processes=1):
+    """Yields a TalkPageReport for each vital article talk page in the dumps.
+
+    With more than one process, pages are checked on a parse_pool.ParsePool.
+    """
+    pages = _talk_pages(filenames)
+    if processes == 1:
+        reports = (check_talk_page(title, text) for title, text in pages)
+        yield from (x for x in reports if x is not None)
+        return
+    with parse_pool.ParsePool(processes) as pool:
+        yield from (x for x in pool.map(check_talk_page, pages) if x is not None)
+
+
+def main():
+    print("\t".join(TalkPageReport._fields))
+    for report in scan(sys.argv[1:], processes=os.cpu_count()):
+        print("\t".join("" if x is None else str(x) for x in report))
+
+
+if __name__ == "__main__":
+    main()
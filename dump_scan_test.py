@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+
+import dump_scan
+
+import bz2
+import io
+import os
+import tempfile
+import unittest
+import xml.sax.saxutils
+
+
+def make_dump(pages):
+    """A dump of pages, a list of (title, namespace, [revision texts])."""
+    out = ['<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" version="0.10">\n'
+           '<siteinfo><sitename>Wikipedia</sitename></siteinfo>\n']
+    for i, (title, ns, texts) in enumerate(pages):
+        out.append("<page><title>%s</title><ns>%d</ns><id>%d</id>\n"
+                   % (xml.sax.saxutils.escape(title), ns, i))
+        for text in texts:
+            out.append('<revision><id>%d</id><text xml:space="preserve">%s</text></revision>\n'
+                       % (i, xml.sax.saxutils.escape(text)))
+        out.append("</page>\n")
+    out.append("</mediawiki>\n")
+    return "".join(out).encode("utf-8")
+
+
+class DumpScanTest(unittest.TestCase):
+    def setUp(self):
+        with open("testdata/bob_dylan.dat") as f:
+            self.dylan = f.read()
+        self.pages = [
+            ("Bob Dylan", 0, ["{{Vital article|level=3}} is not a talk page"]),
+            ("Talk:Bob Dylan", 1, ["old text", self.dylan]),
+            ("Talk:A & B", 1, ["{{nobots}}{{WikiProject Music|class=c}}{{Vital article|level=5}}"]),
+            ("Talk:Nothing", 1, ["{{WikiProject Music|class=B}}"]),
+            ("Talk:Empty", 1, []),
+        ]
+
+    def test_iter_pages(self):
+        pages = list(dump_scan.iter_pages(io.BytesIO(make_dump(self.pages))))
+        self.assertEqual([(x[0], x[1]) for x in self.pages], [(x[0], x[1]) for x in pages])
+        self.assertEqual(self.dylan, pages[1][2])
+        self.assertEqual("", pages[4][2])
+        talk = list(dump_scan.iter_pages(io.BytesIO(make_dump(self.pages)), {1}))
+        self.assertEqual(4, len(talk))
+
+    def test_scan(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            plain = os.path.join(tmp, "dump.xml")
+            with open(plain, "wb") as f:
+                f.write(make_dump(self.pages[:2]))
+            compressed = os.path.join(tmp, "dump.xml.bz2")
+            with bz2.open(compressed, "wb") as f:
+                f.write(make_dump(self.pages[2:]))
+            reports = list(dump_scan.scan([plain, compressed]))
+        self.assertEqual([
+            dump_scan.TalkPageReport("Talk:Bob Dylan", "4", "People", "FA", True),
+            dump_scan.TalkPageReport("Talk:A & B", "5", None, "C", False),
+        ], reports)
+
+    def test_scan_processes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "dump.xml")
+            with open(filename, "wb") as f:
+                f.write(make_dump(self.pages))
+            self.assertEqual(list(dump_scan.scan([filename])),
+                             list(dump_scan.scan([filename], processes=2)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,37 +3,195 @@
 # A proxy for Wikipedia metrics to be exposed in Prometheus
 # format.
 
+import http_client
+import metrics
+
+import functools
 import http.server
-import json
-import urllib.request
+import sys
+import threading
+import time
 
 PORT = 8001
-METRICS_URL = "https://en.wikipedia.org/w/api.php?action=query&meta=siteinfo&siprop=statistics&format=json"
-BACKLOG_URL = ("https://en.wikipedia.org/w/api.php?action=query&prop=categoryinfo&" +
-               "format=json&titles=" + "|".join([
+API_URL = "https://en.wikipedia.org/w/api.php"
+# Backlog categories to report the size of; main() can read another list
+# from a file, one category per line.
+BACKLOG_CATEGORIES = [
   "Category:All accuracy disputes",
   "Category:Pages missing lead section",
-  "Category:Good article nominees"
-  "Category:Good article nominees awaiting review"
-  ]))
+  "Category:Good article nominees",
+  "Category:Good article nominees awaiting review",
+]
+TITLES_PER_QUERY = 50  # the API's limit for most accounts
+
+REFRESH_INTERVAL = 60  # seconds between upstream requests
+
+
+def fetch(categories=BACKLOG_CATEGORIES, session=None):
+    """The upstream data the metrics are made from.
+
+    The site statistics come with the first batch of categories, so a
+    short list takes one request.
+    """
+    session = session or http_client.default_session()
+    result = {"statistics": None, "categories": {}}
+    for i in range(0, max(len(categories), 1), TITLES_PER_QUERY):
+        batch = categories[i:i + TITLES_PER_QUERY]
+        params = {"action": "query", "format": "json"}
+        if i == 0:
+            params.update(meta="siteinfo", siprop="statistics")
+        if batch:
+            params.update(prop="categoryinfo", titles="|".join(batch))
+        renamed = {}
+        info = {}
+        while True:
+            r = session.get(API_URL, params=params).json()
+            query = r["query"]
+            if "statistics" in query:
+                result["statistics"] = query["statistics"]
+            for x in query.get("normalized", []):
+                renamed[x["from"]] = x["to"]
+            for page in query.get("pages", {}).values():
+                if "categoryinfo" in page:
+                    info[page["title"]] = page["categoryinfo"]
+            if "continue" not in r:
+                break
+            params = dict(params, **r["continue"])
+        for title in batch:
+            counts = info.get(renamed.get(title, title), {})
+            result["categories"][title] = {k: counts.get(k, 0)
+                                           for k in ("pages", "subcats", "files")}
+    return result
+
+
+class Snapshot(object):
+    """The latest upstream data, refreshed by a background thread.
+
+    Refreshes asked for while one is running wait for it, rather than
+    making another upstream request, whether it succeeds or fails.
+    """
+
+    def __init__(self, fetch=fetch, interval=REFRESH_INTERVAL, clock=time.time):
+        self.fetch = fetch
+        self.interval = interval
+        self.clock = clock
+        # (data, clock() when it was fetched, seconds the refresh took), all
+        # replaced at once so that scrapes never see a mix of two refreshes.
+        self.published = (None, None, None)
+        self.errors = 0
+        self.failed = None  # clock() of the last refresh, if it failed
+        self._generation = 0  # refreshes tried so far
+        self._refresh_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        generation = self._generation
+        with self._refresh_lock:
+            if self._generation != generation:  # refreshed while we waited
+                return
+            start = time.monotonic()
+            try:
+                data = self.fetch()
+            except Exception as e:
+                self.errors += 1
+                self.failed = self.clock()
+                print("Refresh failed: %s" % e)
+                return
+            finally:
+                self._generation += 1
+            self.published = (data, self.clock(), time.monotonic() - start)
+            self.failed = None
+
+    @property
+    def data(self):
+        return self.published[0]
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.refresh()
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def gauge(name, help_text, value, kind="gauge"):
+    return "# HELP %s %s\n# TYPE %s %s\n%s %s\n\n" % (name, help_text, name, kind, name, value)
+
+
+def category_gauges(categories):
+    lines = []
+    for k in ("pages", "subcats", "files"):
+        name = "wikipedia_category_%s" % k
+        lines.append("# HELP %s Number of %s in the category\n# TYPE %s gauge\n"
+                     % (name, k, name))
+        for title in sorted(categories):
+            lines.append('%s{category="%s"} %s\n'
+                         % (name, metrics.escape_label(title), categories[title][k]))
+        lines.append("\n")
+    return "".join(lines)
+
+
+def format_metrics(snapshot):
+    lines = []
+    data, updated, refresh_seconds = snapshot.published
+    # Scrapes never wait for upstream: until the first refresh succeeds, or
+    # after one fails, this is 0 and the last good data (if any) is served.
+    up = int(data is not None and snapshot.failed is None)
+    lines.append(gauge("exporter_upstream_up",
+                       "Whether the last upstream refresh succeeded", up))
+    if data is not None:
+        statistics = data["statistics"]
+        for k in sorted(statistics):
+            v = statistics[k]
+            k = k.replace("-", "")
+            lines.append(gauge("wikipedia_%s_total" % k, "Total number of %s" % k, v))
+        if data.get("categories"):
+            lines.append(category_gauges(data["categories"]))
+        lines.append(gauge("exporter_snapshot_age_seconds",
+                           "Seconds since the upstream data was fetched",
+                           "%.3f" % (snapshot.clock() - updated)))
+        lines.append(gauge("exporter_refresh_duration_seconds",
+                           "Seconds the last upstream refresh took",
+                           "%.3f" % refresh_seconds))
+    lines.append(gauge("exporter_refresh_errors_total", "Failed upstream refreshes",
+                       snapshot.errors, kind="counter"))
+    return "".join(lines)
+
 
 class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    snapshot = None  # set by main()
+
     def do_GET(self):
-        metric_json = urllib.request.urlopen(METRICS_URL)
-        metric_data = json.loads(metric_json.read().decode())
+        start = time.monotonic()
+        body = format_metrics(self.snapshot) + metrics.text()
+        body += gauge("exporter_scrape_duration_seconds",
+                      "Seconds taken to answer this scrape",
+                      "%.6f" % (time.monotonic() - start))
+        body = bytes(body, "utf8")
         self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
         self.end_headers()
+        self.wfile.write(body)
 
-        for k in sorted(metric_data["query"]["statistics"]):
-            v = metric_data["query"]["statistics"][k]
-            k = k.replace("-", "")
-            self.wfile.write(bytes("# HELP wikipedia_%s_total Total number of %s\n" % (k, k), "utf8"))
-            self.wfile.write(bytes("# TYPE wikipedia_%s_total gauge\n" % k, "utf8"))
-            self.wfile.write(bytes("wikipedia_%s_total %s\n\n" % (k, v), "utf8"))
+def read_categories(filename):
+    with open(filename) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
 
 def main():
-    server_address = ('', 8001)
-    httpd = http.server.HTTPServer(server_address, MetricsHandler)
+    categories = read_categories(sys.argv[1]) if len(sys.argv) > 1 else BACKLOG_CATEGORIES
+    MetricsHandler.snapshot = Snapshot(functools.partial(fetch, categories))
+    MetricsHandler.snapshot.start()
+    server_address = ('', PORT)
+    httpd = http.server.ThreadingHTTPServer(server_address, MetricsHandler)
     httpd.serve_forever()
 
 if __name__ == "__main__":
@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+
+import exporter
+import fakes
+
+import http.server
+import threading
+import unittest
+import urllib.request
+
+
+class Fetch(object):
+    def __init__(self, hold=None):
+        self.hold = hold  # called on every fetch, e.g. to wait for other threads
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.hold:
+            self.hold()
+        return {"statistics": {"pages": 100 + self.calls, "active-users": 5}}
+
+
+class CountingLock(object):
+    """A lock that counts the threads which have tried to take it."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tries = 0
+        self.tried = threading.Condition()
+
+    def __enter__(self):
+        with self.tried:
+            self.tries += 1
+            self.tried.notify_all()
+        return self.lock.__enter__()
+
+    def __exit__(self, *args):
+        return self.lock.__exit__(*args)
+
+    def wait_for(self, tries):
+        with self.tried:
+            if not self.tried.wait_for(lambda: self.tries >= tries, timeout=10):
+                raise AssertionError("only %d of %d threads came" % (self.tries, tries))
+
+
+def refresh_together(snapshot, fetch, count=10):
+    """Refreshes from count threads, the first fetch waiting until all have asked."""
+    lock = CountingLock()
+    snapshot._refresh_lock = lock
+    fetch.hold = lambda: lock.wait_for(count)
+    threads = [threading.Thread(target=snapshot.refresh) for _ in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    fetch.hold = None
+
+
+class SnapshotTest(unittest.TestCase):
+    def test_coalesce(self):
+        fetch = Fetch()
+        snapshot = exporter.Snapshot(fetch)
+        refresh_together(snapshot, fetch)
+        self.assertEqual(1, fetch.calls)
+        self.assertEqual(101, snapshot.data["statistics"]["pages"])
+        snapshot.refresh()
+        self.assertEqual(2, fetch.calls)
+
+    def test_error_keeps_data(self):
+        fetch = Fetch()
+        snapshot = exporter.Snapshot(fetch)
+        snapshot.refresh()
+        snapshot.fetch = lambda: 1 / 0
+        snapshot.refresh()
+        self.assertEqual((101, 1), (snapshot.data["statistics"]["pages"], snapshot.errors))
+
+    def test_failure_coalesced(self):
+        fetch = Fetch()
+        def fail():
+            fetch()
+            raise IOError("upstream down")
+        snapshot = exporter.Snapshot(fail)
+        refresh_together(snapshot, fetch)
+        self.assertEqual((1, 1), (fetch.calls, snapshot.errors))
+        self.assertIsNotNone(snapshot.failed)
+        self.assertIn("exporter_upstream_up 0\n", exporter.format_metrics(snapshot))
+
+        snapshot.fetch = fetch
+        snapshot.refresh()
+        self.assertIsNone(snapshot.failed)
+        self.assertIn("exporter_upstream_up 1\n", exporter.format_metrics(snapshot))
+
+    def test_age(self):
+        now = [1000.0]
+        snapshot = exporter.Snapshot(Fetch(), clock=lambda: now[0])
+        self.assertNotIn("exporter_snapshot_age_seconds", exporter.format_metrics(snapshot))
+        snapshot.refresh()
+        now[0] += 30
+        self.assertIn("\nexporter_snapshot_age_seconds 30.000\n",
+                      exporter.format_metrics(snapshot))
+
+    def test_background(self):
+        fetched = threading.Event()
+        fetch = Fetch(lambda: fetch.calls >= 3 and fetched.set())
+        snapshot = exporter.Snapshot(fetch, interval=0)
+        snapshot.start()
+        self.assertTrue(fetched.wait(10))
+        snapshot.stop()
+        self.assertGreaterEqual(fetch.calls, 3)
+
+
+class FakeApi(object):
+    """Answers siteinfo and categoryinfo queries; categories is {title: pages}."""
+    def __init__(self, categories):
+        self.categories = categories
+        self.requests = []
+
+    def get(self, url, params):
+        self.requests.append(params)
+        query = {}
+        if params.get("meta") == "siteinfo":
+            query["statistics"] = {"pages": 10}
+        if "titles" in params:
+            query["pages"] = {}
+            query["normalized"] = []
+            for i, title in enumerate(params["titles"].split("|")):
+                if title.startswith("category:"):
+                    query["normalized"].append({"from": title, "to": "C" + title[1:]})
+                    title = "C" + title[1:]
+                page = {"title": title}
+                if title in self.categories:
+                    page["categoryinfo"] = {"size": self.categories[title], "subcats": 1,
+                                            "pages": self.categories[title], "files": 0}
+                else:
+                    page["missing"] = ""
+                query["pages"][str(-i - 1)] = page
+        return fakes.FakeResponse({"query": query})
+
+
+class FetchTest(unittest.TestCase):
+    def test_batches(self):
+        categories = ["Category:Backlog %d" % i for i in range(120)]
+        api = FakeApi({x: i for i, x in enumerate(categories)})
+        data = exporter.fetch(categories + ["category:Backlog 7", "Category:Missing"], api)
+        self.assertEqual(3, len(api.requests))
+        self.assertEqual("siteinfo", api.requests[0]["meta"])
+        self.assertNotIn("meta", api.requests[1])
+        self.assertEqual({"pages": 10}, data["statistics"])
+        self.assertEqual({"pages": 5, "subcats": 1, "files": 0},
+                         data["categories"]["Category:Backlog 5"])
+        self.assertEqual(7, data["categories"]["category:Backlog 7"]["pages"])
+        self.assertEqual({"pages": 0, "subcats": 0, "files": 0},
+                         data["categories"]["Category:Missing"])
+
+    def test_no_categories(self):
+        api = FakeApi({})
+        self.assertEqual({"statistics": {"pages": 10}, "categories": {}}, exporter.fetch([], api))
+        self.assertEqual(1, len(api.requests))
+
+    def test_format(self):
+        snapshot = exporter.Snapshot(lambda: exporter.fetch(
+            ["Category:A", 'Category:"Quoted"'], FakeApi({"Category:A": 3})))
+        snapshot.refresh()
+        body = exporter.format_metrics(snapshot)
+        self.assertIn("# TYPE wikipedia_category_pages gauge\n"
+                      'wikipedia_category_pages{category="Category:\\"Quoted\\""} 0\n'
+                      'wikipedia_category_pages{category="Category:A"} 3\n', body)
+        self.assertIn('wikipedia_category_subcats{category="Category:A"} 1\n', body)
+
+
+class ServerTest(unittest.TestCase):
+    def scrape(self, count):
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), exporter.MetricsHandler)
+        server.RequestHandlerClass.log_message = lambda *args: None
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        url = "http://127.0.0.1:%d/metrics" % server.server_address[1]
+        bodies = []
+        threads = [threading.Thread(target=lambda: bodies.append(
+                       urllib.request.urlopen(url).read().decode()))
+                   for _ in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        server.shutdown()
+        server.server_close()
+        return bodies
+
+    def test_scrapes(self):
+        fetch = Fetch()
+        exporter.MetricsHandler.snapshot = exporter.Snapshot(fetch, interval=3600)
+        bodies = self.scrape(5)  # before the first refresh: no upstream requests
+        self.assertEqual(0, fetch.calls)
+        self.assertEqual(5, len(bodies))
+        self.assertIn("\nexporter_upstream_up 0\n", bodies[0])
+        self.assertNotIn("wikipedia_pages_total", bodies[0])
+
+        exporter.MetricsHandler.snapshot.refresh()
+        bodies = self.scrape(5)
+        self.assertEqual(1, fetch.calls)
+        self.assertEqual(5, len(bodies))
+        body = bodies[0]
+        self.assertIn("\nexporter_upstream_up 1\n", body)
+        self.assertIn("# TYPE wikipedia_activeusers_total gauge\nwikipedia_activeusers_total 5\n", body)
+        self.assertIn("wikipedia_pages_total 101\n", body)
+        for name in ["exporter_snapshot_age_seconds", "exporter_refresh_duration_seconds",
+                     "exporter_scrape_duration_seconds", "exporter_refresh_errors_total"]:
+            self.assertIn("\n%s " % name, body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,18 @@
+#!/usr/bin/python3
+#
+# Stand-ins for the wiki shared by the tests.
+
+
+class FakeResponse(object):
+    """A response with data as its JSON body, or text as its content."""
+    def __init__(self, data=None, status_code=200, text="", headers=None):
+        self.data = data
+        self.status_code = status_code
+        self.content = text.encode("utf-8")
+        self.headers = headers or {}
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        pass
@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+#
+# The HTTP client the scripts share: pooled keep-alive connections (and
+# gzip, which requests asks for by default), retries with exponential
+# backoff, Retry-After and maxlag handling, and a limit on concurrent
+# requests to each host.
+
+import metrics
+
+import email.utils
+import random
+import threading
+import time
+import urllib.parse
+
+import requests
+import requests.adapters
+
+USER_AGENT = "wiki_scripts (https://github.com/powera/wiki_scripts) " + requests.utils.default_user_agent()
+MAXLAG = 5  # seconds; see https://www.mediawiki.org/wiki/Manual:Maxlag_parameter
+MAX_RETRIES = 5
+BACKOFF = 1.0  # seconds, doubled on each retry
+MAX_BACKOFF = 60.0
+PER_HOST = 4  # concurrent requests to one host
+TIMEOUT = 60
+RETRY_STATUS = {429, 500, 502, 503, 504}
+SAFE_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+REQUESTS = metrics.counter("wiki_http_requests_total",
+                           "HTTP requests made, by API action and status", ["action", "status"])
+REQUEST_SECONDS = metrics.summary("wiki_http_request_seconds",
+                                  "Time waiting for HTTP responses, by API action", ["action"])
+RETRIES = metrics.counter("wiki_http_retries_total", "HTTP requests retried")
+
+
+def _action(kwargs):
+    """The API action of a request, for metrics."""
+    for key in ("params", "data"):
+        if isinstance(kwargs.get(key), dict) and "action" in kwargs[key]:
+            return kwargs[key]["action"]
+    return "none"
+
+
+def _idempotent(method, action):
+    """Whether a request can be sent again after a failure we know nothing about.
+
+    An edit or login that timed out may still have been made, so only
+    reads are retried on errors; anything else only when the wiki says it
+    did nothing (maxlag, or 429 Too Many Requests).
+    """
+    return method.upper() in SAFE_METHODS or action == "query"
+
+
+class Session(requests.Session):
+    """A requests.Session that retries, backs off and limits concurrency.
+
+    Requests to api.php get a maxlag parameter, and are retried when the
+    wiki answers that its replicas are lagging.  Other failures are only
+    retried for reads (see _idempotent).
+    """
+
+    def __init__(self, max_retries=MAX_RETRIES, backoff=BACKOFF, max_backoff=MAX_BACKOFF,
+                 per_host=PER_HOST, maxlag=MAXLAG, timeout=TIMEOUT, sleep=time.sleep):
+        super().__init__()
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.per_host = per_host
+        self.maxlag = maxlag
+        self.timeout = timeout
+        self.sleep = sleep
+        self.retries = 0
+        self.headers["User-Agent"] = USER_AGENT
+        adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=per_host)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+        self._hosts = {}
+        self._hosts_lock = threading.Lock()
+
+    def _host_limit(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self._hosts_lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(self.per_host)
+            return self._hosts[host]
+
+    def _delay(self, attempt, response):
+        """Seconds to wait before retry number attempt (from 0)."""
+        if response is not None and response.headers.get("Retry-After"):
+            value = response.headers["Retry-After"]
+            try:
+                return min(float(value), self.max_backoff)
+            except ValueError:
+                try:
+                    when = email.utils.parsedate_to_datetime(value).timestamp()
+                    return min(max(when - time.time(), 0), self.max_backoff)
+                except (TypeError, ValueError):
+                    pass
+        # "Full jitter", so that threads waiting on the same host spread out.
+        return random.uniform(0, min(self.backoff * 2 ** attempt, self.max_backoff))
+
+    def _retry(self, response, idempotent):
+        if response.headers.get("MediaWiki-API-Error") == "maxlag" or response.status_code == 429:
+            return True
+        return idempotent and response.status_code in RETRY_STATUS
+
+    def request(self, method, url, **kwargs):
+        if self.maxlag is not None and urllib.parse.urlsplit(url).path.endswith("api.php"):
+            params = kwargs.get("params") or {}
+            if isinstance(params, dict) and "maxlag" not in params:
+                kwargs["params"] = dict(params, maxlag=self.maxlag)
+        kwargs.setdefault("timeout", self.timeout)
+        limit = self._host_limit(url)
+        action = _action(kwargs)
+        idempotent = _idempotent(method, action)
+        attempt = 0
+        while True:
+            response = None
+            try:
+                with limit, REQUEST_SECONDS.time(action=action):
+                    response = super().request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                REQUESTS.inc(action=action, status="error")
+                if attempt >= self.max_retries or not idempotent:
+                    raise
+            else:
+                REQUESTS.inc(action=action, status=response.status_code)
+                if attempt >= self.max_retries or not self._retry(response, idempotent):
+                    return response
+            delay = self._delay(attempt, response)
+            if response is not None:
+                response.close()  # give the connection back to the pool
+            self.sleep(delay)
+            attempt += 1
+            self.retries += 1
+            RETRIES.inc()
+
+
+_session = None
+_session_lock = threading.Lock()
+
+def default_session():
+    """A Session shared by everything that does not need to log in."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = Session()
+        return _session
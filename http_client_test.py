@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+
+import http_client
+
+import requests
+import requests.adapters
+import threading
+import time
+import unittest
+
+
+class FakeAdapter(requests.adapters.BaseAdapter):
+    """Answers requests with the (status, headers) pairs in answers, in turn."""
+    def __init__(self, answers, delay=0):
+        super().__init__()
+        self.answers = list(answers)
+        self.delay = delay
+        self.requests = []
+        self.active = 0
+        self.most_active = 0
+        self.lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        with self.lock:
+            self.requests.append(request)
+            self.active += 1
+            self.most_active = max(self.most_active, self.active)
+            answer = self.answers.pop(0) if self.answers else (200, {})
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+        if answer == "error":
+            raise requests.ConnectionError("refused")
+        response = requests.Response()
+        response.status_code, headers = answer
+        response.headers.update(headers)
+        response._content = b"{}"
+        response.request = request
+        response.url = request.url
+        return response
+
+    def close(self):
+        pass
+
+
+class SessionTest(unittest.TestCase):
+    def session(self, answers, **kwargs):
+        self.sleeps = []
+        session = http_client.Session(sleep=self.sleeps.append, **kwargs)
+        self.adapter = FakeAdapter(answers)
+        session.mount("https://", self.adapter)
+        return session
+
+    def test_retry_after(self):
+        session = self.session([(503, {"Retry-After": "7"}), (429, {}), (200, {})])
+        self.assertEqual(200, session.get("https://example.org/x").status_code)
+        self.assertEqual(3, len(self.adapter.requests))
+        self.assertEqual(7, self.sleeps[0])
+        self.assertLessEqual(self.sleeps[1], 2 * http_client.BACKOFF)
+
+    def test_maxlag(self):
+        before = http_client.REQUESTS.value(action="query", status=200)
+        session = self.session([(200, {"MediaWiki-API-Error": "maxlag", "Retry-After": "5"})])
+        session.get("https://en.wikipedia.org/w/api.php", params={"action": "query"})
+        self.assertEqual([5], self.sleeps)
+        self.assertEqual(before + 2, http_client.REQUESTS.value(action="query", status=200))
+        for request in self.adapter.requests:
+            self.assertIn("maxlag=5", request.url)
+            self.assertIn("action=query", request.url)
+
+    def test_gives_up(self):
+        session = self.session(["error"] * 3, max_retries=2)
+        with self.assertRaises(requests.ConnectionError):
+            session.get("https://example.org/x")
+        self.assertEqual(2, len(self.sleeps))
+
+        session = self.session([(503, {})] * 3, max_retries=2)
+        self.assertEqual(503, session.get("https://example.org/x").status_code)
+
+    def test_not_retried(self):
+        session = self.session([(404, {})])
+        self.assertEqual(404, session.get("https://example.org/x").status_code)
+        self.assertEqual([], self.sleeps)
+
+    def test_post_retried_only_when_not_done(self):
+        session = self.session([(503, {}), "error"])
+        data = {"action": "edit", "title": "X"}
+        self.assertEqual(503, session.post("https://example.org/w/api.php", data=data).status_code)
+        with self.assertRaises(requests.ConnectionError):
+            session.post("https://example.org/w/api.php", data=data)
+        self.assertEqual([], self.sleeps)
+
+        session = self.session([(429, {"Retry-After": "3"}), (200, {})])
+        self.assertEqual(200, session.post("https://example.org/w/api.php", data=data).status_code)
+        self.assertEqual([3], self.sleeps)
+
+        session = self.session(["error", (503, {}), (200, {})])
+        data = {"action": "query", "titles": "X"}
+        self.assertEqual(200, session.post("https://example.org/w/api.php", data=data).status_code)
+        self.assertEqual(2, len(self.sleeps))
+
+    def test_per_host(self):
+        session = self.session([], per_host=2)
+        self.adapter.delay = 0.02
+        threads = [threading.Thread(target=session.get, args=("https://example.org/%d" % i,))
+                   for i in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(6, len(self.adapter.requests))
+        self.assertEqual(2, self.adapter.most_active)
+
+
+if __name__ == '__main__':
+    unittest.main()
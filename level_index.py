@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+#
+# An index of the vital article lists: the level, topic and subpage each
+# article is listed under.  It is saved between runs along with the
+# revision each list page was read at, so only list pages edited since
+# are fetched and parsed again, and what changed between runs is a diff
+# of two snapshots.
+
+import disk_cache
+import util
+import vital_count
+
+import collections
+import json
+import os
+
+INDEX_PATH = os.path.join(disk_cache.CACHE_ROOT, "level_index.json")
+
+# How a list page's links are listed; sentinel, if set, is a marker that
+# the list starts after.
+ListPage = collections.namedtuple("ListPage", ["level", "topic", "subpage", "sentinel"])
+
+# Where an article is listed; page is the list page.
+Entry = collections.namedtuple("Entry", ["level", "topic", "subpage", "page"])
+
+
+class LevelIndex(object):
+    def __init__(self, path=INDEX_PATH):
+        self.path = path
+        self.pages = {}  # list page -> {"revid", "level", "topic", "subpage", "links"}
+        self.pending = set()  # articles whose talk pages are still to be updated
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        self.pages = data["pages"]
+        self.pending = set(data.get("pending", ()))
+
+    def refresh(self, list_pages, session, processes=None):
+        """Brings the index up to date with the wiki.
+
+        list_pages maps each list page title to its ListPage.  Only pages
+        whose latest revision is not the one in the index are read and
+        parsed.  Returns the titles that were.
+        """
+        revisions = util.read_revisions(list_pages, session, content=False)
+        for title in set(self.pages) - set(revisions):  # no longer a list, or deleted
+            del self.pages[title]
+        changed = [title for title, rev in revisions.items()
+                   if self.pages.get(title, {}).get("revid") != rev["revid"]]
+
+        revids = {}
+        texts = []
+        for title, rev in util.read_revisions(changed, session).items():
+            text = rev["content"]
+            sentinel = list_pages[title].sentinel
+            if sentinel and sentinel in text:
+                text = text.split(sentinel, 1)[1]
+            revids[title] = rev["revid"]
+            texts.append((title, text))
+        for title, links in vital_count.parse_links(texts, processes).items():
+            self.pages[title] = {"revid": revids[title], "links": sorted(links)}
+
+        for title, page in self.pages.items():
+            page.update(list_pages[title]._asdict())
+            del page["sentinel"]
+        return changed
+
+    def articles(self):
+        """A snapshot of the index: {article: Entry}.
+
+        An article on several lists gets the lowest (most vital) level.
+        """
+        result = {}
+        for title, page in sorted(self.pages.items(), key=lambda x: (-x[1]["level"], x[0])):
+            entry = Entry(page["level"], page["topic"], page["subpage"], title)
+            for link in page["links"]:
+                result[link] = entry
+        return result
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({"pages": self.pages, "pending": sorted(self.pending)}, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def diff(old, new):
+    """Compares two snapshots: ({article: Entry} new or changed, {removed articles})."""
+    changed = {k: v for k, v in new.items() if old.get(k) != v}
+    return changed, set(old) - set(new)
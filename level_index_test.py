@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+
+import fakes
+import level_index
+
+import os
+import tempfile
+import unittest
+
+
+class FakeWiki(object):
+    """Answers prop=revisions and prop=templates queries from pages, {title: (revid, text)}."""
+    def __init__(self, pages):
+        self.pages = pages
+        self.read = []  # titles whose content was asked for
+
+    def post(self, url, data):
+        if data.get("meta") == "userinfo":
+            return fakes.FakeResponse({"query": {"userinfo": {"rights": ["apihighlimits"]}}})
+        pages = {}
+        for i, title in enumerate(data["titles"].split("|")):
+            if title not in self.pages:
+                pages[str(-i - 1)] = {"title": title, "missing": ""}
+                continue
+            revid, text = self.pages[title]
+            if data["prop"] == "templates":
+                pages[str(i)] = {"title": title, "templates": [
+                    {"ns": 10, "title": "Template:" + x} for x in ("Bots", "Nobots")
+                    if "{{%s" % x.lower() in text.lower()]}
+                continue
+            if data.get("rvsection") == 0:
+                text = text.split("\n==")[0]
+            rev = {"revid": revid, "timestamp": "ts"}
+            if "content" in data["rvprop"]:
+                self.read.append(title)
+                rev["*"] = text
+            pages[str(i)] = {"title": title, "revisions": [rev]}
+        return fakes.FakeResponse({"query": {"pages": pages}})
+
+
+LIST_PAGES = {
+    "Level 3": level_index.ListPage(3, None, None, "<!-- start -->"),
+    "Level 4/Arts": level_index.ListPage(4, "Art", None, None),
+    "Level 5/Arts": level_index.ListPage(5, "Art", None, None),
+    "Level 5/People/Writers": level_index.ListPage(5, "People", "Writers", None),
+}
+
+
+class LevelIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "index.json")
+        self.wiki = FakeWiki({
+            "Level 3": (1, "[[Header]] <!-- start --> [[Music]] [[Painting]]"),
+            "Level 4/Arts": (2, "[[Music]] [[Painting]] [[Opera]] [[File:x.jpg]]"),
+            "Level 5/Arts": (3, "[[Opera]] [[Jazz]]"),
+            "Level 5/People/Writers": (4, "[[Homer]]"),
+        })
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_articles(self):
+        index = level_index.LevelIndex(self.path)
+        self.assertEqual(4, len(index.refresh(LIST_PAGES, self.wiki, processes=1)))
+        E = level_index.Entry
+        self.assertEqual({
+            "Music": E(3, None, None, "Level 3"),
+            "Painting": E(3, None, None, "Level 3"),
+            "Opera": E(4, "Art", None, "Level 4/Arts"),
+            "Jazz": E(5, "Art", None, "Level 5/Arts"),
+            "Homer": E(5, "People", "Writers", "Level 5/People/Writers"),
+        }, index.articles())
+
+    def test_incremental(self):
+        index = level_index.LevelIndex(self.path)
+        index.refresh(LIST_PAGES, self.wiki, processes=1)
+        index.save()
+        old = index.articles()
+
+        self.wiki.pages["Level 5/Arts"] = (5, "[[Jazz]] [[Blues]]")
+        self.wiki.pages["Level 3"] = (6, "<!-- start --> [[Music]] [[Opera]]")
+        del self.wiki.pages["Level 5/People/Writers"]
+        self.wiki.read = []
+        index = level_index.LevelIndex(self.path)
+        self.assertEqual(old, index.articles())
+        self.assertEqual({"Level 5/Arts", "Level 3"},
+                         set(index.refresh(LIST_PAGES, self.wiki, processes=1)))
+        self.assertEqual({"Level 5/Arts", "Level 3"}, set(self.wiki.read))
+
+        changed, removed = level_index.diff(old, index.articles())
+        E = level_index.Entry
+        self.assertEqual({"Painting": E(4, "Art", None, "Level 4/Arts"),
+                          "Opera": E(3, None, None, "Level 3"),
+                          "Blues": E(5, "Art", None, "Level 5/Arts")}, changed)
+        self.assertEqual({"Homer"}, removed)
+
+
+if __name__ == '__main__':
+    unittest.main()
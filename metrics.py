@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+#
+# Counters and timings kept by the scripts themselves (HTTP requests,
+# tokenizing, caches, edits), in the Prometheus text format that
+# exporter.py serves.  Batch runs write them to METRICS_PATH when done,
+# where node_exporter's textfile collector can pick them up.
+#
+#   REQUESTS = metrics.counter("wiki_things_total", "Things done", ["kind"])
+#   REQUESTS.inc(kind="this")
+#   with SECONDS.time():
+#       ...
+
+import disk_cache
+
+import contextlib
+import os
+import threading
+import time
+
+METRICS_PATH = os.path.join(disk_cache.CACHE_ROOT, "metrics.prom")
+
+_registry = {}  # name -> metric, in the order registered
+_registry_lock = threading.Lock()
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}  # label values -> value
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[k]) for k in self.labels)
+
+    def _series(self, name, key):
+        if not self.labels:
+            return name
+        return "%s{%s}" % (name, ",".join('%s="%s"' % (k, escape_label(v))
+                                          for k, v in zip(self.labels, key)))
+
+    def text(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = ["# HELP %s %s\n# TYPE %s %s\n" % (self.name, self.help, self.name, self.kind)]
+        for key, value in values:
+            lines.extend(self._lines(key, value))
+        return "".join(lines) + "\n"
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _lines(self, key, value):
+        yield "%s %s\n" % (self._series(self.name, key), value)
+
+
+class Summary(_Metric):
+    """A count and sum of observations, such as durations in seconds."""
+    kind = "summary"
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            count, total = self._values.get(key, (0, 0.0))
+            self._values[key] = (count + 1, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        return self._values.get(self._key(labels), (0, 0.0))[0]
+
+    def _lines(self, key, value):
+        yield "%s %d\n" % (self._series(self.name + "_count", key), value[0])
+        yield "%s %.6f\n" % (self._series(self.name + "_sum", key), value[1])
+
+
+def _register(cls, name, help_text, labels):
+    with _registry_lock:
+        if name not in _registry:
+            _registry[name] = cls(name, help_text, labels)
+        return _registry[name]
+
+def counter(name, help_text, labels=()):
+    return _register(Counter, name, help_text, labels)
+
+def summary(name, help_text, labels=()):
+    return _register(Summary, name, help_text, labels)
+
+
+# Shared by page_cache, parse_cache and vital_count; the hit ratio of a
+# cache is its "hit" lookups over all of them.
+CACHE_LOOKUPS = counter("wiki_cache_lookups_total", "Cache lookups, by cache and result",
+                        ["cache", "result"])
+
+
+def text():
+    """All metrics, in the Prometheus text format."""
+    with _registry_lock:
+        registered = list(_registry.values())
+    return "".join(metric.text() for metric in registered)
+
+
+def dump(path=None):
+    """Writes text() to path (METRICS_PATH by default), for the end of a batch run."""
+    path = path or METRICS_PATH
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        f.write(text())
+    os.replace(path + ".tmp", path)
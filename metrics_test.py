@@ -0,0 +1,50 @@
+#!/usr/bin/python3
+
+import metrics
+import parser
+
+import os
+import tempfile
+import threading
+import unittest
+
+
+class MetricsTest(unittest.TestCase):
+    def test_counter(self):
+        c = metrics.counter("test_things_total", "Things", ["kind"])
+        self.assertIs(c, metrics.counter("test_things_total", "Things", ["kind"]))
+        threads = [threading.Thread(target=lambda: [c.inc(kind="a") for _ in range(1000)])
+                   for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        c.inc(2, kind='say "hi"\n')
+        self.assertEqual(4000, c.value(kind="a"))
+        self.assertEqual("# HELP test_things_total Things\n"
+                         "# TYPE test_things_total counter\n"
+                         'test_things_total{kind="a"} 4000\n'
+                         'test_things_total{kind="say \\"hi\\"\\n"} 2\n\n', c.text())
+
+    def test_summary(self):
+        s = metrics.summary("test_seconds", "Time")
+        with s.time():
+            pass
+        s.observe(1.5)
+        self.assertEqual(2, s.count())
+        text = s.text()
+        self.assertIn("# TYPE test_seconds summary\ntest_seconds_count 2\ntest_seconds_sum 1.5", text)
+
+    def test_tokenize_and_dump(self):
+        before = parser.TOKENIZE_SECONDS.count()
+        parser.WikiTokenizer("A").tokenize("[[b]]")
+        self.assertEqual(before + 1, parser.TOKENIZE_SECONDS.count())
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "metrics.prom")
+            metrics.dump(path)
+            with open(path) as f:
+                self.assertIn("wiki_tokenize_seconds_count %d\n" % (before + 1), f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,34 +1,142 @@
 #!/usr/bin/python3
+#
+# Reports users newly given some user rights.  Rights log events are
+# read incrementally: each run asks only for events since the last one,
+# appends them to a local log, and keeps an index of grants and removals
+# for each right that the report is answered from.
 
-URL = ("https://en.wikipedia.org/w/api.php?action=query&list=logevents&"
-       "letype=rights&leaction=rights/rights&lelimit=50&format=json&ledir=newer")
+import disk_cache
+import http_client
 
+import bisect
 import datetime
 import json
-import requests
-
-rights_dict = {}
-
-def get_data(start=None):
-    if not start:
-        start = datetime.datetime.now() - datetime.timedelta(days=28)
-    start_url = URL + "&lestart=" + start.strftime("%Y%m%d%H%M%S")
-    lecontinue = ""
-    while True:
-        page = requests.get(start_url + lecontinue)
-        results = page.json()
-        for logevent in results["query"]["logevents"]:
-            user = logevent["title"]
-            rights_dict.setdefault(user, {"old": logevent["params"]["oldgroups"]})
-            rights_dict[user]["new"] = logevent["params"]["newgroups"]
-        if "continue" in results:
-            lecontinue = "&lecontinue=" + results["continue"]["lecontinue"]
-        else:
-            break
-    for right in ["extendedmover", "reviewer", "patroller", "templateeditor"]:
-        print("\n'''" + right + "'''")
-        for user in sorted(rights_dict.keys()):
-            if right in rights_dict[user]["new"] and right not in rights_dict[user]["old"]:
-                print("* " + user)
-
-get_data()
+import os
+
+API_URL = "https://en.wikipedia.org/w/api.php"
+STORE_DIR = os.path.join(disk_cache.CACHE_ROOT, "rights")
+DAYS = 28  # how far back the first run, and the report, look
+REPORTED_RIGHTS = ["extendedmover", "reviewer", "patroller", "templateeditor"]
+
+
+def _timestamp(when):
+    return when.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class RightsLog(object):
+    """The rights log, stored in directory.
+
+    events.jsonl has one event per line, oldest first, and is only ever
+    appended to.  state.json has the checkpoint of the last request and,
+    for each right, its events as [timestamp, user, "grant" or "remove"].
+    """
+
+    def __init__(self, directory=STORE_DIR, session=None):
+        self.directory = directory
+        self.session = session or http_client.default_session()
+        os.makedirs(directory, exist_ok=True)
+        self.events_path = os.path.join(directory, "events.jsonl")
+        self.state_path = os.path.join(directory, "state.json")
+        self.state = {"lestart": None, "lecontinue": None, "logid": 0, "rights": {}}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.state = json.load(f)
+        last = self._last_event()
+        if last is not None and last["logid"] > self.state["logid"]:
+            self._replay()  # interrupted after appending events
+
+    def _last_event(self):
+        if not os.path.exists(self.events_path):
+            return None
+        with open(self.events_path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            pos = f.tell()
+            while pos > 0:
+                pos = max(pos - 4096, 0)
+                f.seek(pos)
+                lines = f.read().splitlines()
+                if len(lines) > 1 or pos == 0:
+                    return json.loads(lines[-1]) if lines else None
+
+    def _replay(self):
+        """Rebuilds the state from events.jsonl."""
+        self.state = {"lestart": None, "lecontinue": None, "logid": 0, "rights": {}}
+        with open(self.events_path) as f:
+            for line in f:
+                self._index(json.loads(line))
+
+    def _index(self, event):
+        for right in sorted(set(event["new"]) - set(event["old"])):
+            self.state["rights"].setdefault(right, []).append(
+                [event["timestamp"], event["user"], "grant"])
+        for right in sorted(set(event["old"]) - set(event["new"])):
+            self.state["rights"].setdefault(right, []).append(
+                [event["timestamp"], event["user"], "remove"])
+        self.state["logid"] = event["logid"]
+        self.state["lestart"] = event["timestamp"]
+
+    def _save_state(self):
+        with open(self.state_path + ".tmp", "w") as f:
+            json.dump(self.state, f)
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+    def ingest(self, now=None):
+        """Reads the events logged since the last run.  Returns how many."""
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        params = {
+            "action": "query", "format": "json", "list": "logevents",
+            "letype": "rights", "leaction": "rights/rights", "ledir": "newer",
+            "lelimit": "max", "leprop": "ids|title|timestamp|details",
+            "lestart": self.state["lestart"] or _timestamp(now - datetime.timedelta(days=DAYS)),
+        }
+        if self.state["lecontinue"]:
+            params["lecontinue"] = self.state["lecontinue"]
+        count = 0
+        while True:
+            results = self.session.get(API_URL, params=params).json()
+            new = [x for x in results["query"]["logevents"] if x["logid"] > self.state["logid"]]
+            with open(self.events_path, "a") as f:
+                for logevent in new:
+                    event = {"logid": logevent["logid"], "timestamp": logevent["timestamp"],
+                             "user": logevent["title"],
+                             "old": logevent["params"]["oldgroups"],
+                             "new": logevent["params"]["newgroups"]}
+                    f.write(json.dumps(event) + "\n")
+                    self._index(event)
+                f.flush()
+                os.fsync(f.fileno())
+            count += len(new)
+            if "continue" in results:
+                self.state["lecontinue"] = params["lecontinue"] = results["continue"]["lecontinue"]
+            else:
+                self.state["lecontinue"] = None
+            self._save_state()
+            if "continue" not in results:
+                return count
+
+    def gained(self, right, since):
+        """Users who have right now but did not at since (a log timestamp)."""
+        events = self.state["rights"].get(right, [])  # in timestamp order
+        first = {}
+        last = {}
+        for timestamp, user, change in events[bisect.bisect_left(events, [since]):]:
+            first.setdefault(user, change)
+            last[user] = change
+        return sorted(u for u in last if first[u] == "grant" and last[u] == "grant")
+
+    def report(self, since, rights=REPORTED_RIGHTS):
+        lines = []
+        for right in rights:
+            lines.append("\n'''" + right + "'''")
+            lines.extend("* " + user for user in self.gained(right, since))
+        return "\n".join(lines)
+
+
+def main():
+    log = RightsLog()
+    log.ingest()
+    since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=DAYS)
+    print(log.report(_timestamp(since)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+
+import fakes
+import new_rights
+
+import datetime
+import os
+import tempfile
+import unittest
+
+
+class FakeLog(object):
+    """Answers list=logevents queries, PAGE events at a time."""
+    PAGE = 3
+
+    def __init__(self):
+        self.events = []
+        self.requests = []
+
+    def add(self, timestamp, user, old, new):
+        self.events.append({"logid": len(self.events) + 1, "timestamp": timestamp,
+                            "title": user, "params": {"oldgroups": old, "newgroups": new}})
+
+    def get(self, url, params):
+        self.requests.append(params)
+        start = int(params.get("lecontinue", 0))
+        events = [x for x in self.events[start:] if x["timestamp"] >= params["lestart"]]
+        result = {"query": {"logevents": events[:self.PAGE]}}
+        if len(events) > self.PAGE:
+            next_event = events[self.PAGE]
+            result["continue"] = {"lecontinue": str(self.events.index(next_event))}
+        return fakes.FakeResponse(result)
+
+
+class RightsLogTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.api = FakeLog()
+        self.now = datetime.datetime(2020, 3, 1)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def log(self):
+        return new_rights.RightsLog(self.tmp.name, self.api)
+
+    def test_ingest(self):
+        self.api.add("2020-01-01T00:00:00Z", "Old", [], ["reviewer"])  # too old
+        self.api.add("2020-02-10T00:00:00Z", "A", [], ["reviewer", "patroller"])
+        self.api.add("2020-02-11T00:00:00Z", "B", ["reviewer"], [])
+        self.api.add("2020-02-12T00:00:00Z", "C", [], ["reviewer"])
+        self.api.add("2020-02-13T00:00:00Z", "C", ["reviewer"], [])
+        log = self.log()
+        self.assertEqual(4, log.ingest(self.now))
+        self.assertEqual("max", self.api.requests[0]["lelimit"])
+        self.assertEqual(2, len(self.api.requests))
+        self.assertEqual(["A"], log.gained("reviewer", "2020-02-01T00:00:00Z"))
+        self.assertEqual("\n'''reviewer'''\n* A\n\n'''patroller'''\n* A",
+                         log.report("2020-02-01T00:00:00Z", ["reviewer", "patroller"]))
+
+        # The next run asks only for new events, and keeps the old ones.
+        self.api.add("2020-02-13T00:00:00Z", "D", [], ["reviewer"])
+        self.api.requests = []
+        log = self.log()
+        self.assertEqual(1, log.ingest(self.now))
+        self.assertEqual("2020-02-13T00:00:00Z", self.api.requests[0]["lestart"])
+        self.assertEqual(["A", "D"], log.gained("reviewer", "2020-02-01T00:00:00Z"))
+        self.assertEqual(["D"], log.gained("reviewer", "2020-02-13T00:00:00Z"))
+        with open(os.path.join(self.tmp.name, "events.jsonl")) as f:
+            self.assertEqual(5, len(f.readlines()))
+
+        self.assertEqual(0, self.log().ingest(self.now))
+
+    def test_interrupted(self):
+        for i in range(5):
+            self.api.add("2020-02-1%dT00:00:00Z" % i, "U%d" % i, [], ["reviewer"])
+        log = self.log()
+        log.ingest(self.now)
+        os.remove(os.path.join(self.tmp.name, "state.json"))  # lost after appending
+        log = self.log()
+        self.assertEqual(5, log.state["logid"])
+        self.assertEqual(0, log.ingest(self.now))
+        self.assertEqual(["U%d" % i for i in range(5)],
+                         log.gained("reviewer", "2020-02-01T00:00:00Z"))
+
+
+if __name__ == '__main__':
+    unittest.main()
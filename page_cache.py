@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+#
+# A cache of raw page text for util.get_page, in memory and on disk.
+# Entries younger than the TTL are used as they are; older ones are
+# revalidated with a conditional request (ETag / Last-Modified).
+
+import disk_cache
+import http_client
+import metrics
+
+import collections
+import json
+import os
+import threading
+import time
+import urllib.parse
+
+CACHE_DIR = os.path.join(disk_cache.CACHE_ROOT, "pages")
+MAX_CACHE_BYTES = 256 << 20
+MEMORY_ENTRIES = 512
+TTL = 300  # seconds
+RAW_URL = "https://en.wikipedia.org/wiki/%s?action=raw"
+
+
+class PageCache(object):
+    def __init__(self, directory=CACHE_DIR, ttl=TTL, max_bytes=MAX_CACHE_BYTES,
+                 memory_entries=MEMORY_ENTRIES, session=None):
+        self.files = disk_cache.DiskCache(directory, max_bytes, ".json")
+        self.ttl = ttl
+        self.memory_entries = memory_entries
+        self.session = session or http_client.default_session()
+        self._memory = collections.OrderedDict()  # title -> entry, oldest use first
+        self._lock = threading.Lock()  # for _memory and the counters
+        self.hits = 0  # fresh entries, no request made
+        self.revalidated = 0  # "304 Not Modified"
+        self.misses = 0  # page text downloaded
+
+    def _lookup(self, title):
+        with self._lock:
+            entry = self._memory.get(title)
+            if entry is not None:
+                self._memory.move_to_end(title)
+                return entry
+        data = self.files.read(disk_cache.file_name(title))
+        if data is None:
+            return None
+        try:
+            entry = json.loads(data.decode("utf-8"))
+        except ValueError:
+            self.files.remove(disk_cache.file_name(title))
+            return None
+        self._remember(title, entry)
+        return entry
+
+    def _remember(self, title, entry):
+        with self._lock:
+            self._memory[title] = entry
+            self._memory.move_to_end(title)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def _store(self, title, entry):
+        self._remember(title, entry)
+        self.files.write(disk_cache.file_name(title), json.dumps(entry).encode("utf-8"))
+
+    def get(self, title, max_age=None):
+        """The raw wiki text of title.
+
+        Entries younger than max_age seconds (the TTL by default) are used
+        without a request; max_age=0 always revalidates.
+        """
+        if max_age is None:
+            max_age = self.ttl
+        entry = self._lookup(title)
+        now = time.time()
+        if entry is not None and now - entry["fetched"] < max_age:
+            with self._lock:
+                self.hits += 1
+            metrics.CACHE_LOOKUPS.inc(cache="page", result="hit")
+            return entry["text"]
+
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        r = self.session.get(RAW_URL % urllib.parse.quote(title), headers=headers)
+        if r.status_code == 304 and entry is not None:
+            with self._lock:
+                self.revalidated += 1
+            metrics.CACHE_LOOKUPS.inc(cache="page", result="revalidated")
+            entry = dict(entry, fetched=now)
+            self._store(title, entry)
+            return entry["text"]
+        r.raise_for_status()
+
+        with self._lock:
+            self.misses += 1
+        metrics.CACHE_LOOKUPS.inc(cache="page", result="miss")
+        entry = {
+            "text": r.content.decode("utf-8"),
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+            "fetched": now,
+        }
+        self._store(title, entry)
+        return entry["text"]
+
+    def forget(self, title):
+        """Drops title, for instance after editing it."""
+        with self._lock:
+            self._memory.pop(title, None)
+        self.files.remove(disk_cache.file_name(title))
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def default_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = PageCache()
+        return _cache
@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+
+import fakes
+import page_cache
+
+import tempfile
+import unittest
+
+
+class FakeWiki(object):
+    """Serves pages, answering conditional requests as the wiki does."""
+    def __init__(self):
+        self.pages = {}
+        self.requests = []
+
+    def get(self, url, headers):
+        self.requests.append((url, headers))
+        title = url.split("/wiki/")[1].split("?")[0]
+        text, etag = self.pages[title]
+        if etag is not None and headers.get("If-None-Match") == etag:
+            return fakes.FakeResponse(status_code=304)
+        return fakes.FakeResponse(text=text, headers={"ETag": etag})
+
+
+class PageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.wiki = FakeWiki()
+        self.wiki.pages["Talk%3AA"] = ("{{Vital article}}", '"1"')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def cache(self, **kwargs):
+        return page_cache.PageCache(self.tmp.name, session=self.wiki, **kwargs)
+
+    def test_fresh(self):
+        cache = self.cache()
+        self.assertEqual("{{Vital article}}", cache.get("Talk:A"))
+        self.assertEqual("{{Vital article}}", cache.get("Talk:A"))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        self.assertEqual(1, len(self.wiki.requests))
+
+    def test_revalidate(self):
+        cache = self.cache(ttl=0)
+        cache.get("Talk:A")
+        self.assertEqual("{{Vital article}}", cache.get("Talk:A"))
+        self.assertEqual(1, cache.revalidated)
+
+        self.wiki.pages["Talk%3AA"] = ("changed", '"2"')
+        self.assertEqual("changed", cache.get("Talk:A"))
+        self.assertEqual(2, cache.misses)
+
+    def test_max_age(self):
+        cache = self.cache()
+        cache.get("Talk:A")
+        self.wiki.pages["Talk%3AA"] = ("{{nobots}}", '"2"')
+        self.assertEqual("{{Vital article}}", cache.get("Talk:A"))
+        self.assertEqual("{{nobots}}", cache.get("Talk:A", max_age=0))
+
+    def test_on_disk(self):
+        self.cache().get("Talk:A")
+        cache = self.cache(ttl=0)
+        self.assertEqual("{{Vital article}}", cache.get("Talk:A"))
+        self.assertEqual((1, 0), (cache.revalidated, cache.misses))
+
+    def test_forget(self):
+        cache = self.cache()
+        cache.get("Talk:A")
+        cache.forget("Talk:A")
+        cache.get("Talk:A")
+        self.assertEqual(2, cache.misses)
+
+    def test_memory_bound(self):
+        for i in range(5):
+            self.wiki.pages["P%d" % i] = ("text %d" % i, None)
+        cache = self.cache(memory_entries=2)
+        for i in range(5):
+            cache.get("P%d" % i)
+        self.assertEqual(["P3", "P4"], list(cache._memory))
+        self.assertEqual("text 0", cache.get("P0"))  # from disk
+        self.assertEqual(5, cache.misses)
+
+
+if __name__ == '__main__':
+    unittest.main()
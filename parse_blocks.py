@@ -1,61 +1,332 @@
 # Copyright 2017
 
-import functools
+import bisect
 import itertools
 
+
 class LatexRenderState(object):
+    __slots__ = ("math_mode",)
+
     def __init__(self):
         self.math_mode = False
 
 
+class SourceText(object):
+    """The text a tree was parsed from, and the parts of it since changed.
+
+    There is one for each document, so changes counts the changes made to
+    that document's tree after parsing (set_param, re-parsing, removing
+    templates), and cached lookups know to start over.
+    """
+    __slots__ = ("text", "dirty", "marked", "removed", "changes")
+
+    def __init__(self, text=None):
+        self.text = text
+        self.dirty = []  # (start, end) of the changed parts, sorted and merged
+        self.marked = set()  # the SourceSpans of blocks that were changed themselves
+        self.removed = []  # (start, end) of blocks taken out of the tree, sorted
+        self.changes = 0
+
+    def mark(self, start, end, span=None):
+        """Notes a change to the block parsed from text[start:end].
+
+        span is that block's SourceSpan, if it has one.
+        """
+        if span is not None:
+            self.marked.add(span)
+        dirty = self.dirty
+        lo = bisect.bisect_left(dirty, (start,))
+        if lo and dirty[lo - 1][1] >= start:
+            lo -= 1
+        hi = lo
+        while hi < len(dirty) and dirty[hi][0] <= end:
+            start = min(start, dirty[hi][0])
+            end = max(end, dirty[hi][1])
+            hi += 1
+        dirty[lo:hi] = [(start, end)]
+        self.changes += 1
+
+    def changed(self, start, end):
+        """Whether any of text[start:end] has changed."""
+        i = bisect.bisect_left(self.dirty, (end,))
+        return i > 0 and self.dirty[i - 1][1] > start
+
+    def cut(self, span):
+        """Notes that the block parsed from span was taken out of the tree."""
+        bisect.insort(self.removed, (span.start, span.end))
+        self.mark(span.start, span.end)
+
+    def copy(self, start, end, parts):
+        """Appends text[start:end] to parts, without the blocks cut from it."""
+        removed = self.removed
+        i = bisect.bisect_left(removed, (start,))
+        while i < len(removed) and removed[i][0] < end:
+            cut_start, cut_end = removed[i]
+            if cut_start >= start:  # else inside a cut already made
+                parts.append(self.text[start:cut_start])
+                start = cut_end
+            i += 1
+        parts.append(self.text[start:end])
+
+
+class SourceSpan(object):
+    """Where a block was parsed from: source.text[start:end].
+
+    length is the number of sub_blocks the block had when it was closed,
+    so that appending to sub_blocks by hand is noticed.
+    """
+    __slots__ = ("source", "start", "end", "length")
+
+    def __init__(self, source, start, end=None, length=None):
+        self.source = source
+        self.start = start
+        self.end = end
+        self.length = length
+
+    def close(self, block, end):
+        self.end = end
+        self.length = len(block.sub_blocks or ())
+
+    def text_of(self, block):
+        """The source text of block, or None if it may have changed."""
+        text = self.source.text
+        if text is None or self.end is None:
+            return None
+        if len(block.sub_blocks or ()) != self.length:
+            return None
+        if self.source.changed(self.start, self.end):
+            return None
+        return text[self.start:self.end]
+
+    def splice(self, block):
+        """Parts for block when only blocks inside it changed, or None.
+
+        The source text is copied around the sub_blocks that changed, which
+        are rendered again, and without those removed (see ParseBlock.remove);
+        the rest of block is written as it was parsed.
+        """
+        source = self.source
+        text = source.text
+        if (text is None or self.end is None or self in source.marked
+                or len(block.sub_blocks or ()) != self.length):
+            return None
+        parts = []
+        pos = self.start
+        for child in block.sub_blocks:
+            span = getattr(child, "span", None)
+            if span is None or span.end is None or not source.changed(span.start, span.end):
+                continue
+            source.copy(pos, span.start, parts)
+            parts.append(child)
+            pos = span.end
+        source.copy(pos, self.end, parts)
+        return parts
+
+
+class _Capture(object):
+    """Returned by a _*_parts method to see its rendered parts first.
+
+    The parts are rendered, then finish() gets their joined output (and the
+    render arguments) and returns what to render instead.
+    """
+    __slots__ = ("parts", "finish", "mark")
+
+    def __init__(self, parts, finish):
+        self.parts = parts
+        self.finish = finish
+        self.mark = None
+
+
+class _AsWiki(object):
+    """Parts, in what a _*_parts method returns, to render as wiki text.
+
+    Only for renderers that take no arguments, as _wiki_parts does not.
+    """
+    __slots__ = ("parts",)
+
+    def __init__(self, parts):
+        self.parts = parts
+
+
+def _render(parts, method, *args):
+    """Renders parts without recursion, into one list joined at the end.
+
+    Strings are written as they are; blocks are replaced by what their
+    method (one of the _*_parts methods, called with args) returns: a
+    string, a list of strings and blocks, or a _Capture.  Blocks are asked
+    in document order, so LatexRenderState changes in the right places.
+    The parts of an _AsWiki are rendered with _wiki_parts instead.
+
+    Wiki text for blocks that have not changed since parsing is copied
+    from the source instead, and blocks with changes only inside them are
+    copied around those (see SourceSpan.splice).
+    """
+    out = []
+    write = out.append
+    stack = [(iter(parts), method)]  # iterators over the parts still to write
+    while stack:
+        items, method = stack[-1]
+        plain = _PLAIN_TEXT_BLOCKS.get(method, ())
+        copy = method == "_wiki_parts"
+        for item in items:
+            cls = type(item)
+            if cls is str:
+                write(item)
+                continue
+            if cls in plain:  # the most common case, without a call
+                write(item.text)
+                continue
+            if cls is _AsWiki:
+                stack.append((iter(item.parts), "_wiki_parts"))
+                break
+            if copy and item.span is not None:
+                text = item.span.text_of(item)
+                if text is not None:
+                    write(text)
+                    continue
+                spliced = item.span.splice(item)
+                if spliced is not None:
+                    stack.append((iter(spliced), method))
+                    break
+            if cls is _Capture:  # its parts are done
+                result = item.finish("".join(out[item.mark:]), *args)
+                del out[item.mark:]
+            else:
+                result = getattr(item, method)(*args)
+            if type(result) is str:
+                write(result)
+                continue
+            if type(result) is _Capture:
+                result.mark = len(out)
+                stack.append((iter((result,)), method))
+                result = result.parts
+            stack.append((iter(result), method))
+            break
+        else:
+            stack.pop()
+    return "".join(out)
+
+
 class ParseBlock(object):
-    def __init__(self, sub_blocks=None, short=False, tokenizer=None):
+    """Base of all blocks.
+
+    Blocks use __slots__ to keep parse trees small: most tokens become a
+    block of their own.  Leaf blocks have no sub_blocks and are never open,
+    which these class attributes provide without a slot.
+    """
+    __slots__ = ()
+    sub_blocks = None
+    is_open = False
+    span = None
+
+    def __init__(self, sub_blocks=None):
         if sub_blocks:
             self.sub_blocks = sub_blocks
         else:
             self.sub_blocks = []
-        if tokenizer:
-            self.tokenizer = tokenizer
         self.is_open = False
-        self.short = short
+        self.span = None
+
+    def mark_changed(self):
+        """Notes a change to this block, made after parsing.
+
+        Cached lookups in the document the block was parsed into start over,
+        and wiki() renders the block again rather than copying its source
+        text.  Changes made by hand, other than appending to sub_blocks,
+        should call this.
+        """
+        span = self.span
+        if span is not None:
+            end = span.end if span.end is not None else span.start + 1
+            span.source.mark(span.start, end, span)
+
+    def iter_weighted_links(self):
+        """Yields (anchor, weight) for every link, in order.
+
+        Links count half inside each reference or template around them.
+        """
+        stack = [(self, 1)]
+        while stack:
+            block, weight = stack.pop()
+            if isinstance(block, LinkBlock):
+                yield (block.anchor(), weight)
+                continue
+            if block.sub_blocks:
+                # Note: Most refblocks are in {{cite}}
+                if isinstance(block, (ReferenceBlock, TemplateBlock)):
+                    weight = weight / 2
+                stack.extend((x, weight) for x in reversed(block.sub_blocks)
+                             if isinstance(x, ParseBlock))
 
     def weighted_links(self, subcall=False):
-        if isinstance(self, LinkBlock):
-            return [(self.anchor(), 1)]
-        if hasattr(self, "sub_blocks") and self.sub_blocks:
-            links = [x.weighted_links(subcall=True) for x in self.sub_blocks
-                     if hasattr(x, "weighted_links")]
-            links = functools.reduce(lambda x,y:x+y, links, [])
-            if isinstance(self, ReferenceBlock):  # Note: Most refblocks are in {{cite}}
-                links = [(x[0], x[1]/2) for x in links]
-            if isinstance(self, TemplateBlock):
-                links = [(x[0], x[1]/2) for x in links]
-            if not subcall:
-                cutoff = int(len(links) / 4)
-                links = ([(x[0], x[1] * 1.5) for x in links[:cutoff] ] + links[cutoff:-cutoff] +
-                         [(x[0], x[1] * 0.7) for x in links[-cutoff:] ])
+        links = list(self.iter_weighted_links())
+        if subcall or isinstance(self, LinkBlock):
             return links
-        return []
+        # The first quarter of the links count more, the last quarter less.
+        cutoff = int(len(links) / 4)
+        return ([(x[0], x[1] * 1.5) for x in links[:cutoff] ] + links[cutoff:-cutoff] +
+                [(x[0], x[1] * 0.7) for x in links[-cutoff:] ])
+
+    def iter_links(self):
+        """Yields the anchor of every link, in order.
+
+        Links inside a link (such as in an image caption) are skipped.
+        """
+        stack = [self]
+        while stack:
+            block = stack.pop()
+            if isinstance(block, LinkBlock):
+                anchor = block.anchor()
+                if anchor != "":
+                    yield anchor
+                    continue
+            if block.sub_blocks:
+                stack.extend(x for x in reversed(block.sub_blocks) if isinstance(x, ParseBlock))
 
     def links(self):
-        if isinstance(self, LinkBlock):
-            if self.anchor() != "":
-                return [self.anchor()]
-        if hasattr(self, "sub_blocks") and self.sub_blocks:
-            links = [x.links() for x in self.sub_blocks if hasattr(x, "links")]
-            return functools.reduce(lambda x,y:x+y, links, [])
-        return []
+        return list(self.iter_links())
+
+    def iter_templates(self):
+        """Yields every template, including nested ones, in order."""
+        stack = [self]
+        while stack:
+            block = stack.pop()
+            if isinstance(block, TemplateBlock):
+                yield block
+            if block.sub_blocks:
+                stack.extend(x for x in reversed(block.sub_blocks) if isinstance(x, ParseBlock))
 
     def has_template_of_kind(self, kind):
         kind = kind[0].upper() + kind[1:]
-        if isinstance(self, TemplateBlock):
-            if self.kind() == kind:
-                return True
-        if hasattr(self, "sub_blocks") and self.sub_blocks:
-            for s in self.sub_blocks:
-                if isinstance(s, ParseBlock) and s.has_template_of_kind(kind):
-                    return True
-        return False
+        return any(t.kind() == kind for t in self.iter_templates())
+
+    def query(self, *queries):
+        """Answers several TreeQuery objects in a single walk of the tree.
+
+        The walk stops early once every query is done, and does not go
+        deeper than any query still needs.  Returns the results, in the same
+        order as the queries.
+        """
+        remaining = len([q for q in queries if not q.done])
+        ancestors = []
+        stack = [(self, 0, queries)]
+        while stack and remaining:
+            block, depth, active = stack.pop()
+            del ancestors[depth:]
+            inside = []
+            for q in active:
+                if q.done:
+                    continue
+                descend = q.visit(block, ancestors)
+                if q.done:
+                    remaining -= 1
+                elif descend is not False and (q.max_depth is None or depth < q.max_depth):
+                    inside.append(q)
+            if inside and block.sub_blocks:
+                ancestors.append(block)
+                stack.extend((x, depth + 1, inside) for x in reversed(block.sub_blocks)
+                             if isinstance(x, ParseBlock))
+        return [q.result for q in queries]
 
     def get_first_template_of_kind(self, kind):
         template_list = self.get_templates_of_kind(kind)
@@ -64,24 +335,32 @@ class ParseBlock(object):
         return template_list[0]
 
     def get_templates_of_kind(self, kind):
-        template_list = []
-        if isinstance(self, TemplateBlock):
-            if self.kind() == kind:
-                template_list.append(self)
-        if hasattr(self, "sub_blocks") and self.sub_blocks:
-            for s in self.sub_blocks:
-                if isinstance(s, ParseBlock):
-                    template_list.extend(s.get_templates_of_kind(kind))
-        return template_list
+        return [t for t in self.iter_templates() if t.kind() == kind]
 
     def remove_templates_of_kind(self, kind):
         if hasattr(self, "sub_blocks") and self.sub_blocks:
             for s in self.sub_blocks[:]:
                 if isinstance(s, TemplateBlock) and s.kind() == kind:
-                    self.sub_blocks.remove(s)
+                    self.remove(s)
                 elif isinstance(s, ParseBlock):
                     s.remove_templates_of_kind(kind)
 
+    def remove(self, block):
+        """Takes block out of sub_blocks.
+
+        If both were parsed from the source, only the removed text is dirty
+        (this block's parents contain it), and wiki() still copies the rest
+        of this block; otherwise this block is marked changed.
+        """
+        self.sub_blocks.remove(block)
+        span = block.span
+        if (span is not None and span.end is not None and self.span is not None
+                and self.span.length is not None):
+            self.span.length -= 1
+            span.source.cut(span)
+        else:
+            self.mark_changed()
+
     def add_block(self, block):
         if self.sub_blocks and self.sub_blocks[-1].is_open:
             return self.sub_blocks[-1].add_block(block)
@@ -93,8 +372,10 @@ class ParseBlock(object):
         # be repeated.  Some amount of detection of hostile tags is necessary.
         # 
         # TLDR: For LaTex, you should uncomment everything.
-        if block == "&nbsp;":
-            self.sub_blocks.append(TextBlock("&nbsp;"))
+        #
+        # Spaces, pipes, newlines, &nbsp; and bold/italic marks use SHARED_BLOCKS.
+        if type(block) is str and block in SHARED_BLOCKS:
+            self.sub_blocks.append(SHARED_BLOCKS[block])
         #elif block in ("<br>", "<br />", "<br/>"):
         #    self.sub_blocks.append(DebugBlock("\n\n"))
         elif isinstance(block, ParseBlock):
@@ -116,16 +397,8 @@ class ParseBlock(object):
         elif block == "{{":
             self.sub_blocks.append(TemplateBlock())
             self.sub_blocks[-1].is_open = True
-        elif block == "'''":
-            self.sub_blocks.append(BoldBlock())
-        elif block == "''":
-            self.sub_blocks.append(ItalicBlock())
-        elif block == "'''''":
-            self.sub_blocks.append(BoldItalicBlock())
         elif block.startswith("=="):
             self.sub_blocks.append(HeadingBlock(block))
-        elif block == " ":  # CLEANUP: make all words textblock
-            self.sub_blocks.append(TextBlock(block))
         else:
             self.sub_blocks.append(DebugBlock(block))
 
@@ -135,33 +408,47 @@ class ParseBlock(object):
         return ''.join([repr(x) for x in self.sub_blocks])
 
     def wiki(self):
-        if hasattr(self, "sub_blocks") and self.sub_blocks:
-            return ''.join([x.wiki() for x in self.sub_blocks])
+        return _render([self], "_wiki_parts")
+
+    def wigfmt(self):
+        return _render([self], "_wigfmt_parts")
+
+    def to_text(self):
+        return _render([self], "_text_parts")
+
+    def latex(self, state=None):
+        if state is None:
+            state = LatexRenderState()
+        return _render([self], "_latex_parts", state)
+
+    # What each renderer writes for a block; see _render().
+
+    def _wiki_parts(self):
+        if self.sub_blocks:
+            return self.sub_blocks
         elif hasattr(self, "text"):
             return self.text
         else:
             print("Possible error, blank section.")
             return ""
 
-    def wigfmt(self):
-        if hasattr(self, "sub_blocks") and self.sub_blocks:
-            return ''.join([x.wigfmt() for x in self.sub_blocks])
+    def _wigfmt_parts(self):
+        if self.sub_blocks:
+            return self.sub_blocks
         else:
-            return self.wiki()
+            return self._wiki_parts()
 
-    def to_text(self):
-        if hasattr(self, "sub_blocks") and self.sub_blocks:
-            return ''.join([x.to_text() for x in self.sub_blocks])
+    def _text_parts(self):
+        if self.sub_blocks:
+            return self.sub_blocks
         elif hasattr(self, "text"):
             return self.text
         print("Error on type ", type(self))
         raise "Unhandled Text"
 
-    def latex(self, state=None):
-        if state is None:
-            state = LatexRenderState()
-        if hasattr(self, "sub_blocks") and self.sub_blocks:
-            return ''.join([x.latex(state) for x in self.sub_blocks])
+    def _latex_parts(self, state):
+        if self.sub_blocks:
+            return self.sub_blocks
         elif hasattr(self, "text"):
             return self.text
         print("Error on type ", type(self))
@@ -169,13 +456,127 @@ class ParseBlock(object):
 
 
 class DocumentBlock(ParseBlock):
-    """Entry point."""
-    pass
+    """Entry point.
+
+    Tokens are added through a stack of the currently open blocks, so each
+    token goes straight to the innermost one instead of walking down from
+    the top of the document.
+
+    Template lookups by kind use an index of every template in the
+    document, built on the first lookup and rebuilt after any change.
+
+    Blocks opened while adding tokens get a SourceSpan, so once the source
+    text is set, wiki() copies whatever has not changed.
+    """
+    __slots__ = ("sub_blocks", "is_open", "span", "short", "tokenizer", "source", "_offset",
+                 "_open_blocks", "_template_index", "_template_index_key")
+
+    def __init__(self, sub_blocks=None, short=False, tokenizer=None):
+        super(DocumentBlock, self).__init__(sub_blocks)
+        if tokenizer:
+            self.tokenizer = tokenizer
+        self.short = short
+        self.source = SourceText()
+        self._offset = 0
+        self._open_blocks = None
+        self._template_index = None
+        self._template_index_key = None
+
+    def set_source(self, text):
+        """Sets the text the tokens added so far came from."""
+        self.source.text = text
+        self._offset = len(text)
+        for block in self._open_stack():  # never closed
+            if block.span is not None:
+                block.span.close(block, len(text))
+        self.span = SourceSpan(self.source, 0)
+        self.span.close(self, len(text))
+
+    def _templates_by_kind(self):
+        key = (self.source.changes, len(self.sub_blocks))
+        if self._template_index is None or self._template_index_key != key:
+            index = {}
+            for template in self.iter_templates():
+                try:
+                    kind = template.kind()
+                except Exception:  # unclosed or empty, so it has no kind
+                    continue
+                index.setdefault(kind, []).append(template)
+            self._template_index = index
+            self._template_index_key = key
+        return self._template_index
+
+    def has_template_of_kind(self, kind):
+        kind = kind[0].upper() + kind[1:]
+        return kind in self._templates_by_kind()
+
+    def get_templates_of_kind(self, kind):
+        return list(self._templates_by_kind().get(kind, []))
+
+    def remove_templates_of_kind(self, kind):
+        # The blocks may have been parsed into another document (as for
+        # get_lede()), or built by hand, so their changes need not reach
+        # this document's source.
+        super().remove_templates_of_kind(kind)
+        self._template_index = None
+
+    def _open_stack(self):
+        stack = self._open_blocks
+        if stack is not None:
+            top = stack[-1]
+            if top is self:
+                linked = True
+            else:
+                linked = top.is_open and self.sub_blocks and self.sub_blocks[-1] is stack[1]
+            if linked and not (top.sub_blocks and top.sub_blocks[-1].is_open):
+                return stack
+        # Missing, or the tree was changed by hand: walk down to rebuild it.
+        stack = [self]
+        while stack[-1].sub_blocks and getattr(stack[-1].sub_blocks[-1], "is_open", False):
+            stack.append(stack[-1].sub_blocks[-1])
+        self._open_blocks = stack
+        return stack
+
+    def add_block(self, block):
+        self._template_index = None
+        stack = self._open_stack()
+        start = self._offset
+        if type(block) is str:
+            self._offset += len(block)
+        else:
+            self._offset += len(block.text)
+        if type(block) is str and block in ("\n\n", "</ref>"):
+            # Links and references look for these before passing a token
+            # on, so the outermost open one takes it.
+            closer = LinkBlock if block == "\n\n" else ReferenceBlock
+            for depth in range(1, len(stack)):
+                if isinstance(stack[depth], closer):
+                    stack[depth].add_block(block)
+                    for closed in stack[depth:]:
+                        if closed.span is not None:
+                            closed.span.close(closed, self._offset)
+                    del stack[depth:]
+                    return
+        innermost = stack[-1]
+        if innermost is self:
+            super().add_block(block)
+        else:
+            innermost.add_block(block)
+            if not innermost.is_open:
+                if innermost.span is not None:
+                    innermost.span.close(innermost, self._offset)
+                stack.pop()
+                return
+        if innermost.sub_blocks and innermost.sub_blocks[-1].is_open:
+            opened = innermost.sub_blocks[-1]
+            opened.span = SourceSpan(self.source, start)
+            stack.append(opened)
 
 class DebugBlock(ParseBlock):
+    __slots__ = ("text",)
+
     def __init__(self, text):
         self.text = text
-        self.is_open = False
 
     def __repr__(self):
         return self.text
@@ -185,10 +586,10 @@ class DebugBlock(ParseBlock):
             return True
         return False
 
-    def to_text(self):
+    def _text_parts(self):
         return self.text
 
-    def latex(self, state):
+    def _latex_parts(self, state):
         if self.text == "&":
             return "\\&"
         if self.text == "#":
@@ -214,10 +615,10 @@ class DebugBlock(ParseBlock):
 
 
 class TextBlock(ParseBlock):
+    __slots__ = ("text",)
+
     def __init__(self, text):
         self.text = text
-        self.is_open = False
-        self.sub_blocks = None
 
     def __repr__(self):
         return self.text
@@ -227,10 +628,10 @@ class TextBlock(ParseBlock):
             return True
         return False
 
-    def to_text(self):
+    def _text_parts(self):
         return self.text
 
-    def latex(self, state):
+    def _latex_parts(self, state):
         if self.text == "&ndash;" or self.text == "&mdash;" or self.text == "&minus;":
             return "-"
         if self.text == "&sdot;":
@@ -250,20 +651,21 @@ class TextBlock(ParseBlock):
 
 
 class HTMLTagBlock(ParseBlock):
+    __slots__ = ("text",)
+
     def __init__(self, text):
         self.text = text
-        self.is_open = False
 
     def __repr__(self):
         return self.text
-    def wiki(self):
+    def _wiki_parts(self):
         return self.text
-    def wigfmt(self):
+    def _wigfmt_parts(self):
         return self.text
-    def to_text(self):
+    def _text_parts(self):
         return self.text
 
-    def latex(self, state):
+    def _latex_parts(self, state):
         if self.text == "<sub>":
             return "\\textsubscript{"
         elif self.text == "</sub>":
@@ -285,12 +687,15 @@ class HTMLTagBlock(ParseBlock):
 
 class WikiBlock(ParseBlock):
     """Only for documenting inheritence."""
-    pass
+    __slots__ = ("sub_blocks", "is_open", "span")
 
 class HeadingBlock(WikiBlock):
+    __slots__ = ("level",)
+
     def __init__(self, block):
         self.sub_blocks = []
         self.is_open = True
+        self.span = None
         self.level = len(block)
 
     def add_block(self, block):
@@ -303,20 +708,17 @@ class HeadingBlock(WikiBlock):
         else:
             super().add_block(block)
 
-    def wiki(self):
-        tag = "=" * self.level
-        return tag + ''.join([x.wiki() for x in self.sub_blocks]) + tag
-
-    def wigfmt(self):
+    def _wiki_parts(self):
         tag = "=" * self.level
-        return tag + ''.join([x.wigfmt() for x in self.sub_blocks]) + tag
+        return [tag] + self.sub_blocks + [tag]
 
-    def to_text(self):
-        tag = "=" * self.level
-        return tag + ''.join([x.to_text() for x in self.sub_blocks]) + tag
+    _wigfmt_parts = _wiki_parts
+    _text_parts = _wiki_parts
 
 
 class LinkBlock(WikiBlock):
+    __slots__ = ("malformed",)
+
     def add_block(self, block):
         if block == "\n\n":  # Mal-formed; close block at paragraph break
             self.is_open = False
@@ -355,22 +757,18 @@ class LinkBlock(WikiBlock):
         linktext = "".join([str(x) for x in self.sub_blocks[idx+1:]])
         return linktext
 
-    def wiki(self):
-        return "[[" + ''.join([x.wiki() for x in self.sub_blocks]) + "]]"
+    def _wiki_parts(self):
+        return ["[["] + self.sub_blocks + ["]]"]
 
-    def wigfmt(self):
-        return "[[" + ''.join([x.wigfmt() for x in self.sub_blocks]) + "]]"
+    _wigfmt_parts = _wiki_parts
 
-    def to_text(self):
+    def _text_parts(self):
         if str(self.sub_blocks[0]).startswith("File:"):
             return ""
         if str(self.sub_blocks[0]).startswith("Image:"):
             return ""
         elif len(self.sub_blocks) == 1:
-            if isinstance(self.sub_blocks[0], ParseBlock):
-                return self.sub_blocks[0].to_text()
-            else:
-                return self.sub_blocks[0]
+            return self.sub_blocks[:1]
         else:
             if "|" not in self.sub_blocks:
                 text = "".join([str(x) for x in self.sub_blocks])
@@ -379,19 +777,17 @@ class LinkBlock(WikiBlock):
             linktext = "".join([str(x) for x in self.sub_blocks[idx+1:]])
             return linktext
 
-    def latex(self, state):
+    def _latex_parts(self, state):
         if str(self.sub_blocks[0]).startswith("File:"):
             return ""
         if str(self.sub_blocks[0]).startswith("Image:"):
             return ""
-        if len(self.sub_blocks) == 1:
-            linktext = strtex(self.sub_blocks[0], state)
-        elif "|" not in self.sub_blocks:
-            linktext = "".join([strtex(x, state) for x in self.sub_blocks])
+        if "|" not in self.sub_blocks:
+            linktext = self.sub_blocks
         else:
             idx = self.sub_blocks.index("|")
-            linktext = "".join([strtex(x, state) for x in self.sub_blocks[idx+1:]])
-        return "\emph{" + linktext + "}"
+            linktext = self.sub_blocks[idx+1:]
+        return ["\emph{"] + linktext + ["}"]
 
 
 class TemplateBlock(WikiBlock):
@@ -400,14 +796,24 @@ class TemplateBlock(WikiBlock):
     Templates consist of a name, followed by a series of pipe (the "|" character)
     separated arguments.  These are sometimes of the key=value type, and sometimes
     are positional arguments.
+
+    Nothing is parsed when the template closes.  kind() reads only the
+    blocks before the first "|"; the arguments are split on first use, and
+    get_param() keeps the strings it returns until set_param().
     """
+    __slots__ = ("_kind", "_kind_was_lowercase", "_kind_leading_whitespace",
+                 "_kind_trailing_whitespace", "arguments",
+                 "arg_dict", "positional_args", "is_parsed", "rewrite", "_params")
+
     def __init__(self, *args, **kwargs):
         self._kind = None
         self._kind_was_lowercase = False
+        self._kind_leading_whitespace = ""
         self._kind_trailing_whitespace = ""
         self.arguments = []
         self.is_parsed = False
         self.rewrite = False
+        self._params = None
         super(TemplateBlock, self).__init__(*args, **kwargs)
 
     def add_block(self, block):
@@ -422,25 +828,37 @@ class TemplateBlock(WikiBlock):
             return
         else:
             super().add_block(block)
-        if not self.is_open:
-            self.parse()
 
-    def parse(self):
+    def _parse_kind(self):
         if self.is_open:
             raise Exception("Template block incorrectly open.")
+        name = []  # the blocks before the first "|", as the first group in parse()
+        for x in self.sub_blocks:
+            if x == "|":
+                if name:
+                    break
+            else:
+                name.append(x)
 
+        # We upper-case the first letter, keep the rest as written.
+        kind = "".join(x.text if type(x) in (TextBlock, DebugBlock) else x.wiki()
+                       for x in name)
+        self._kind_was_lowercase = kind[0] != kind[0].upper()
+        written = kind.rstrip()
+        self._kind_leading_whitespace = written[:len(written) - len(written.lstrip())]
+        self._kind_trailing_whitespace = kind[len(written):]
+        self._kind = (kind[0].upper() + kind[1:]).strip()
+
+    def parse(self):
+        if self.is_parsed or self._kind is not None:  # again, after sub_blocks were changed
+            self.mark_changed()
+        self._parse()
+
+    def _parse(self):
+        self._parse_kind()
         # Split the block by "|"
         blocks = [list(g) for k, g in itertools.groupby(self.sub_blocks, lambda x: x=="|")
                   if not k]
-
-        # We upper-case the first letter, keep the rest as written.
-        self._kind = "".join(x.wiki() for x in blocks[0])
-        if self._kind[0] != self._kind[0].upper():
-            self._kind_was_lowercase = True
-        if len(self._kind) != len(self._kind.rstrip()):
-            self._kind_trailing_whitespace = self._kind[len(self._kind.rstrip()):]
-        self._kind = self._kind[0].upper() + self._kind[1:]
-        self._kind = self._kind.strip()
         self.arguments = blocks[1:]
         self.arg_dict = {}
         self.positional_args = []
@@ -453,33 +871,46 @@ class TemplateBlock(WikiBlock):
             else:
                 # positional argument
                 self.positional_args.append(x)
+        self._params = {}
         self.is_parsed = True
 
     def has_param(self, key):
         if not self.is_parsed:
-            self.parse()
+            self._parse()
         return key in self.arg_dict
 
     def get_param(self, key):
         if not self.is_parsed:
-            self.parse()
-        return "".join(str(x) for x in self.arg_dict[key])  # or raise KeyError
+            self._parse()
+        value = self._params.get(key)
+        if value is None:
+            value = "".join(str(x) for x in self.arg_dict[key])  # or raise KeyError
+            self._params[key] = value
+        return value
 
     def set_param(self, key, value):
+        if not self.is_parsed:
+            self._parse()
+        self._params.pop(key, None)
         if value is None:
             if key in self.arg_dict:
                 del self.arg_dict[key]
         else:
             self.arg_dict[key] = [TextBlock(value)]
         self.rewrite = True
+        self.mark_changed()
 
     def remove_templates_of_kind(self, kind):
+        if not self.is_parsed:
+            self._parse()
         for k, v in self.arg_dict.items():
             for sub_block in v[:]:
                 if isinstance(sub_block, TemplateBlock):
                     if sub_block.kind() == kind:
                         v.remove(sub_block)
+                        self._params.pop(k, None)
                         self.rewrite = True
+                        self.mark_changed()
                     else:
                         self.rewrite = sub_block.remove_templates_of_kind(kind)
         for block_group in self.positional_args:
@@ -488,6 +919,7 @@ class TemplateBlock(WikiBlock):
                     if sub_block.kind() == kind:
                         block_group.remove(sub_block)
                         self.rewrite = True
+                        self.mark_changed()
                     else:
                         self.rewrite = sub_block.remove_templates_of_kind(kind)
         return self.rewrite
@@ -495,51 +927,53 @@ class TemplateBlock(WikiBlock):
     def sections(self):
         if self.is_parsed:
             return self.arguments
-        self.parse()
+        self._parse()
         return self.arguments
 
     def kind(self):
-        if self.is_parsed:
-            return self._kind
-        self.parse()
+        if self._kind is None:
+            self._parse_kind()
         return self._kind
 
-    def to_text(self):
+    def _text_parts(self):
         if self.rewrite:
             raise Exception("set_param not yet compatible with latex")
-        return "{{" + ''.join([x.to_text() for x in self.sub_blocks]) + "}}"
+        return ["{{"] + self.sub_blocks + ["}}"]
 
-    def wiki(self):
+    def _wiki_parts(self):
         if not self.is_parsed:
-            self.parse()
-        out = "{{"
+            self._parse()
         if self._kind_was_lowercase:
-            out += self._kind[0].lower() + self._kind[1:]
+            kind = self._kind[0].lower() + self._kind[1:]
         else:
-            out += self._kind
-        out += self._kind_trailing_whitespace
+            kind = self._kind
+        out = ["{{", self._kind_leading_whitespace, kind, self._kind_trailing_whitespace]
         if self.rewrite:
             # Use arg_dict
             for key, value in self.arg_dict.items():
-                out += "|" + key + "=" + "".join([x.wiki() for x in value])
+                out.append("|" + key + "=")
+                out.extend(value)
             for block in self.positional_args:
-                out += "|" + "".join([x.wiki() for x in block])
+                out.append("|")
+                out.extend(block)
         else:
-            if self.arguments:
-                out += "|"
-                out += "|".join([''.join([y.wiki() for y in x]) for x in self.arguments])
-        out += "}}"
+            for x in self.arguments:
+                out.append("|")
+                out.extend(x)
+        out.append("}}")
         return out
 
-    def wigfmt(self):
+    def _wigfmt_parts(self):
         if self.rewrite:
             raise Exception("set_param not yet compatible with latex")
-        return "{{" + ''.join([x.wigfmt() for x in self.sub_blocks]) + "}}"
+        return ["{{"] + self.sub_blocks + ["}}"]
 
-    def latex(self, state):
+    def _latex_parts(self, state):
         if self.rewrite:
             raise Exception("set_param not yet compatible with latex")
-        joined_body = "".join([strtex(x, state) for x in self.sub_blocks])
+        return _Capture(self.sub_blocks, self._finish_latex)
+
+    def _finish_latex(self, joined_body, state):
         split_body = joined_body.split("|")
         if self.kind() == "Lang":
             return split_body[2]
@@ -555,53 +989,76 @@ class TemplateBlock(WikiBlock):
             return "as of %s" % split_body[1]
         if self.kind() == "Sc" and len(split_body) == 2:
             return "\textsc{%s}" % split_body[1]
-        return ''.join([x.latex(state) for x in self.sub_blocks])
+        return self.sub_blocks  # rendered again, as the blocks they are
 
 
-class BoldBlock(WikiBlock):
-    def wiki(self):
+class _MarkBlock(WikiBlock):
+    """A bold or italic mark.
+
+    These are shared between trees (see SHARED_BLOCKS), so they have an
+    empty tuple for sub_blocks rather than a list one tree could add to.
+    """
+    __slots__ = ()
+
+    def __init__(self):
+        self.sub_blocks = ()
+        self.is_open = False
+        self.span = None
+
+class BoldBlock(_MarkBlock):
+    __slots__ = ()
+
+    def _wiki_parts(self):
         return "'''"
-    def wigfmt(self):
+    def _wigfmt_parts(self):
         return "'''"
-    def to_text(self):
+    def _text_parts(self):
         return ""
-    def latex(self, state):
+    def _latex_parts(self, state):
         return ""
 
-class ItalicBlock(WikiBlock):
-    def wiki(self):
+class ItalicBlock(_MarkBlock):
+    __slots__ = ()
+
+    def _wiki_parts(self):
         return "''"
-    def wigfmt(self):
+    def _wigfmt_parts(self):
         return "''"
-    def to_text(self):
+    def _text_parts(self):
         return ""
-    def latex(self, state):
+    def _latex_parts(self, state):
         return ""
 
-class BoldItalicBlock(WikiBlock):
-    def wiki(self):
+class BoldItalicBlock(_MarkBlock):
+    __slots__ = ()
+
+    def _wiki_parts(self):
         return "'''''"
-    def wigfmt(self):
+    def _wigfmt_parts(self):
         return "'''''"
-    def to_text(self):
+    def _text_parts(self):
         return ""
-    def latex(self, state):
+    def _latex_parts(self, state):
         return ""
 
 class CommentBlock(ParseBlock):
-    def wiki(self):
+    __slots__ = ("sub_blocks", "is_open", "span")
+
+    def _wiki_parts(self):
         return "".join([str(x) for x in self.sub_blocks])
-    def wigfmt(self):
+    def _wigfmt_parts(self):
         return ""
-    def to_text(self):
+    def _text_parts(self):
         return ""
-    def latex(self, state):
+    def _latex_parts(self, state):
         return ""
     def __repr__(self):
         return "".join(self.sub_blocks)
 
 
 class TableBlock(WikiBlock):
+    __slots__ = ()
+
     def add_block(self, block):
         if self.sub_blocks and isinstance(self.sub_blocks[-1], ParseBlock) and self.sub_blocks[-1].is_open:
             return self.sub_blocks[-1].add_block(block)
@@ -612,15 +1069,17 @@ class TableBlock(WikiBlock):
         else:
             super().add_block(block)
 
-    def wiki(self):
-        return "{|" + ''.join([x.wiki() for x in self.sub_blocks]) + "|}"
+    def _wiki_parts(self):
+        return ["{|"] + self.sub_blocks + ["|}"]
 
-    def wigfmt(self):
-        return "{|" + ''.join([x.wigfmt() for x in self.sub_blocks]) + "|}"
+    _wigfmt_parts = _wiki_parts
 
 
 class ReferenceBlock(WikiBlock):
+    __slots__ = ("details",)
+
     def __init__(self, block):
+        self.span = None
         if block == "<ref>":
             self.is_open = True
             self.sub_blocks = []
@@ -646,30 +1105,138 @@ class ReferenceBlock(WikiBlock):
         else:
             super().add_block(block)
 
-    def to_text(self):
+    def _text_parts(self):
         return ""
 
     def wiki(self, extra_line_breaks=False):
+        if not extra_line_breaks:
+            return super().wiki()
+        return _render(self._reference_parts(True), "_wiki_parts")
+
+    def _reference_parts(self, extra_line_breaks):
         if not self.sub_blocks:  # single-tag
             if not self.details:
-                return "<ref></ref>"  # degenerate case
-            return self.details.wiki()
+                return ["<ref></ref>"]  # degenerate case
+            return [self.details]
         if self.details:
-            open_tag = "<ref " + self.details.wiki() + ">"
+            open_tag = "<ref " + self.details.text + ">"
         else:
             open_tag = "<ref>"
-        body = ''.join([x.wiki() for x in self.sub_blocks])
         if extra_line_breaks:
-            return open_tag + "\n" + body + "\n</ref>"
+            return [open_tag + "\n"] + self.sub_blocks + ["\n</ref>"]
         else:
-            return open_tag + body + "</ref>"
+            return [open_tag] + self.sub_blocks + ["</ref>"]
 
-    def wigfmt(self):
-        return self.wiki(extra_line_breaks=True)
+    def _wiki_parts(self):
+        return self._reference_parts(False)
 
-    def latex(self, state):
+    def _wigfmt_parts(self):
+        # The body is written as wiki text, not wigfmt.
+        return [_AsWiki(self._reference_parts(True))]
+
+    def _latex_parts(self, state):
         return ""
 
+class TreeQuery(object):
+    """A question for ParseBlock.query(), answered during one walk of a tree.
+
+    visit() sees each block, with the list of blocks around it (outermost
+    first, only valid during the call), and sets self.done once self.result
+    is final.  Returning False from visit() skips the blocks inside.
+    """
+    max_depth = None
+
+    def __init__(self):
+        self.done = False
+        self.result = None
+
+    def visit(self, block, ancestors):
+        raise NotImplementedError
+
+
+class FirstTemplateWithParam(TreeQuery):
+    """The first template with the given parameter.
+
+    Only looks inside templates, so with max_depth=2 this finds a talk page
+    banner or a banner inside a banner shell.
+    """
+    def __init__(self, key, max_depth=None):
+        super(FirstTemplateWithParam, self).__init__()
+        self.key = key
+        self.max_depth = max_depth
+
+    def visit(self, block, ancestors):
+        if isinstance(block, TemplateBlock):
+            if block.has_param(self.key):
+                self.result = block
+                self.done = True
+            return
+        return not ancestors  # the top of the tree
+
+
+class TemplatesOfKind(TreeQuery):
+    """Every template of the given kinds, as a dict of kind to templates."""
+    def __init__(self, *kinds):
+        super(TemplatesOfKind, self).__init__()
+        self.result = {kind[0].upper() + kind[1:]: [] for kind in kinds}
+
+    def visit(self, block, ancestors):
+        if isinstance(block, TemplateBlock):
+            try:
+                kind = block.kind()
+            except Exception:  # unclosed or empty, so it has no kind
+                return
+            if kind in self.result:
+                self.result[kind].append(block)
+
+
+class AllLinks(TreeQuery):
+    """The anchor of every link, the same as ParseBlock.links()."""
+    def __init__(self):
+        super(AllLinks, self).__init__()
+        self.result = []
+
+    def visit(self, block, ancestors):
+        if isinstance(block, LinkBlock):
+            anchor = block.anchor()
+            if anchor != "":
+                self.result.append(anchor)
+                return False
+
+
+class FirstInfobox(TreeQuery):
+    """The first infobox (or taxobox and the like) at the top of the tree."""
+    max_depth = 1
+
+    def visit(self, block, ancestors):
+        if isinstance(block, TemplateBlock):
+            kind = block.kind().lower()
+            if kind.startswith("infobox") or kind in ("subspeciesbox", "speciesbox", "taxobox"):
+                self.result = block
+                self.done = True
+
+
+# Blocks that each renderer writes as their text, as _render() knows.
+_PLAIN_TEXT_BLOCKS = {
+    "_wiki_parts": {DebugBlock, TextBlock, HTMLTagBlock},
+    "_wigfmt_parts": {DebugBlock, TextBlock, HTMLTagBlock},
+    "_text_parts": {DebugBlock, TextBlock, HTMLTagBlock},
+}
+
+# Blocks for the most common tokens.  None of these ever change, so every
+# tree shares one instance of each.
+SHARED_BLOCKS = {
+    " ": TextBlock(" "),
+    "&nbsp;": TextBlock("&nbsp;"),
+    "|": DebugBlock("|"),
+    "\n": DebugBlock("\n"),
+    "\n\n": DebugBlock("\n\n"),
+    "": DebugBlock(""),
+    "''": ItalicBlock(),
+    "'''": BoldBlock(),
+    "'''''": BoldItalicBlock(),
+}
+
 def strtex(x, state):
     if hasattr(x, "latex"):
         return x.latex(state)
@@ -0,0 +1,432 @@
+#!/usr/bin/python3
+
+import parse_blocks
+import parser
+import parser_test
+
+import functools
+import glob
+import random
+import unittest
+
+
+def structure(block):
+    """A comparable summary of a parse tree."""
+    children = None
+    if isinstance(getattr(block, "sub_blocks", None), list):
+        children = [structure(x) for x in block.sub_blocks]
+    return (type(block).__name__, getattr(block, "text", None),
+            getattr(block, "is_open", None), children)
+
+
+def recursive_tree(tokens):
+    """Builds a tree the old way, walking down from the top for each token."""
+    document = parse_blocks.DocumentBlock()
+    for token in tokens:
+        parse_blocks.ParseBlock.add_block(document, token)
+    return document
+
+
+def recursive_links(block):
+    """links(), as it was written before iter_links()."""
+    if isinstance(block, parse_blocks.LinkBlock):
+        if block.anchor() != "":
+            return [block.anchor()]
+    if block.sub_blocks:
+        links = [recursive_links(x) for x in block.sub_blocks
+                 if isinstance(x, parse_blocks.ParseBlock)]
+        return functools.reduce(lambda x,y:x+y, links, [])
+    return []
+
+
+def recursive_weighted_links(block, subcall=False):
+    """weighted_links(), as it was written before iter_weighted_links()."""
+    if isinstance(block, parse_blocks.LinkBlock):
+        return [(block.anchor(), 1)]
+    if block.sub_blocks:
+        links = [recursive_weighted_links(x, subcall=True) for x in block.sub_blocks
+                 if isinstance(x, parse_blocks.ParseBlock)]
+        links = functools.reduce(lambda x,y:x+y, links, [])
+        if isinstance(block, (parse_blocks.ReferenceBlock, parse_blocks.TemplateBlock)):
+            links = [(x[0], x[1]/2) for x in links]
+        if not subcall:
+            cutoff = int(len(links) / 4)
+            links = ([(x[0], x[1] * 1.5) for x in links[:cutoff] ] + links[cutoff:-cutoff] +
+                     [(x[0], x[1] * 0.7) for x in links[-cutoff:] ])
+        return links
+    return []
+
+
+class LinksTest(unittest.TestCase):
+    def assertSameLinks(self, text):
+        t = parser.WikiTokenizer("Test", engine="regex")
+        t.tokenize(text)
+        self.assertEqual(recursive_links(t.parsed_data), t.parsed_data.links())
+        self.assertEqual(recursive_weighted_links(t.parsed_data),
+                         t.parsed_data.weighted_links())
+
+    def test_testdata(self):
+        for filename in glob.glob("testdata/*.dat"):
+            with open(filename) as f:
+                self.assertSameLinks(f.read())
+
+    def test_nesting(self):
+        for text in ["[[a]] {{b|[[c]] <ref>[[d]]</ref>}} [[e|[[f]]]] [[|[[g]]]]",
+                     "[[a]] [[b]] [[c]] [[d]] [[e]] [[f]] [[g]] [[h]] [[i]]", "plain"]:
+            self.assertSameLinks(text)
+
+    def test_generated(self):
+        rng = random.Random(5)
+        for _ in range(500):
+            self.assertSameLinks(parser_test.random_text(rng, rng.randint(1, 60)))
+
+
+class TemplateIndexTest(unittest.TestCase):
+    def parse(self, filename):
+        t = parser.WikiTokenizer("Test")
+        with open(filename) as f:
+            t.tokenize(f.read())
+        return t.parsed_data
+
+    def test_same_as_walking(self):
+        for filename in glob.glob("testdata/*.dat"):
+            document = self.parse(filename)
+            kinds = set(t.kind() for t in document.iter_templates())
+            for kind in kinds | {"Nobots", "Missing"}:
+                walked = parse_blocks.ParseBlock.get_templates_of_kind(document, kind)
+                self.assertEqual(walked, document.get_templates_of_kind(kind))
+                self.assertEqual(bool(walked), document.has_template_of_kind(kind))
+
+    def test_lowercase_lookup(self):
+        document = self.parse("testdata/bob_dylan.dat")
+        self.assertTrue(document.has_template_of_kind("vital article"))
+
+    def test_changes(self):
+        document = self.parse("testdata/bob_dylan.dat")
+        self.assertFalse(document.has_template_of_kind("Added"))
+        parent = document.get_first_template_of_kind("Vital article")
+        parent.sub_blocks.append(parse_blocks.TemplateBlock(
+            sub_blocks=[parse_blocks.TextBlock("Added")]))
+        parent.parse()
+        self.assertTrue(document.has_template_of_kind("Added"))
+
+        document.remove_templates_of_kind("Added")
+        self.assertEqual(
+            parse_blocks.ParseBlock.get_templates_of_kind(document, "Added"),
+            document.get_templates_of_kind("Added"))
+        document.sub_blocks.append(parse_blocks.TemplateBlock(
+            sub_blocks=[parse_blocks.TextBlock("Appended")]))
+        self.assertTrue(document.has_template_of_kind("Appended"))
+
+    def test_changes_per_document(self):
+        document = self.parse("testdata/bob_dylan.dat")
+        other = self.parse("testdata/bob_dylan.dat")
+        index = other._templates_by_kind()
+        document.get_first_template_of_kind("Vital article").set_param("class", "B")
+        self.assertEqual(1, document.source.changes)
+        self.assertIs(index, other._templates_by_kind())
+        self.assertIsNot(index, document._templates_by_kind())
+
+    def test_removed_from_lede(self):
+        t = parser.WikiTokenizer("Test", engine="regex")
+        t.tokenize("[[a|{{Foo}}]] text\n== Heading ==\n")
+        lede = parser.get_lede(t)
+        self.assertTrue(lede.has_template_of_kind("Foo"))
+        lede.remove_templates_of_kind("Foo")
+        self.assertFalse(lede.has_template_of_kind("Foo"))
+
+    def test_removed_by_hand(self):
+        inner = parse_blocks.TemplateBlock(sub_blocks=[parse_blocks.TextBlock("Foo")])
+        outer = parse_blocks.ReferenceBlock("<ref>")
+        outer.is_open = False
+        outer.sub_blocks.append(inner)
+        document = parse_blocks.DocumentBlock([outer])
+        self.assertTrue(document.has_template_of_kind("Foo"))
+        document.remove_templates_of_kind("Foo")
+        self.assertFalse(document.has_template_of_kind("Foo"))
+
+
+class QueryTest(unittest.TestCase):
+    def parse(self, filename):
+        t = parser.WikiTokenizer("Test")
+        with open(filename) as f:
+            t.tokenize(f.read())
+        return t.parsed_data
+
+    def test_one_walk_for_all(self):
+        for filename in glob.glob("testdata/*.dat"):
+            document = self.parse(filename)
+            templates = parse_blocks.TemplatesOfKind("Vital article", "nobots", "Bots")
+            links = parse_blocks.AllLinks()
+            document.query(templates, links)
+            self.assertEqual(recursive_links(document), links.result)
+            self.assertEqual(["Vital article", "Nobots", "Bots"], list(templates.result))
+            for kind, found in templates.result.items():
+                self.assertEqual(document.get_templates_of_kind(kind), found)
+
+    def test_first_template_with_param(self):
+        document = self.parse("testdata/bob_dylan.dat")
+        template, = document.query(parse_blocks.FirstTemplateWithParam("class", max_depth=2))
+        self.assertEqual("FA", template.get_param("class").strip())
+        # The banner is inside a banner shell, so depth 1 is not enough.
+        self.assertEqual([None], document.query(
+            parse_blocks.FirstTemplateWithParam("class", max_depth=1)))
+
+    def test_early_exit(self):
+        document = self.parse("testdata/bob_dylan.dat")
+        visited = []
+        class Counting(parse_blocks.FirstTemplateWithParam):
+            def visit(self, block, ancestors):
+                visited.append(block)
+                return super(Counting, self).visit(block, ancestors)
+        class Everything(parse_blocks.TreeQuery):
+            def visit(self, block, ancestors):
+                visited.append(block)
+        document.query(Counting("class"))
+        found = len(visited)
+        visited[:] = []
+        document.query(Everything())
+        self.assertLess(found, len(visited) / 2)
+
+    def test_infobox(self):
+        document = parse_blocks.DocumentBlock()
+        for token in ["{{", "Short description", "}}", "{{", "infobox person", "|",
+                      "name", "=", "X", "}}", "{{", "Infobox", "}}"]:
+            document.add_block(token)
+        infobox, = document.query(parse_blocks.FirstInfobox())
+        self.assertEqual("Infobox person", infobox.kind())
+
+    def test_ancestors(self):
+        document = self.parse("testdata/economics.dat")
+        seen = []
+        class Parents(parse_blocks.TreeQuery):
+            def visit(self, block, ancestors):
+                seen.append((block, list(ancestors)))
+        document.query(Parents())
+        for block, ancestors in seen:
+            self.assertIs(document, (ancestors or [block])[0])
+            if ancestors:
+                self.assertTrue(any(x is block for x in ancestors[-1].sub_blocks))
+
+
+class RenderTest(unittest.TestCase):
+    def parse(self, text):
+        t = parser.WikiTokenizer("Test", engine="regex")
+        t.tokenize(text)
+        return t.parsed_data
+
+    def test_deep_nesting(self):
+        text = "{{a|" * 5000 + "<ref>[[b]]</ref>" + "}}" * 5000
+        document = self.parse(text)
+        self.assertEqual(text, document.wiki())
+        self.assertEqual(text, document.wigfmt().replace("\n", ""))
+        self.assertEqual(text.replace("<ref>[[b]]</ref>", ""), document.to_text())
+
+    def test_wigfmt_reference(self):
+        text = "<ref>x " + "{{a|" * 100 + "[[b]]" + "}}" * 100 + "</ref> <ref name=c/>"
+        document = self.parse(text)
+        wiki = document.sub_blocks[0].wiki()
+        self.assertEqual("<ref>\n" + wiki[5:-6] + "\n</ref> <ref name=c/>", document.wigfmt())
+
+    def test_latex(self):
+        document = self.parse("<math>a_b</math> {{Convert|2|to|4|km}} "
+                              "{{Foo|<math>x</math>}}_[[a|b_c]]")
+        self.assertEqual("$a_b$ 2-4 km Foo|$x$\\_\\emph{b\\_c}", document.latex())
+
+    def test_rewrite(self):
+        document = self.parse("{{a|b=c|d}} {{e}}")
+        self.assertTrue(document.sub_blocks[0].has_param("b"))
+        document.sub_blocks[0].set_param("b", "x")
+        document.sub_blocks[0].set_param("f", "y")
+        self.assertEqual("{{a|b=x|f=y|d}} {{e}}", document.wiki())
+        with self.assertRaises(Exception):
+            document.to_text()
+
+
+class SourceSpanTest(unittest.TestCase):
+    def parse(self, text):
+        t = parser.WikiTokenizer("Test", engine="regex")
+        t.tokenize(text)
+        return t.parsed_data
+
+    def assertSameAsRendering(self, document):
+        copied = document.wiki()
+        text, document.source.text = document.source.text, None
+        try:
+            self.assertEqual(document.wiki(), copied)
+        finally:
+            document.source.text = text
+
+    def test_round_trip(self):
+        rng = random.Random(4)
+        texts = ["{{ a |b}}", "[[a\n\nb", "<ref>[[a</ref>", "{{a|{{b}}"]
+        texts += [parser_test.random_text(rng, rng.randint(1, 60)) for _ in range(2000)]
+        for text in texts:
+            document = self.parse(text)
+            self.assertEqual(text, document.wiki(), repr(text))
+            for block in document.sub_blocks:
+                if block.span is not None:
+                    self.assertEqual(text[block.span.start:block.span.end], block.wiki())
+
+    def test_set_param(self):
+        for filename in glob.glob("testdata/*.dat"):
+            with open(filename) as f:
+                document = self.parse(f.read())
+            for template in document.iter_templates():
+                if template.has_param("class"):
+                    template.set_param("class", "B")
+            self.assertSameAsRendering(document)
+
+    def test_changed_by_hand(self):
+        with open("testdata/bob_dylan.dat") as f:
+            document = self.parse(f.read())
+        banner = document.get_first_template_of_kind("WikiProjectBannerShell")
+        banner.sub_blocks.append(parse_blocks.TextBlock("inner"))
+        banner.parse()
+        document.sub_blocks.append(parse_blocks.TextBlock("outer"))
+        self.assertIn("inner}}", document.wiki())
+        self.assertTrue(document.wiki().endswith("outer"))
+        self.assertSameAsRendering(document)
+
+        document.remove_templates_of_kind("Talk header")
+        self.assertNotIn("{{Talk header}}", document.wiki())
+        self.assertSameAsRendering(document)
+
+    def test_streamed(self):
+        with open("testdata/economics.dat", "rb") as f:
+            text = f.read()
+        t = parser.WikiTokenizer("Economics", engine="regex")
+        t.tokenize([text[i:i + 100] for i in range(0, len(text), 100)], keep_tokens=False)
+        self.assertEqual(text.decode("utf-8"), t.parsed_data.source.text)
+
+        t.tokenize([text[i:i + 100] for i in range(0, len(text), 100)], keep_tokens=False,
+                   keep_source=False)
+        self.assertIsNone(t.parsed_data.source.text)
+        self.assertEqual(text.decode("utf-8"), t.parsed_data.wiki())
+
+    def test_removal_marks_only_the_template(self):
+        with open("testdata/bob_dylan.dat") as f:
+            text = f.read()
+        document = self.parse(text)
+        removed = document.get_first_template_of_kind("Talk header")
+        document.remove_templates_of_kind("Talk header")
+        self.assertEqual([(removed.span.start, removed.span.end)], document.source.dirty)
+        self.assertEqual(text.replace("{{Talk header}}", "", 1), document.wiki())
+        self.assertSameAsRendering(document)
+
+    def test_changes_inside_copied_around(self):
+        text = ("{{ WikiProject banner shell |1=\n{{ Vital article |level=4 | class=B}}\n}}\n"
+                "[[Foo {{Vital article|level=5}}\n\nbar")
+        document = self.parse(text)
+        for template in document.get_templates_of_kind("Vital article"):
+            template.set_param("level", "3")
+        self.assertEqual(text.replace("{{ Vital article |level=4 | class=B}}",
+                                      "{{ Vital article |level=3|class=B}}")
+                             .replace("level=5", "level=3"), document.wiki())
+
+        document = self.parse(text)
+        document.remove_templates_of_kind("Vital article")
+        self.assertEqual("{{ WikiProject banner shell |1=\n\n}}\n[[Foo \n\nbar", document.wiki())
+
+    def test_dirty_merged(self):
+        source = parse_blocks.SourceText("x" * 100)
+        for start, end in [(10, 20), (30, 40), (50, 60), (15, 35), (60, 70), (80, 90)]:
+            source.mark(start, end)
+        self.assertEqual([(10, 40), (50, 70), (80, 90)], source.dirty)
+        self.assertEqual(6, source.changes)
+        for start, end in [(0, 10), (40, 50), (70, 80), (90, 100)]:
+            self.assertFalse(source.changed(start, end))
+        for start, end in [(0, 11), (39, 50), (45, 51), (0, 100), (85, 86)]:
+            self.assertTrue(source.changed(start, end))
+
+    def test_shared_marks(self):
+        text = "''a'' '''b''' '''''c'''''"
+        document = self.parse(text)
+        for mark in ("''", "'''", "'''''"):
+            block = parse_blocks.SHARED_BLOCKS[mark]
+            self.assertIn(block, document.sub_blocks)
+            self.assertEqual((), block.sub_blocks)
+        self.assertEqual(text, document.wiki())
+
+
+class LazyTemplateTest(unittest.TestCase):
+    def templates(self):
+        rng = random.Random(6)
+        texts = [parser_test.random_text(rng, rng.randint(1, 60)) for _ in range(2000)]
+        for filename in glob.glob("testdata/*.dat"):
+            with open(filename) as f:
+                texts.append(f.read())
+        texts += ["{{ lower |a=b}}", "{{|x}}", "{{a {{b}} |c}}"]
+        for text in texts:
+            t = parser.WikiTokenizer("Test", engine="regex")
+            t.tokenize(text)
+            for template in t.parsed_data.iter_templates():
+                yield template
+
+    def test_kind(self):
+        for template in self.templates():
+            copy = parse_blocks.TemplateBlock(sub_blocks=list(template.sub_blocks))
+            copy.is_open = template.is_open
+            try:
+                copy.parse()
+            except Exception as e:
+                with self.assertRaises(type(e)):
+                    template.kind()
+                continue
+            self.assertEqual(copy.kind(), template.kind())
+            self.assertFalse(template.is_parsed)
+
+    def test_index_does_not_parse(self):
+        with open("testdata/bob_dylan.dat") as f:
+            t = parser.WikiTokenizer("Bob Dylan")
+            t.tokenize(f.read())
+        self.assertTrue(t.parsed_data.has_template_of_kind("Article history"))
+        self.assertFalse(any(x.is_parsed for x in t.parsed_data.iter_templates()))
+
+    def test_get_param(self):
+        t = parser.WikiTokenizer("Test")
+        t.tokenize("{{a|b=c}}")
+        template = t.parsed_data.sub_blocks[0]
+        template.set_param("d", "e")
+        self.assertEqual("c", template.get_param("b"))
+        template.set_param("b", "f")
+        self.assertEqual("f", template.get_param("b"))
+        self.assertEqual("{{a|b=f|d=e}}", t.parsed_data.wiki())
+
+
+class OpenBlockStackTest(unittest.TestCase):
+    def assertSameTree(self, text):
+        t = parser.WikiTokenizer("Test", engine="regex")
+        t.tokenize(text)
+        expected = recursive_tree(t.tokens)
+        self.assertEqual(structure(expected), structure(t.parsed_data), repr(text))
+
+    def test_testdata(self):
+        for filename in glob.glob("testdata/*.dat"):
+            with open(filename) as f:
+                self.assertSameTree(f.read())
+
+    def test_nesting(self):
+        for text in ["{{a|[[b|{{c|d}}]]}}", "[[a {{b\n\nc}} d", "<ref>[[a</ref> b",
+                     "<ref name=x>{{a|<ref>b</ref>}}</ref>", "== a [[b]] ==\nc",
+                     "{|\n| {{a}} |}", "{{a||b}}"]:
+            self.assertSameTree(text)
+
+    def test_generated(self):
+        rng = random.Random(3)
+        for _ in range(2000):
+            self.assertSameTree(parser_test.random_text(rng, rng.randint(1, 60)))
+
+    def test_changed_by_hand(self):
+        document = parse_blocks.DocumentBlock()
+        for token in ["{{", "a", "}}"]:
+            document.add_block(token)
+        document.sub_blocks.append(parse_blocks.TemplateBlock())
+        document.sub_blocks[-1].is_open = True
+        for token in ["b", "}}", "c"]:
+            document.add_block(token)
+        self.assertEqual("{{a}}{{b}}c", document.wiki())
+
+
+if __name__ == '__main__':
+    unittest.main()
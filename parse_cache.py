@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+#
+# A binary format for parse trees, and an on-disk cache of parsed pages
+# so that the same list and talk pages are not tokenized on every run.
+
+from parse_blocks import *
+import disk_cache
+import metrics
+import parser
+
+import hashlib
+import marshal
+import os
+import sys
+import threading
+import zlib
+
+FORMAT_VERSION = 1
+# marshal's format belongs to the interpreter, so it is part of the
+# header and of every cache key.
+_FORMAT = (FORMAT_VERSION,) + tuple(sys.version_info[:2])
+CACHE_DIR = os.path.join(disk_cache.CACHE_ROOT, "parse")
+MAX_CACHE_BYTES = 256 << 20
+
+# The tree is a flat list of records.  A str is a TextBlock, a negative
+# number -n is the shared block _SHARED_ORDER[n - 1], and other records
+# start with one of these codes.  Containers are followed by their
+# children and then _END.  The order of these is part of the format.
+_END, _DEBUG, _TAG, _COMMENT = range(4)
+_CONTAINERS = [HeadingBlock, LinkBlock, TemplateBlock, TableBlock, ReferenceBlock]
+_MARKS = [BoldBlock, ItalicBlock, BoldItalicBlock]
+_CONTAINER_CODE = {cls: 4 + i for i, cls in enumerate(_CONTAINERS)}
+_MARK_CODE = {cls: 4 + len(_CONTAINERS) + i for i, cls in enumerate(_MARKS)}
+_SHARED_ORDER = (" ", "&nbsp;", "|", "\n", "\n\n", "", "''", "'''", "'''''")
+_SHARED_CODE = {id(SHARED_BLOCKS[key]): -1 - i for i, key in enumerate(_SHARED_ORDER)}
+
+_OPEN, _MALFORMED, _NO_CHILDREN = 1, 2, 4
+
+LOAD_SECONDS = metrics.summary("wiki_tree_load_seconds", "Time loading cached parse trees")
+
+
+def dump_tree(document):
+    """Serializes a parsed DocumentBlock (and its source text) to bytes.
+
+    The tree is written as a flat list in document order, so deep pages do
+    not recurse.  Trees changed since parsing (through mark_changed, or
+    by adding sub_blocks) are refused, as their source text no longer
+    matches.
+    """
+    if document.source.changes:
+        raise ValueError("Can't store a tree changed since parsing.")
+    records = []
+    write = records.append
+    stack = list(reversed(document.sub_blocks))
+    while stack:
+        block = stack.pop()
+        cls = type(block)
+        if cls is TextBlock:
+            shared = _SHARED_CODE.get(id(block))
+            write(block.text if shared is None else shared)
+        elif cls is int:  # the end of a container
+            write(block)
+        elif cls is DebugBlock:
+            shared = _SHARED_CODE.get(id(block))
+            if shared is None:
+                records.extend((_DEBUG, block.text))
+            else:
+                write(shared)
+        elif cls is HTMLTagBlock:
+            records.extend((_TAG, block.text))
+        elif cls is CommentBlock:
+            records.extend((_COMMENT, block.sub_blocks))
+        elif cls in _MARK_CODE:
+            shared = _SHARED_CODE.get(id(block))
+            write(_MARK_CODE[cls] if shared is None else shared)
+        elif cls in _CONTAINER_CODE:
+            if cls is TemplateBlock and block.rewrite:
+                raise ValueError("Can't store a template changed with set_param.")
+            flags = _OPEN if block.is_open else 0
+            if cls is LinkBlock and getattr(block, "malformed", False):
+                flags |= _MALFORMED
+            if block.sub_blocks is None:
+                flags |= _NO_CHILDREN
+            if cls is HeadingBlock:
+                extra = block.level
+            elif cls is ReferenceBlock:
+                extra = block.details.text if block.details else None
+            else:
+                extra = None
+            span = block.span
+            if span is None or span.end is None:
+                records.extend((_CONTAINER_CODE[cls], flags, extra, -1, -1))
+            else:
+                if span.length != len(block.sub_blocks or ()):
+                    raise ValueError("Can't store a tree changed since parsing.")
+                records.extend((_CONTAINER_CODE[cls], flags, extra, span.start, span.end))
+            if block.sub_blocks is not None:
+                stack.append(_END)
+                stack.extend(reversed(block.sub_blocks))
+        else:
+            raise ValueError("Can't store block of type %s" % cls.__name__)
+    source = document.source.text
+    data = (_FORMAT, source, document.short, records)
+    return zlib.compress(marshal.dumps(data))
+
+
+def _container(code, flags, extra):
+    cls = _CONTAINERS[code - 4]
+    if cls is HeadingBlock:
+        block = HeadingBlock("=" * extra)
+    elif cls is ReferenceBlock:
+        block = ReferenceBlock("<ref>")
+        block.details = None if extra is None else TextBlock(extra)
+    else:
+        block = cls()
+    if flags & _MALFORMED:
+        block.malformed = True
+    if flags & _NO_CHILDREN:
+        block.sub_blocks = None
+    block.is_open = bool(flags & _OPEN)
+    return block
+
+
+def load_tree(data):
+    """The DocumentBlock that dump_tree() wrote to data."""
+    version, source, short, records = marshal.loads(zlib.decompress(data))
+    if version != _FORMAT:
+        raise ValueError("Parse tree format %s, expected %s" % (version, _FORMAT))
+    document = DocumentBlock(short=short)
+    shared = [None] + [SHARED_BLOCKS[key] for key in reversed(_SHARED_ORDER)]
+    parents = []  # the containers whose children are being read
+    append = document.sub_blocks.append
+    it = iter(records)
+    for x in it:
+        if type(x) is str:
+            append(TextBlock(x))
+        elif x < 0:
+            append(shared[x])
+        elif x == _END:
+            block = parents.pop()
+            if block.span is not None:  # taken when the block closed
+                block.span.length = len(block.sub_blocks)
+            append = (parents[-1] if parents else document).sub_blocks.append
+        elif x == _DEBUG:
+            append(DebugBlock(next(it)))
+        elif x == _TAG:
+            append(HTMLTagBlock(next(it)))
+        elif x == _COMMENT:
+            append(CommentBlock(next(it)))
+        elif x < 4 + len(_CONTAINERS):
+            block = _container(x, next(it), next(it))
+            start = next(it)
+            end = next(it)
+            if start != -1:
+                block.span = SourceSpan(document.source, start, end, 0)
+            append(block)
+            if block.sub_blocks is not None:
+                parents.append(block)
+                append = block.sub_blocks.append
+        else:
+            append(_MARKS[x - 4 - len(_CONTAINERS)]())
+    if source is not None:
+        document.set_source(source)
+    return document
+
+
+class ParseCache(object):
+    """Parsed pages on disk, keyed by title and revision (or content hash).
+
+    The least recently used files are removed once the directory holds more
+    than max_bytes.
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+        self.files = disk_cache.DiskCache(directory, max_bytes, ".tree")
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()  # for the counters
+
+    def get(self, title, key):
+        """The cached DocumentBlock for (title, key), or None."""
+        name = disk_cache.file_name(title, key, *_FORMAT)
+        data = self.files.read(name)
+        document = None
+        if data is not None:
+            try:
+                with LOAD_SECONDS.time():
+                    document = load_tree(data)
+            except Exception as e:  # written by another version, or damaged
+                print("Dropping cached parse of %s: %s" % (title, e))
+                self.files.remove(name)
+        with self._lock:
+            if document is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        metrics.CACHE_LOOKUPS.inc(cache="parse", result="miss" if document is None else "hit")
+        return document
+
+    def put(self, title, key, document):
+        self.files.write(disk_cache.file_name(title, key, *_FORMAT), dump_tree(document))
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def default_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ParseCache()
+        return _cache
+
+
+def tokenize(title, text, revid=None, cache=None):
+    """A WikiTokenizer with parsed_data for text, from the cache if it can be.
+
+    The cache key is revid if given, else a hash of text.  The tokenizer
+    keeps no tokens, as with tokenize(text, keep_tokens=False).
+    """
+    if cache is None:
+        cache = default_cache()
+    key = revid if revid is not None else hashlib.sha1(text.encode("utf-8")).hexdigest()
+    t = parser.WikiTokenizer(title)
+    document = cache.get(title, key)
+    if document is None:
+        t.tokenize(text, keep_tokens=False)
+        cache.put(title, key, t.parsed_data)
+    else:
+        document.tokenizer = t
+        t.parsed_data = document
+    return t
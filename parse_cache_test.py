@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+
+import disk_cache
+import parse_blocks
+import parse_blocks_test
+import parse_cache
+import parser
+import parser_test
+
+import glob
+import os
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+
+class TreeFormatTest(unittest.TestCase):
+    def assertRoundTrip(self, text):
+        t = parser.WikiTokenizer("Test", engine="regex")
+        t.tokenize(text)
+        document = parse_cache.load_tree(parse_cache.dump_tree(t.parsed_data))
+        self.assertEqual(parse_blocks_test.structure(t.parsed_data),
+                         parse_blocks_test.structure(document), repr(text))
+        self.assertEqual(text, document.wiki())
+        return document
+
+    def test_testdata(self):
+        for filename in glob.glob("testdata/*.dat"):
+            with open(filename) as f:
+                self.assertRoundTrip(f.read())
+
+    def test_generated(self):
+        rng = random.Random(11)
+        for _ in range(1000):
+            self.assertRoundTrip(parser_test.random_text(rng, rng.randint(1, 60)))
+
+    def test_deep_nesting(self):
+        text = "{{a|" * 5000 + "b" + "}}" * 5000
+        t = parser.WikiTokenizer("Test", engine="regex")
+        t.tokenize(text)
+        document = parse_cache.load_tree(parse_cache.dump_tree(t.parsed_data))
+        document.source.text = None  # render it, rather than copy
+        self.assertEqual(text, document.wiki())
+
+    def test_edit_after_loading(self):
+        with open("testdata/economics.dat") as f:
+            text = f.read()
+        document = self.assertRoundTrip(text)
+        document.get_first_template_of_kind("Vital article").set_param("level", "4")
+        self.assertEqual(text.replace("level=3", "level=4", 1), document.wiki())
+        with self.assertRaises(ValueError):
+            parse_cache.dump_tree(document)
+
+    def test_changed_trees(self):
+        t = parser.WikiTokenizer("Test", engine="regex")
+        t.tokenize("<ref>a</ref> {{b|{{c}}}}")
+        t.parsed_data.remove_templates_of_kind("C")
+        with self.assertRaises(ValueError):
+            parse_cache.dump_tree(t.parsed_data)
+
+        t.tokenize("<ref>a</ref> {{b}}")
+        t.parsed_data.sub_blocks[0].sub_blocks.append(parse_blocks.TextBlock("x"))
+        with self.assertRaises(ValueError):
+            parse_cache.dump_tree(t.parsed_data)
+
+    def test_other_interpreter(self):
+        t = parser.WikiTokenizer("Test", engine="regex")
+        t.tokenize("{{a}}")
+        data = parse_cache.dump_tree(t.parsed_data)
+        with mock.patch.object(parse_cache, "_FORMAT", (parse_cache.FORMAT_VERSION, 2, 7)):
+            with self.assertRaises(ValueError):
+                parse_cache.load_tree(data)
+
+
+class ParseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_hit_and_miss(self):
+        cache = parse_cache.ParseCache(self.tmp.name)
+        with open("testdata/bob_dylan.dat") as f:
+            text = f.read()
+        first = parse_cache.tokenize("Talk:Bob Dylan", text, cache=cache)
+        second = parse_cache.tokenize("Talk:Bob Dylan", text, cache=cache)
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        self.assertEqual(first.parsed_data.links(), second.parsed_data.links())
+        self.assertIs(second, second.parsed_data.tokenizer)
+
+        parse_cache.tokenize("Talk:Bob Dylan", text + "x", cache=cache)
+        self.assertEqual(2, cache.misses)
+
+    def test_damaged_file(self):
+        cache = parse_cache.ParseCache(self.tmp.name)
+        parse_cache.tokenize("A", "[[b]]", revid=1, cache=cache)
+        for name in os.listdir(self.tmp.name):
+            with open(os.path.join(self.tmp.name, name), "wb") as f:
+                f.write(b"junk")
+        self.assertIsNone(cache.get("A", 1))
+        self.assertEqual([], os.listdir(self.tmp.name))
+
+    def test_eviction(self):
+        cache = parse_cache.ParseCache(self.tmp.name)
+        text = "".join("[[Page %d]]\n" % i for i in range(100))
+        parse_cache.tokenize("A", text, revid=0, cache=cache)
+        cache.files.max_bytes = 3 * cache.files.total_bytes()
+        for revid in range(1, 10):
+            parse_cache.tokenize("A", text, revid=revid, cache=cache)
+            for name in os.listdir(self.tmp.name):  # older than anything used next
+                path = os.path.join(self.tmp.name, name)
+                old = os.path.getmtime(path) - 10
+                os.utime(path, (old, old))
+            cache.get("A", 0)  # kept in use
+        sizes = [os.path.getsize(os.path.join(self.tmp.name, x))
+                 for x in os.listdir(self.tmp.name)]
+        # Evicted down to the low water mark, not just under max_bytes.
+        self.assertLessEqual(sum(sizes), cache.files.max_bytes * disk_cache.LOW_WATER)
+        self.assertEqual(2, len(sizes))
+        self.assertIsNotNone(cache.get("A", 0))
+        self.assertIsNone(cache.get("A", 1))
+
+        reopened = parse_cache.ParseCache(self.tmp.name)
+        self.assertEqual(sum(sizes), reopened.files.total_bytes())
+
+    def test_leftover_tmp_files(self):
+        stale = os.path.join(self.tmp.name, "a.tree.1.tmp")
+        fresh = os.path.join(self.tmp.name, "b.tree.1.tmp")
+        for path in (stale, fresh):
+            with open(path, "wb") as f:
+                f.write(b"partial")
+        old = os.path.getmtime(stale) - disk_cache.STALE_TMP_SECONDS - 1
+        os.utime(stale, (old, old))
+        cache = parse_cache.ParseCache(self.tmp.name)
+        self.assertEqual(["b.tree.1.tmp"], os.listdir(self.tmp.name))
+        self.assertEqual(0, cache.files.total_bytes())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+#
+# Tokenizes many pages on a pool of worker processes.  Pages are sent to
+# the workers in chunks, a bounded number at a time, so a long stream of
+# pages (from a dump, say) is never read far ahead of the results.
+#
+#   with parse_pool.ParsePool() as pool:
+#       for title, links in pool.map(parse_pool.links, pages):
+#           ...
+
+import parse_cache
+import parser
+import vital_update
+
+import collections
+import concurrent.futures
+import itertools
+import os
+
+CHUNKSIZE = 16  # pages sent to a worker at a time
+CHUNKS_PER_WORKER = 2  # chunks queued for each worker
+
+
+def _tokenize(title, text):
+    t = parser.WikiTokenizer(title)
+    t.tokenize(text, keep_tokens=False, keep_source=False)
+    return t
+
+
+# Functions for ParsePool.map.  They run in the workers, so they take the
+# page and return only what the caller needs.
+
+def links(title, text):
+    """(title, the links on the page)."""
+    return title, _tokenize(title, text).parsed_data.links()
+
+
+def template_params(title, text, kind):
+    """(title, the arguments of the first template of kind, or None).
+
+    Use as functools.partial(template_params, kind="Vital article").
+    """
+    template = _tokenize(title, text).parsed_data.get_first_template_of_kind(kind)
+    if template is None:
+        return title, None
+    template.sections()  # splits the arguments into arg_dict
+    return title, {k: template.get_param(k) for k in template.arg_dict}
+
+
+def article_class(title, text):
+    """(title, vital_update.get_article_class() for a talk page)."""
+    return title, vital_update.get_article_class(title, _tokenize(title, text))
+
+
+def tree(title, text):
+    """(title, the tree in parse_cache's format); parse_cache.load_tree() reads it."""
+    return title, parse_cache.dump_tree(_tokenize(title, text).parsed_data)
+
+
+def _run_chunk(func, chunk):
+    return [func(title, text) for title, text in chunk]
+
+
+class ParsePool(object):
+    def __init__(self, processes=None, chunksize=CHUNKSIZE):
+        self.processes = processes or os.cpu_count() or 1
+        self.chunksize = chunksize
+        self.executor = concurrent.futures.ProcessPoolExecutor(self.processes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown()
+
+    def map(self, func, pages, ordered=True):
+        """Yields func(title, text) for each (title, text) in pages.
+
+        func must be picklable: a module-level function, or a
+        functools.partial of one.  With ordered=False, results come as soon
+        as their chunk is done rather than in the order of pages.
+        """
+        pages = iter(pages)
+        limit = self.processes * CHUNKS_PER_WORKER
+        pending = collections.deque() if ordered else set()
+        add = pending.append if ordered else pending.add
+        while True:
+            while len(pending) < limit:
+                chunk = list(itertools.islice(pages, self.chunksize))
+                if not chunk:
+                    break
+                add(self.executor.submit(_run_chunk, func, chunk))
+            if not pending:
+                return
+            if ordered:
+                yield from pending.popleft().result()
+            else:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                    yield from future.result()
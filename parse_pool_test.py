@@ -0,0 +1,57 @@
+#!/usr/bin/python3
+
+import parse_cache
+import parse_pool
+
+import functools
+import glob
+import unittest
+
+
+def _pages():
+    pages = []
+    for filename in sorted(glob.glob("testdata/*.dat")):
+        with open(filename) as f:
+            pages.append(("Talk:" + filename[9:-4], f.read()))
+    return pages * 10
+
+
+class ParsePoolTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = parse_pool.ParsePool(2, chunksize=3)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+
+    def test_ordered(self):
+        pages = _pages()
+        expected = [parse_pool.links(title, text) for title, text in pages]
+        self.assertEqual(expected, list(self.pool.map(parse_pool.links, pages)))
+
+    def test_unordered(self):
+        pages = [("P%d" % i, "[[Link %d]]" % i) for i in range(100)]
+        results = list(self.pool.map(parse_pool.links, iter(pages), ordered=False))
+        self.assertEqual(sorted((t, ["Link " + t[1:]]) for t, _ in pages), sorted(results))
+
+    def test_template_params(self):
+        func = functools.partial(parse_pool.template_params, kind="Vital article")
+        results = dict(self.pool.map(func, _pages()[:4]))
+        self.assertEqual({"level": "4", "topic": "People", "class": "FA"},
+                         results["Talk:bob_dylan"])
+        self.assertIsNone(results["Talk:fried_plantain"])
+
+    def test_class_and_tree(self):
+        pages = _pages()[:4]
+        self.assertEqual(["FA", "B", "Start", "C"],
+                         [c for _, c in self.pool.map(parse_pool.article_class, pages)])
+        for (title, text), (_, data) in zip(pages, self.pool.map(parse_pool.tree, pages)):
+            self.assertEqual(text, parse_cache.load_tree(data).wiki())
+
+    def test_empty(self):
+        self.assertEqual([], list(self.pool.map(parse_pool.links, [])))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,149 +1,401 @@
 # Copyright 2017
 
+import metrics
+
+import codecs
+import re
+
 from parse_blocks import *
 
+ENGINES = ("char", "regex")
+
+TOKENIZE_SECONDS = metrics.summary(
+    "wiki_tokenize_seconds", "Time tokenizing pages into parse trees; the count is pages")
+
+# Characters that make up a run of text: letters, digits, and a little
+# punctuation.  [^\W_] is exactly str.isalpha() or str.isnumeric().
+_TEXT = r"(?:[^\W_]|[/.,:()\-])"
+
+# A tag runs up to the first ">"; a comment runs up to the first "-->" that
+# starts no earlier than the last dash of "<!--".
+_TAG = r"<!--.(?:.*?(?<=--)>|.*)|<[^>]*>?"
+
+# Runs of "[", "{", "=", newline and "'" are grouped, "]" and "}" are
+# grouped in pairs.  Anything else is a token on its own.
+_RUNS = r"\[+|\{+|=+|\n+|'+|\]\]?|\}\}?"
+
+_TOKEN_RE = re.compile(
+    r"%s+|&%s*;?|\{\||%s|%s|." % (_TEXT, _TEXT, _TAG, _RUNS), re.DOTALL)
+
+# Inside a table, "|-" and "|}" are tokens, "{|" is not special, and tags
+# are still split by pipes.
+_TABLE_TOKEN_RE = re.compile(
+    r"%s+|&%s*;?|\|[-}]?|%s|%s|." % (_TEXT, _TEXT, _TAG, _RUNS), re.DOTALL)
+
+# Single characters with a rule of their own; others go in the debug_set.
+_SPECIAL_CHARS = set("/.,:-();&<|]}[{=\n' ")
+
+# The regex engine tokenizes a window of text at a time, so that a switch
+# in and out of a table only throws away the rest of one window.
+_MIN_WINDOW = 64
+_MAX_WINDOW = 1 << 16
+
+# Input is handed to the engines in chunks of at most this many characters.
+_CHUNK_SIZE = 1 << 16
+
+
+def _text_chunks(source):
+    """Splits a string, or an iterable of str or bytes chunks, into strings."""
+    if isinstance(source, (str, bytes)):
+        source = [source]
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    for chunk in source:
+        if isinstance(chunk, bytes):
+            chunk = decoder.decode(chunk)
+        for start in range(0, len(chunk), _CHUNK_SIZE):
+            yield chunk[start:start + _CHUNK_SIZE]
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+def _kept_chunks(chunks, pieces):
+    """Passes chunks on, keeping them in pieces too."""
+    for chunk in chunks:
+        pieces.append(chunk)
+        yield chunk
+
+
+def _split_table_tag(text, pos, final=True):
+    """Tokenize a tag inside a table, which pipes split into pieces.
+
+    This is rare enough to be done a character at a time, following the
+    same rules as WikiTokenizer._char_batches.  Returns the tokens, the
+    position after the tag, and whether we are still in the table; or None
+    if the tag does not end before the text does and more text may follow.
+    """
+    tokens = []
+    current_token = "<"
+    in_table = True
+    in_comment = False
+    pos += 1
+    while pos < len(text):
+        c = text[pos]
+        pos += 1
+        if in_table and c in "|-}":
+            if current_token == "|" and c == "-":
+                tokens.append("|-")
+                current_token = ""
+                continue
+            if current_token == "|" and c == "}":
+                tokens.append("|}")
+                current_token = ""
+                in_table = False
+                continue
+            if c == "|":
+                if current_token:
+                    tokens.append(current_token)
+                current_token = "|"
+                continue
+        if in_table and current_token == "|":
+            tokens.append(current_token)
+            current_token = ""
+        if in_comment:
+            if c == ">" and current_token.endswith("--"):
+                tokens.append(current_token + c)
+                current_token = ""
+                break
+            current_token += c
+            continue
+        if current_token == "<!--":
+            in_comment = True
+            current_token += c
+            continue
+        current_token += c
+        if c == ">":
+            tokens.append(current_token)
+            current_token = ""
+            break
+    else:
+        if not final:
+            return None
+    if current_token:
+        tokens.append(current_token)
+    tokens = [TextBlock(x) if x.isalpha() else x for x in tokens]
+    return tokens, pos, in_table
+
+
 class WikiTokenizer():
-    def __init__(self, page_name):
+    def __init__(self, page_name, engine="char"):
+        if engine not in ENGINES:
+            raise ValueError("Unknown tokenizer engine: %s" % engine)
         self.page_name = page_name
+        self.engine = engine
         self.current_token = ""
         self.tokens = []
         self.parsed_data = None
         self.debug_set = set()
 
-    def clear_token(self):
+    def clear_token(self, tokens):
         if self.current_token:
             if self.current_token.isalpha():
-                self.tokens.append(TextBlock(self.current_token))
+                tokens.append(TextBlock(self.current_token))
             else:
-                self.tokens.append(self.current_token)
+                tokens.append(self.current_token)
         self.current_token = ""
 
-    def tokenize(self, text):
+    def _char_batches(self, chunks):
+        """The original tokenizer, one character at a time.
+
+        Yields lists of tokens, one per chunk of text.
+        """
         in_text = False
         in_tag = False
         in_table = False
         in_comment = False
 
-        for c in text:
-            if in_table and c in "|-}":  # special handling of |- and |}
-                if self.current_token == "|" and c == "-":
-                    self.current_token += c
-                    self.clear_token()
-                    continue
-                if self.current_token == "|" and c == "}":
-                    self.current_token += c
-                    self.clear_token()
-                    in_table = False
-                    continue
-                if c == "|":
-                    self.clear_token()
-                    self.current_token += c
-                    continue
-            if in_table and self.current_token == "|":  # regular pipe in a table
-                self.clear_token()
-            if in_tag:
-                if in_comment:
-                    if c == ">" and self.current_token.endswith("--"):
-                        # end of comment
+        tokens = []
+        for chunk in chunks:
+            for c in chunk:
+                if in_table and c in "|-}":  # special handling of |- and |}
+                    if self.current_token == "|" and c == "-":
                         self.current_token += c
-                        self.clear_token()
-                        in_tag = False
-                        in_comment = False
+                        self.clear_token(tokens)
                         continue
-                    else:
+                    if self.current_token == "|" and c == "}":
+                        self.current_token += c
+                        self.clear_token(tokens)
+                        in_table = False
+                        continue
+                    if c == "|":
+                        self.clear_token(tokens)
                         self.current_token += c
                         continue
-                if self.current_token == "<!--":  # HTML comment
-                    in_comment = True
+                if in_table and self.current_token == "|":  # regular pipe in a table
+                    self.clear_token(tokens)
+                if in_tag:
+                    if in_comment:
+                        if c == ">" and self.current_token.endswith("--"):
+                            # end of comment
+                            self.current_token += c
+                            self.clear_token(tokens)
+                            in_tag = False
+                            in_comment = False
+                            continue
+                        else:
+                            self.current_token += c
+                            continue
+                    if self.current_token == "<!--":  # HTML comment
+                        in_comment = True
+                        self.current_token += c
+                        continue
+                    if c != ">":
+                        self.current_token += c
+                        continue
+                    #  else c == ">":
                     self.current_token += c
+                    in_tag = False
+                    self.clear_token(tokens)
                     continue
-                if c != ">":
-                    self.current_token += c
+                elif c.isalpha() or c.isnumeric() or c in ("/", ".", ",", ":", "-", "(", ")"):
+                    if in_text:
+                        self.current_token += c
+                    else:  # (not in_text)
+                        self.clear_token(tokens)
+                        self.current_token += c
+                        in_text = True
                     continue
-                #  else c == ">":
-                self.current_token += c
-                in_tag = False
-                self.clear_token()
-                continue
-            elif c.isalpha() or c.isnumeric() or c in ("/", ".", ",", ":", "-", "(", ")"):
-                if in_text:
-                    self.current_token += c
-                else:  # (not in_text)
-                    self.clear_token()
+                elif c == ";":
+                    # Special because of &nbsp; and the like.
+                    if in_text and self.current_token[0] == "&":
+                        self.current_token += c
+                        self.clear_token(tokens)
+                        in_text = False
+                    else:
+                        self.clear_token(tokens)
+                        tokens.append(";")
+                        in_text = False
+                    continue
+                elif c == "&":
+                    # Clear current text, ascii after can be included.
+                    self.clear_token(tokens)
                     self.current_token += c
                     in_text = True
-                continue
-            elif c == ";":
-                # Special because of &nbsp; and the like.
-                if in_text and self.current_token[0] == "&":
-                    self.current_token += c
-                    self.clear_token()
-                    in_text = False
-                else:
-                    self.clear_token()
-                    self.tokens.append(";")
-                    in_text = False
-                continue
-            elif c == "&":
-                # Clear current text, ascii after can be included.
-                self.clear_token()
-                self.current_token += c
-                in_text = True
-            elif c == "<":
-                # Start tag
-                if in_tag:
-                    raise("Nested tags on " + self.page_name)
-                self.clear_token()
-                in_text = False
-                in_tag = True
-                self.current_token += c
-            elif c == "|":
-                if self.current_token == "{":
-                    # Table starts {|
-                    self.current_token += c
-                    self.clear_token()
-                    in_table = True
-                else:
-                    # Always separate
-                    self.clear_token()
-                    self.tokens.append("|")
-                    in_text = False
-            elif c in ("]", "}"):
-                # Group up to two of these in a row
-                if self.current_token and self.current_token == c:
-                    self.current_token += c
-                else:
-                    self.clear_token()
-                    self.current_token += c
+                elif c == "<":
+                    # Start tag
+                    if in_tag:
+                        raise("Nested tags on " + self.page_name)
+                    self.clear_token(tokens)
                     in_text = False
-            elif c in ("[", "{", "=", "\n", "'"):
-                # Group all of these in a row
-                if self.current_token and self.current_token[0] == c:
-                    self.current_token += c
-                else:
-                    self.clear_token()
+                    in_tag = True
                     self.current_token += c
+                elif c == "|":
+                    if self.current_token == "{":
+                        # Table starts {|
+                        self.current_token += c
+                        self.clear_token(tokens)
+                        in_table = True
+                    else:
+                        # Always separate
+                        self.clear_token(tokens)
+                        tokens.append("|")
+                        in_text = False
+                elif c in ("]", "}"):
+                    # Group up to two of these in a row
+                    if self.current_token and self.current_token == c:
+                        self.current_token += c
+                    else:
+                        self.clear_token(tokens)
+                        self.current_token += c
+                        in_text = False
+                elif c in ("[", "{", "=", "\n", "'"):
+                    # Group all of these in a row
+                    if self.current_token and self.current_token[0] == c:
+                        self.current_token += c
+                    else:
+                        self.clear_token(tokens)
+                        self.current_token += c
+                        in_text = False
+                elif c == " ":
+                    if in_text:
+                        self.clear_token(tokens)
+                        in_text = False
+                        tokens.append(c)
+                    else:
+                        self.clear_token(tokens)
+                        tokens.append(c)
+                else:  # Unhandled, keep as single characters
+                    self.debug_set.add(c)
+                    self.clear_token(tokens)
+                    tokens.append(c)
                     in_text = False
-            elif c == " ":
-                if in_text:
-                    self.clear_token()
-                    in_text = False
-                    self.tokens.append(c)
-                else:
-                    self.clear_token()
-                    self.tokens.append(c)
-            else:  # Unhandled, keep as single characters
-                self.debug_set.add(c)
-                self.clear_token()
-                self.tokens.append(c)
-                in_text = False
+            yield tokens
+            tokens = []
         # finally
-        self.clear_token()
-        self.parsed_data = DocumentBlock(tokenizer=self)
-        for token in self.tokens:
-            self.parsed_data.add_block(token)
-        return self.parsed_data
+        self.clear_token(tokens)
+        yield tokens
+
+    def _regex_batches(self, chunks):
+        """Same token stream as _char_batches, matching whole runs at once.
+
+        Yields lists of tokens, one per window of text.  A token that reaches
+        the end of the text read so far waits for the next chunk.
+        """
+        chunks = iter(chunks)
+        text = ""
+        pos = 0
+        final = False
+        need_more = False
+        in_table = False
+        window = _MIN_WINDOW
+        skip = 0
+        while True:
+            if need_more or pos >= len(text):
+                if final:
+                    return
+                chunk = next(chunks, None)
+                if chunk is None:
+                    final = True
+                else:
+                    text = text[pos:] + chunk
+                    skip = max(skip - pos, 0)
+                    pos = 0
+                need_more = False
+                continue
+
+            if in_table:
+                pattern, marker = _TABLE_TOKEN_RE, "|}"
+            else:
+                pattern, marker = _TOKEN_RE, "{|"
+            end = len(text)
+            window_end = min(pos + window, end)
+            # End the window where the table state may change, so nothing
+            # after it is tokenized under the wrong rules.
+            switch = text.find(marker, max(pos, skip), window_end)
+            if switch != -1:
+                window_end = switch + 2
+            tokens = pattern.findall(text, pos, window_end)
+            if tokens[-1] != marker and not (final and window_end == end):
+                # The last token may carry on past the window.
+                tokens.pop()
+                if not tokens:
+                    if window_end == end:
+                        need_more = True
+                    else:
+                        window *= 2
+                        skip = window_end - 1
+                    continue
+            split_tag = False
+            if in_table:
+                for i, token in enumerate(tokens):
+                    if token == "|}":
+                        del tokens[i + 1:]
+                        in_table = False
+                        break
+                    if token[0] == "<" and "|" in token:
+                        del tokens[i:]
+                        split_tag = True
+                        break
+            elif "{|" in tokens:
+                del tokens[tokens.index("{|") + 1:]
+                in_table = True
+
+            if in_table != (pattern is _TABLE_TOKEN_RE) or split_tag:
+                window = _MIN_WINDOW
+            else:
+                window = min(window * 2, _MAX_WINDOW)
+            pos += sum(map(len, tokens))
+            for token in set(tokens):
+                if (len(token) == 1 and token not in _SPECIAL_CHARS
+                        and not token.isalpha() and not token.isnumeric()):
+                    self.debug_set.add(token)
+            if tokens:
+                yield [TextBlock(x) if x.isalpha() else x for x in tokens]
+
+            if split_tag:  # a tag inside a table, broken up by its pipes
+                split = _split_table_tag(text, pos, final)
+                if split is None:
+                    need_more = True
+                    continue
+                tokens, pos, in_table = split
+                yield tokens
+
+    def _batches(self, text, pieces=None):
+        chunks = _text_chunks(text)
+        if pieces is not None:
+            chunks = _kept_chunks(chunks, pieces)
+        if self.engine == "regex":
+            return self._regex_batches(chunks)
+        return self._char_batches(chunks)
 
+    def iter_tokens(self, text):
+        """Yields the tokens of text one at a time.
+
+        text may be a string, or an iterable of str or bytes chunks such as a
+        file object or an HTTP response; bytes are decoded as UTF-8.
+        """
+        for batch in self._batches(text):
+            yield from batch
+
+    def tokenize(self, text, keep_tokens=True, keep_source=True):
+        """Tokenizes text (as for iter_tokens) and builds self.parsed_data.
+
+        With keep_tokens=False the tree is built as the tokens are produced,
+        and self.tokens is left empty.  With keep_source=False the tree does
+        not keep the text (joined, if it came in chunks), so wiki() renders
+        every block instead of copying the unchanged ones.
+        """
+        with TOKENIZE_SECONDS.time():
+            self.parsed_data = DocumentBlock(tokenizer=self)
+            pieces = [] if keep_source and not isinstance(text, str) else None
+            for batch in self._batches(text, pieces):
+                if keep_tokens:
+                    self.tokens.extend(batch)
+                for token in batch:
+                    self.parsed_data.add_block(token)
+            if keep_source:
+                self.parsed_data.set_source(text if pieces is None else "".join(pieces))
+        return self.parsed_data
 
 def get_lede(tokenizer):
     assert isinstance(tokenizer, WikiTokenizer)  # CLEANUP: migration
@@ -163,15 +415,4 @@ def get_lede(tokenizer):
 
 def get_infobox(tokenizer):
     assert isinstance(tokenizer, WikiTokenizer)  # CLEANUP: migration
-    for section in tokenizer.parsed_data.sub_blocks:
-        if isinstance(section, TemplateBlock):
-            kind = section.kind()
-            if kind.startswith("infobox"):
-                return section
-            if kind == "subspeciesbox":
-                return section
-            if kind == "speciesbox":
-                return section
-            if kind == "taxobox":
-                return section
-    return None
+    return tokenizer.parsed_data.query(FirstInfobox())[0]
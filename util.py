@@ -1,14 +1,19 @@
 # -*- coding: utf-8 -*-
 
+import category_members
+import http_client
+import metrics
+import page_cache
+import parse_cache
 import parser
 
 import difflib
-import requests
-import urllib.parse
-import urllib.request
+
+EDITS = metrics.counter("wiki_edits_total", "Edits made, failed, or not made, and why",
+                        ["result"])
 
 def init_session_with_token():
-    session = requests.Session()
+    session = http_client.Session()
     username = 'PowerBOT'
     import pwdfile
     password = pwdfile.password
@@ -45,41 +50,20 @@ def init_session_with_token():
 
 
 def get_page(title):
-    URL_FMT = "https://en.wikipedia.org/wiki/%s?action=raw"
-    url = URL_FMT % (urllib.parse.quote(title))
-    r = urllib.request.urlopen(url)
-    return r.read().decode('utf-8')
+    return page_cache.default_cache().get(title)
 
 
 def get_links_from_page(title, sentinel=None):
-    p = parser.WikiTokenizer(title)
     page = get_page(title)
     if sentinel:
         page = page.split(sentinel)[1]
-    p.tokenize(page)
+    p = parse_cache.tokenize(title, page)
     links = [x for x in p.parsed_data.links() if ":" not in x]
     return set(links)
 
 
 def get_category_members(cat_name, session, token):
-    api_url = 'https://en.wikipedia.org/w/api.php'
-    entries = []
-    cmcontinue = None
-    while True:
-        p1 = session.post(api_url, data={
-            'format': 'json',
-            'action': 'query',
-            'list': 'categorymembers',
-            'cmtitle': cat_name,
-            'cmlimit': 250,
-            'cmcontinue': cmcontinue,
-            })
-        entries.extend([x["title"] for x in p1.json()["query"]["categorymembers"]])
-        if "continue" in p1.json():
-            cmcontinue = p1.json()["continue"]["cmcontinue"]
-        else:
-            break
-    return set(entries)
+    return category_members.default_snapshots().members(cat_name, session)
 
 def read_for_edit(pagename, session, token):
     api_url = 'https://en.wikipedia.org/w/api.php'
@@ -101,20 +85,104 @@ def read_for_edit(pagename, session, token):
 
     return base_ts, base_content
 
+MAX_TITLES_PER_QUERY = 50
+HIGH_LIMIT_TITLES_PER_QUERY = 500  # for accounts with apihighlimits (bots)
+
+def titles_per_query(session):
+    """The batch_size for read_revisions() that session's account may use."""
+    api_url = 'https://en.wikipedia.org/w/api.php'
+    r = session.post(api_url, data={
+        'format': 'json',
+        'action': 'query',
+        'meta': 'userinfo',
+        'uiprop': 'rights',
+    }).json()
+    if 'apihighlimits' in r['query']['userinfo'].get('rights', []):
+        return HIGH_LIMIT_TITLES_PER_QUERY
+    return MAX_TITLES_PER_QUERY
+
+def read_revisions(titles, session, section=None, batch_size=MAX_TITLES_PER_QUERY,
+                   follow_redirects=False, content=True):
+    """Reads the latest revision of many pages, batch_size titles a request.
+
+    Returns a dict from each title asked for to a dict with "timestamp",
+    "content" (unless content is False) and "revid".  Missing pages are
+    left out.  Titles the wiki normalizes (or, with follow_redirects,
+    redirects) are mapped back.
+    """
+    data = {
+        'prop': 'revisions',
+        'rvprop': 'ids|timestamp|content' if content else 'ids|timestamp',
+    }
+    if section is not None:
+        data['rvsection'] = section
+    if follow_redirects:
+        data['redirects'] = 1
+    result = {}
+    for title, entries in _query_pages(titles, session, data, batch_size):
+        revisions = [x['revisions'][0] for x in entries if 'revisions' in x]
+        if revisions:
+            rev = revisions[0]
+            result[title] = {"timestamp": rev["timestamp"], "revid": rev["revid"]}
+            if content:
+                result[title]["content"] = rev["*"]
+    return result
+
+def _query_pages(titles, session, data, batch_size):
+    """Runs a prop= query (data) on titles, batch_size titles a request.
+
+    Yields each title asked for with the list of its page entries from every
+    continued response; the list is empty if the wiki didn't mention it.
+    """
+    api_url = 'https://en.wikipedia.org/w/api.php'
+    titles = list(titles)
+    for i in range(0, len(titles), batch_size):
+        batch = titles[i:i + batch_size]
+        params = dict(data, format='json', action='query', titles='|'.join(batch))
+        renamed = {}
+        entries = {}
+        while True:
+            r = session.post(api_url, data=params).json()
+            query = r.get('query', {})
+            for x in query.get('normalized', []) + query.get('redirects', []):
+                renamed[x['from']] = x['to']
+            for page in query.get('pages', {}).values():
+                entries.setdefault(page['title'], []).append(page)
+            if 'continue' not in r:
+                break
+            params = dict(params, **r['continue'])
+        for title in batch:
+            name = title
+            while name in renamed:  # normalized, then redirected
+                name = renamed[name]
+            yield title, entries.get(name, [])
+
+def read_many_for_edit(pagenames, session, token, batch_size=MAX_TITLES_PER_QUERY):
+    """read_for_edit() for many pages, batched: {pagename: (base_ts, base_content)}."""
+    revisions = read_revisions(pagenames, session, section=0, batch_size=batch_size)
+    return {k: (v["timestamp"], v["content"]) for k, v in revisions.items()}
+
 def edit(pagename, session, token, base_ts, message, new_content, old_content=None):
+    """Saves new_content to section 0 of pagename, after confirmation.
+
+    Returns the result counted in EDITS: "made", "failed", "unchanged" or
+    "declined".
+    """
     api_url = 'https://en.wikipedia.org/w/api.php'
     if old_content:
         print(pagename)
         print("Commit message: ", message)
         if old_content == new_content:
             print("No diff for %s" % pagename)
-            return
+            EDITS.inc(result="unchanged")
+            return "unchanged"
         print(" ".join(difflib.ndiff(old_content.splitlines(keepends=True),
                                      new_content.splitlines(keepends=True))))
         print("Confirm edit?  (Y/n)")
         if input() not in ("Y", "y"):
             print("not confirmed, skipping")
-            return
+            EDITS.inc(result="declined")
+            return "declined"
     # save the edit
     if True:
         r4 = session.post(api_url, data={
@@ -129,20 +197,46 @@ def edit(pagename, session, token, base_ts, message, new_content, old_content=No
             'title': pagename,
             'token': token,
         })
+        page_cache.default_cache().forget(pagename)
+        try:
+            failed = "error" in r4.json()
+        except ValueError:
+            failed = True
+        if failed:
+            print("Edit failed on %s: %s" % (pagename, r4.text[:500]))
+        result = "failed" if failed else "made"
+        EDITS.inc(result=result)
+        return result
     else:
         print("Did not edit with new content: " + new_content)
 
-def bot_check(pagename, session=None, token=None):  #TODO: use token or remove
-    t = parser.WikiTokenizer(pagename)
-    t.tokenize(get_page(pagename))
+def bot_check(pagename, session=None, token=None, parsed=None):  #TODO: use token or remove
+    """Whether {{bots}} and {{nobots}} on pagename let PowerBOT edit it.
 
-    if t.parsed_data.has_template_of_kind("Nobots"):
+    parsed is the page's WikiTokenizer or DocumentBlock, if the whole page
+    (not just a section) has been read already.  Otherwise the page is read,
+    through session if there is one; the page cache is always revalidated,
+    so that a {{nobots}} added since is seen.
+    """
+    if parsed is None:
+        if session is not None:
+            rev = read_revisions([pagename], session)[pagename]
+            parsed = parse_cache.tokenize(pagename, rev["content"], rev["revid"])
+        else:
+            text = page_cache.default_cache().get(pagename, max_age=0)
+            parsed = parse_cache.tokenize(pagename, text)
+    document = getattr(parsed, "parsed_data", parsed)
+
+    templates = parser.TemplatesOfKind("Nobots", "Bots")
+    document.query(templates)
+    if templates.result["Nobots"]:
         print("Nobots present on " + pagename)
         return False
 
-    bots_tpls = t.parsed_data.get_templates_of_kind("Bots")
+    bots_tpls = templates.result["Bots"]
     for tpl in bots_tpls:
         for section in tpl.sections():
+            section = "".join(str(x) for x in section).strip()
             if section.startswith("allow"):
                 values = section[6:].split(",")
                 if "none" in values:
@@ -165,3 +259,28 @@ def bot_check(pagename, session=None, token=None):  #TODO: use token or remove
             print(tpl)
 
     return True
+
+def bot_check_many(pagenames, session, batch_size=MAX_TITLES_PER_QUERY):
+    """bot_check() for many pages, in batches: {pagename: allowed}.
+
+    The wiki is asked which pages transclude {{bots}} or {{nobots}}, and
+    only those are read and parsed.  Missing pages are left out.
+    """
+    data = {
+        'prop': 'templates',
+        'tltemplates': 'Template:Bots|Template:Nobots',
+        'tllimit': 'max',
+    }
+    result = {}
+    candidates = []
+    for title, entries in _query_pages(pagenames, session, data, batch_size):
+        if not entries or any('missing' in x or 'invalid' in x for x in entries):
+            continue
+        if any(x.get('templates') for x in entries):
+            candidates.append(title)
+        else:
+            result[title] = True
+    for title, rev in read_revisions(candidates, session, batch_size=batch_size).items():
+        t = parse_cache.tokenize(title, rev["content"], rev["revid"])
+        result[title] = bot_check(title, parsed=t)
+    return result
@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+
+import fakes
+import parse_cache
+import parser
+import util
+
+import tempfile
+import unittest
+
+
+class FakeApi(object):
+    """Answers prop=revisions queries, two pages of content at a time.
+
+    prop=templates queries list {{bots}} and {{nobots}}, as the wiki's
+    templatelinks would.
+    """
+    def __init__(self, pages, rights=()):
+        self.pages = pages
+        self.rights = list(rights)
+        self.posts = []
+
+    def post(self, url, data):
+        self.posts.append(data)
+        if data.get("meta") == "userinfo":
+            return fakes.FakeResponse({"query": {"userinfo": {"rights": self.rights}}})
+        titles = data["titles"].split("|")
+        normalized = [{"from": x, "to": x[0].upper() + x[1:]} for x in titles if x[0].islower()]
+        titles = [x[0].upper() + x[1:] for x in titles]
+        start = int(data.get("rvcontinue", 0))
+        pages = {}
+        for i, title in enumerate(titles):
+            if title not in self.pages:
+                pages[str(-i)] = {"title": title, "missing": ""}
+                continue
+            page = {"title": title}
+            if data["prop"] == "templates":
+                text = self.pages[title].lower()
+                page["templates"] = [{"ns": 10, "title": "Template:" + x}
+                                     for x in ("Bots", "Nobots") if "{{%s" % x.lower() in text]
+            elif start <= i < start + 2:
+                page["revisions"] = [{"revid": i, "timestamp": "ts", "*": self.pages[title]}]
+            pages[str(i)] = page
+        result = {"query": {"pages": pages}}
+        if normalized:
+            result["query"]["normalized"] = normalized
+        if data["prop"] == "revisions" and start + 2 < len(titles):
+            result["continue"] = {"rvcontinue": str(start + 2), "continue": "||"}
+        return fakes.FakeResponse(result)
+
+
+class ReadRevisionsTest(unittest.TestCase):
+    def test_batches(self):
+        pages = {"Talk:%d" % i: "text %d" % i for i in range(7)}
+        api = FakeApi(pages)
+        result = util.read_revisions(list(pages) + ["Talk:missing", "talk:3"], api,
+                                     section=0, batch_size=3)
+        self.assertEqual(set(pages) | {"talk:3"}, set(result))
+        for title, text in pages.items():
+            self.assertEqual(text, result[title]["content"])
+        self.assertEqual("text 3", result["talk:3"]["content"])
+        self.assertEqual(3, len(set(x["titles"] for x in api.posts)))
+        self.assertTrue(all(x["rvsection"] == 0 for x in api.posts))
+
+    def test_for_edit(self):
+        api = FakeApi({"Talk:A": "a"})
+        self.assertEqual({"Talk:A": ("ts", "a")}, util.read_many_for_edit(["Talk:A"], api, None))
+
+    def test_titles_per_query(self):
+        self.assertEqual(50, util.titles_per_query(FakeApi({}, ["read", "edit"])))
+        self.assertEqual(500, util.titles_per_query(FakeApi({}, ["read", "apihighlimits"])))
+
+
+class BotCheckTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.real_cache = parse_cache._cache
+        parse_cache._cache = parse_cache.ParseCache(self.tmp.name)
+
+    def tearDown(self):
+        parse_cache._cache = self.real_cache
+        self.tmp.cleanup()
+
+    def test_parsed(self):
+        cases = [("{{WikiProject Music}}", True),
+                 ("{{nobots}}", False),
+                 ("{{bots|allow=PowerBOT,OtherBOT}}", True),
+                 ("{{bots|allow=OtherBOT}}", False),
+                 ("{{bots|deny=all}}", False),
+                 ("{{bots|deny=OtherBOT}}", True)]
+        for text, allowed in cases:
+            t = parser.WikiTokenizer("Talk:A")
+            t.tokenize(text)
+            self.assertEqual(allowed, util.bot_check("Talk:A", parsed=t), text)
+            self.assertEqual(allowed, util.bot_check("Talk:A", parsed=t.parsed_data), text)
+
+    def test_many(self):
+        api = FakeApi({"Talk:A": "{{nobots}}", "Talk:B": "text", "Talk:C": "{{bots}}",
+                       "Talk:E": "{{Bots|deny=PowerBOT}}"})
+        self.assertEqual({"Talk:A": False, "Talk:B": True, "Talk:C": True, "talk:E": False},
+                         util.bot_check_many(["Talk:A", "Talk:B", "Talk:C", "Talk:D", "talk:E"],
+                                             api))
+        self.assertEqual(["templates", "revisions", "revisions"], [x["prop"] for x in api.posts])
+        # Only the pages with either template are read.
+        self.assertEqual("Talk:A|Talk:C|talk:E", api.posts[1]["titles"])
+
+    def test_session(self):
+        api = FakeApi({"Talk:A": "{{nobots}}"})
+        self.assertFalse(util.bot_check("Talk:A", api))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,8 +2,21 @@
 
 """Pages that contain the "Vital articles" project lists."""
 
+import disk_cache
+import metrics
+import parse_pool
 import util
 
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+
+CACHE_DIR = os.path.join(disk_cache.CACHE_ROOT, "links")
+MAX_CACHE_BYTES = 64 << 20
+WORKERS = 8  # list pages fetched at once
+
 LEVEL1 = ["Wikipedia:Vital articles/Level/1"]
 LEVEL2 = ["Wikipedia:Vital articles/Level/2"]
 LEVEL3 = ["Wikipedia:Vital articles"]
@@ -53,11 +66,92 @@ LEVEL5 = [
     "Wikipedia:Vital articles/Level/5/Mathematics",
 ]
 
-def links_for_rank(rank=3):
-    """Returns a map of (page name) -> (list of links)."""
-    RANK_MAP = {1: LEVEL1, 2: LEVEL2, 3: LEVEL3, 4: LEVEL4, 5: LEVEL5}
-    pages = RANK_MAP[rank]
+RANK_MAP = {1: LEVEL1, 2: LEVEL2, 3: LEVEL3, 4: LEVEL4, 5: LEVEL5}
+
+# Link sets of list pages, by (title, hash of the text): in memory for
+# this process, and as JSON files in CACHE_DIR.
+_links = {}
+_links_lock = threading.Lock()
+_files = None
+
+def _link_files():
+    global _files
+    with _links_lock:
+        if _files is None:
+            _files = disk_cache.DiskCache(CACHE_DIR, MAX_CACHE_BYTES, ".json")
+        return _files
+
+def _cached_links(title, key):
+    with _links_lock:
+        links = _links.get((title, key))
+    if links is None:
+        data = _link_files().read(disk_cache.file_name(title, key))
+        if data is not None:
+            links = set(json.loads(data.decode("utf-8")))
+            with _links_lock:
+                _links[(title, key)] = links
+    metrics.CACHE_LOOKUPS.inc(cache="links", result="miss" if links is None else "hit")
+    return links
+
+def _store_links(title, key, links):
+    with _links_lock:
+        _links[(title, key)] = links
+    _link_files().write(disk_cache.file_name(title, key),
+                        json.dumps(sorted(links)).encode("utf-8"))
+
+def links_for_pages(pages, workers=WORKERS, processes=None):
+    """Returns a map of (page name) -> (set of article links), like
+    util.get_links_from_page for each page.
+
+    Pages are fetched on workers threads, and those whose links are not
+    cached are parsed on a parse_pool.ParsePool of processes.
+    """
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        texts = dict(zip(pages, pool.map(util.get_page, pages)))
+
     result_map = {}
-    for page in pages:
-        result_map[page] = util.get_links_from_page(page)
+    keys = {}
+    todo = []
+    for page, text in texts.items():
+        keys[page] = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        links = _cached_links(page, keys[page])
+        if links is None:
+            todo.append((page, text))
+        else:
+            result_map[page] = links
+
+    for page, links in parse_links(todo, processes).items():
+        _store_links(page, keys[page], links)
+        result_map[page] = links
     return result_map
+
+def parse_links(pages, processes=None):
+    """Returns a map of (page name) -> (set of article links) for a list of
+    (page name, text), parsed on a parse_pool.ParsePool if there are several.
+    """
+    processes = processes or os.cpu_count() or 1
+    if processes > 1 and len(pages) > 1:
+        with parse_pool.ParsePool(min(processes, len(pages)), chunksize=1) as pool:
+            parsed = list(pool.map(parse_pool.links, pages, ordered=False))
+    else:
+        parsed = [parse_pool.links(page, text) for page, text in pages]
+    return {page: set(x for x in links if ":" not in x) for page, links in parsed}
+
+def links_for_rank(rank=3, workers=WORKERS, processes=None):
+    """Returns a map of (page name) -> (set of links)."""
+    return links_for_pages(RANK_MAP[rank], workers, processes)
+
+def vital_index(ranks=(1, 2, 3, 4, 5), workers=WORKERS, processes=None):
+    """Returns a map of (article) -> (level, list page).
+
+    An article on the lists of several levels gets the most vital (lowest)
+    one.
+    """
+    pages = [page for rank in ranks for page in RANK_MAP[rank]]
+    links = links_for_pages(pages, workers, processes)
+    index = {}
+    for rank in sorted(ranks, reverse=True):
+        for page in RANK_MAP[rank]:
+            for link in links[page]:
+                index[link] = (rank, page)
+    return index
@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+
+import disk_cache
+import util
+import vital_count
+
+import tempfile
+import unittest
+
+
+class LinksForRankTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.real = (util.get_page, vital_count._files, vital_count._links)
+        vital_count._files = disk_cache.DiskCache(self.tmp.name, 1 << 20, ".json")
+        vital_count._links = {}
+        self.fetched = []
+        self.pages = {page: "".join("# [[Article %d]] [[File:x.jpg]]\n" % (i * 3 + j)
+                                    for j in range(5))
+                      for i, page in enumerate(vital_count.LEVEL3 + vital_count.LEVEL4)}
+        self.pages["Wikipedia:Vital articles/Level/2"] = "[[Article 0]] [[Article 4]]"
+        util.get_page = self.get_page
+
+    def tearDown(self):
+        util.get_page, vital_count._files, vital_count._links = self.real
+        self.tmp.cleanup()
+
+    def get_page(self, title):
+        self.fetched.append(title)
+        return self.pages[title]
+
+    def test_links(self):
+        result = vital_count.links_for_rank(4, processes=2)
+        self.assertEqual(set(vital_count.LEVEL4), set(result))
+        self.assertEqual({"Article 3", "Article 4", "Article 5", "Article 6", "Article 7"},
+                         result[vital_count.LEVEL4[0]])
+
+    def test_cached(self):
+        first = vital_count.links_for_rank(4, processes=1)
+        vital_count._links = {}  # a new process: only the files are left
+        self.pages[vital_count.LEVEL4[1]] = "[[Changed]]"
+        second = vital_count.links_for_rank(4, processes=1)
+        self.assertEqual({"Changed"}, second.pop(vital_count.LEVEL4[1]))
+        first.pop(vital_count.LEVEL4[1])
+        self.assertEqual(first, second)
+        self.assertEqual(1 + len(vital_count.LEVEL4), len(vital_count._files._sizes))
+
+    def test_vital_index(self):
+        index = vital_count.vital_index((2, 3, 4), processes=1)
+        self.assertEqual((2, "Wikipedia:Vital articles/Level/2"), index["Article 0"])
+        self.assertEqual((2, "Wikipedia:Vital articles/Level/2"), index["Article 4"])
+        self.assertEqual((3, "Wikipedia:Vital articles"), index["Article 1"])
+        self.assertEqual((4, vital_count.LEVEL4[0]), index["Article 5"])
+        self.assertNotIn("File:x.jpg", index)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,15 @@
 #!/usr/bin/python3
 
+import level_index
+import metrics
 import parser
 import util
+import vital_count
 
+import collections
+import concurrent.futures
+import functools
+import time
 import urllib.parse
 import urllib.request
 
@@ -32,8 +39,20 @@ topic_for_cat = {
     "Physical sciences": "Science",
     "Technology": "Technology",
     "Mathematics": "Mathematics",
+    "Biological and health sciences": "Biology",  # as in the level 5 page names
 }
 
+LEVEL4_PAGE = "Wikipedia:Vital articles/Level/4/"
+LEVEL5_PAGE = "Wikipedia:Vital articles/Level/5/"
+LIST_SENTINEL = "<!-- LIST STARTS HERE -->"
+
+# Talk pages are read and parsed on WORKERS threads; edits are made one at
+# a time, at most one every EDIT_INTERVAL seconds.
+WORKERS = 8
+EDIT_INTERVAL = 6
+
+RENDER_SECONDS = metrics.summary("wiki_render_seconds", "Time rendering edited talk pages")
+
 L5_GEOGRAPHY = {
     "Physical": "Physical geography",
     "Countries": "Countries",
@@ -46,72 +65,120 @@ def make_template(kind, params):
     sub_blocks = [parser.TextBlock(kind)] + param_text
     return parser.TemplateBlock(sub_blocks=sub_blocks)
 
-def _get_article_class(pagename, t):
-    for section in t.parsed_data.sub_blocks:
-        if isinstance(section, parser.TemplateBlock) and section.has_param("class"):
-            return section.get_param("class").strip()
-        if isinstance(section, parser.TemplateBlock):  # too many synonyms of WPBS to list
-            for subsection in section.sub_blocks:
-                if (isinstance(subsection, parser.TemplateBlock) and
-                        subsection.has_param("class")):
-                    return subsection.get_param("class").strip()
+WPBS_KINDS = ["WikiProject Banner Shell", "WPBS", "WikiProjectBannerShell",
+              "WikiProject banner shell", "Banner holder", "WikiProjectBanners",
+              "WikiProject Banners"]
+
+def class_query():
+    # A banner, or a banner inside one of the too many synonyms of WPBS to list.
+    return parser.FirstTemplateWithParam("class", max_depth=2)
+
+def _get_article_class(pagename, template):
+    if template is not None:
+        return template.get_param("class").strip()
     # Not found, consider it start class
     print("No class found for " + pagename)
     return "Start"
 
-def get_article_class(pagename, t):
-    """Validate class."""
-    g = _get_article_class(pagename, t)
+def get_article_class(pagename, t, query=None):
+    """Validate class.
+
+    query is a class_query() already run over t, if the caller has one.
+    """
+    if query is None:
+        query = class_query()
+        t.parsed_data.query(query)
+    g = _get_article_class(pagename, query.result)
     if g in ["Start", "Stub", "GA", "FA"]:
         return g
     return g.split()[0].capitalize()
 
+def _render(t):
+    with RENDER_SECONDS.time():
+        return t.parsed_data.wiki()
+
+PlannedEdit = collections.namedtuple(
+    "PlannedEdit", ["pagename", "base_ts", "message", "new_content", "old_content"])
+
+def apply_edit(plan, session, token):
+    """Makes a planned edit.  Returns util.edit()'s result, or None without a plan."""
+    if plan is None:
+        return None
+    if plan.new_content == plan.old_content:
+        util.EDITS.inc(result="unchanged")
+        return "unchanged"
+    return util.edit(plan.pagename, session, token, plan.base_ts, message=plan.message,
+                     new_content=plan.new_content, old_content=plan.old_content)
+
+def _bots_allowed(pagename, session, token, bots_allowed):
+    """bot_check() on the whole page, unless the caller did it already.
+
+    The plans only read section 0, which a {{nobots}} may not be in.
+    """
+    if bots_allowed is None:
+        try:
+            bots_allowed = util.bot_check(pagename, session, token)
+        except Exception:
+            bots_allowed = False
+    if not bots_allowed:
+        print("Bot check failed on %s, no action taken." % pagename)
+    return bots_allowed
+
 def update_link(pagename, session, token, target_level,
-                topic=None, subpage=None):
+                topic=None, subpage=None, prefetched=None):
+    apply_edit(plan_update_link(pagename, session, token, target_level,
+                                topic, subpage, prefetched), session, token)
+
+def plan_update_link(pagename, session, token, target_level,
+                     topic=None, subpage=None, prefetched=None, bots_allowed=None):
+    """The edit update_link() makes, or None.
+
+    prefetched is (base_ts, base_content) of section 0, and bots_allowed
+    what bot_check() said, if already known.
+    """
     if not pagename.startswith("Talk:"):  # wrong namespace
         print("Doing nothing for " + pagename)
         return
 
     try:
-        base_ts, base_content = util.read_for_edit(pagename, session, token)
+        if prefetched:
+            base_ts, base_content = prefetched
+        else:
+            base_ts, base_content = util.read_for_edit(pagename, session, token)
     except Exception:
         print("page read failed on %s" % pagename)
         return
 
+    if not _bots_allowed(pagename, session, token, bots_allowed):
+        return
+
     t = parser.WikiTokenizer(pagename)
     t.tokenize(base_content)
-    
-    try:
-        util.bot_check(pagename, session, token)
-    except Exception:
-        print("Bot check failed on %s, no action taken." % pagename)
-        return
 
+    classes = class_query()
+    templates = parser.TemplatesOfKind("Vital article", *WPBS_KINDS)
     try:
-        article_class = get_article_class(pagename, t)
+        t.parsed_data.query(classes, templates)
+        article_class = get_article_class(pagename, t, classes)
     except Exception:
         print("Article class failed on %s" % pagename)
         return
-    if t.parsed_data.has_template_of_kind("Vital article"):
-        block = t.parsed_data.get_first_template_of_kind("Vital article")
+    if templates.result["Vital article"]:
+        block = templates.result["Vital article"][0]
         block.set_param("topic", topic)
         block.set_param("level", str(target_level))
         block.set_param("subpage", subpage)
-        new_content = t.parsed_data.wiki()
-        util.edit(pagename, session, token, base_ts,
-                  message="Updating vital article template",
-                  new_content=new_content, old_content=base_content)
-        return
+        new_content = _render(t)
+        return PlannedEdit(pagename, base_ts, "Updating vital article template",
+                           new_content, base_content)
 
     vital_block = make_template("Vital article", params={
         "class": article_class, "topic": topic,
         "level": str(target_level), "subpage": subpage})
 
-    for wpbs in ["WikiProject Banner Shell", "WPBS", "WikiProjectBannerShell",
-                 "WikiProject banner shell", "Banner holder", "WikiProjectBanners",
-                 "WikiProject Banners"]:
-        if t.parsed_data.has_template_of_kind(wpbs):
-            parent = t.parsed_data.get_first_template_of_kind(wpbs)
+    for wpbs in WPBS_KINDS:
+        if templates.result[wpbs]:
+            parent = templates.result[wpbs][0]
             if parent.sub_blocks[-1] != "\n":
                 parent.sub_blocks.append(parser.TextBlock("\n"))
             parent.sub_blocks.append(vital_block)
@@ -122,47 +189,122 @@ def update_link(pagename, session, token, target_level,
         t.parsed_data.sub_blocks.append(parser.DebugBlock("\n"))
         t.parsed_data.sub_blocks.append(vital_block)
 
-    new_content = t.parsed_data.wiki()
-    util.edit(pagename, session, token, base_ts,
-              message="Adding vital article level-%s template" % target_level,
-              new_content=new_content, old_content=base_content)
+    new_content = _render(t)
+    return PlannedEdit(pagename, base_ts,
+                       "Adding vital article level-%s template" % target_level,
+                       new_content, base_content)
 
 
-def remove_link(pagename, session, token):
-    base_ts, base_content = util.read_for_edit(pagename, session, token)
+def remove_link(pagename, session, token, prefetched=None):
+    apply_edit(plan_remove_link(pagename, session, token, prefetched), session, token)
 
-    t = parser.WikiTokenizer(pagename)
-    t.tokenize(base_content)
+def plan_remove_link(pagename, session, token, prefetched=None, bots_allowed=None):
+    """The edit remove_link() makes, or None (as for plan_update_link)."""
+    if prefetched:
+        base_ts, base_content = prefetched
+    else:
+        base_ts, base_content = util.read_for_edit(pagename, session, token)
 
-    try:
-        util.bot_check(pagename, session, token)
-    except Exception:
-        print("Bot check failed on %s, no action taken." % pagename)
+    if not _bots_allowed(pagename, session, token, bots_allowed):
         return
 
+    t = parser.WikiTokenizer(pagename)
+    t.tokenize(base_content)
+
     if not t.parsed_data.has_template_of_kind("Vital article"):
         print("Template not present on " + pagename)
-        return
+        return PlannedEdit(pagename, base_ts, None, base_content, base_content)  # nothing to do
     
     t.parsed_data.remove_templates_of_kind("Vital article")
 
-    new_content = t.parsed_data.wiki()
-    util.edit(pagename, session, token, base_ts,
-              message="Removing vital article template",
-              new_content=new_content, old_content=base_content)
+    new_content = _render(t)
+    return PlannedEdit(pagename, base_ts, "Removing vital article template",
+                       new_content, base_content)
 
 
 ### Update functions.  These get a list of pages which need templates ###
 ### to be added or removed, due to updates on the vital article lists ###
 
-def update_vital3():
+def prefetch(pagenames, session, token):
+    """Reads the pages an update is about to touch, a batch at a time.
+
+    Returns read_many_for_edit() (section 0, which the plans edit) and
+    bot_check_many() (read from the whole pages).  Batches are as large as
+    the account may ask for.
+    """
+    batch_size = util.titles_per_query(session)
+    return (util.read_many_for_edit(pagenames, session, token, batch_size),
+            util.bot_check_many(pagenames, session, batch_size))
+
+def run_plans(plans, session, token, workers=WORKERS, edit_interval=EDIT_INTERVAL,
+              clock=time.monotonic, sleep=time.sleep):
+    """Runs plan_* functions on a pool of threads, then makes their edits.
+
+    Edits are made here, in the order the plans finish, one at a time (they
+    may ask for confirmation) and at most one every edit_interval seconds.
+    A plan that raises is logged and counted as a failed edit.
+
+    Returns the result of each plan, in order: apply_edit()'s, "skipped"
+    for a plan of None, or "failed".
+    """
+    results = [None] * len(plans)
+    last_edit = None
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        futures = {pool.submit(plan): i for i, plan in enumerate(plans)}
+        for future in concurrent.futures.as_completed(futures):
+            i = futures[future]
+            try:
+                plan = future.result()
+            except Exception as e:
+                print("Planning an edit failed: %r" % e)
+                util.EDITS.inc(result="failed")
+                results[i] = "failed"
+                continue
+            if plan is None:
+                util.EDITS.inc(result="skipped")
+                results[i] = "skipped"
+                continue
+            if plan.new_content != plan.old_content and last_edit is not None:
+                wait = last_edit + edit_interval - clock()
+                if wait > 0:
+                    sleep(wait)
+            results[i] = apply_edit(plan, session, token)
+            if results[i] != "unchanged":
+                last_edit = clock()
+    return results
+
+def list_pages():
+    """The vital article lists, as {title: level_index.ListPage}."""
+    pages = {
+        vital_count.LEVEL1[0]: level_index.ListPage(1, None, None, None),
+        vital_count.LEVEL2[0]: level_index.ListPage(2, None, None, None),
+        vital_count.LEVEL3[0]: level_index.ListPage(3, None, None, LIST_SENTINEL),
+    }
+    for category in CAT:
+        pages[LEVEL4_PAGE + category] = level_index.ListPage(
+            4, topic_for_cat[category], None, None)
+    for title in vital_count.LEVEL5:
+        category, _, subcat = title[len(LEVEL5_PAGE):].partition("/")
+        pages[title] = level_index.ListPage(
+            5, topic_for_cat.get(category), subcat or None, None)
+    return pages
+
+def _listed_talk_pages(snapshot, page):
+    """Talk pages of the articles a level_index snapshot assigns to list page."""
+    return set("Talk:" + x for x, entry in snapshot.items() if entry.page == page)
+
+def update_vital3(snapshot=None):
+    """snapshot is a level_index snapshot, if the caller has one."""
     session, token = util.init_session_with_token()
 
-    # These are "article" page links.
-    links2 = util.get_links_from_page("Wikipedia:Vital articles/Level/2")
-    links3 = util.get_links_from_page("Wikipedia:Vital articles")
+    if snapshot is not None:
+        level3_talk_pages = _listed_talk_pages(snapshot, vital_count.LEVEL3[0])
+    else:
+        # These are "article" page links.
+        links2 = util.get_links_from_page("Wikipedia:Vital articles/Level/2")
+        links3 = util.get_links_from_page("Wikipedia:Vital articles")
 
-    level3_talk_pages = set(["Talk:" + x for x in (links3 - links2)])
+        level3_talk_pages = set(["Talk:" + x for x in (links3 - links2)])
 
     # These are "talk" page links.
     current = util.get_category_members(
@@ -170,25 +312,33 @@ def update_vital3():
 
     extra = current - level3_talk_pages
     missing = level3_talk_pages - current
-    for link in missing:
-        update_link(link, session, token, target_level=3, topic=None)
+    pages, allowed = prefetch(missing, session, token)
+    run_plans([functools.partial(plan_update_link, link, session, token, target_level=3,
+                                 topic=None, prefetched=pages.get(link),
+                                 bots_allowed=allowed.get(link))
+               for link in missing], session, token)
     for link in extra:
         # Do nothing for now.
         print(link)
+    metrics.dump()
 
 
-def update_level4_cat(category, session=None, token=None):
+def update_level4_cat(category, session=None, token=None, workers=WORKERS, snapshot=None):
+    """snapshot is a level_index snapshot; without one, the lists are read."""
     if not session:
         session, token = util.init_session_with_token()
     else:
         assert token  # must pass both
 
-    links3 = util.get_links_from_page(
-        "Wikipedia:Vital articles",
-        sentinel="<!-- LIST STARTS HERE -->")
-    links_for_cat = util.get_links_from_page("Wikipedia:Vital articles/Level/4/" + category)
+    if snapshot is not None:
+        level4_talk_pages_for_cat = _listed_talk_pages(snapshot, LEVEL4_PAGE + category)
+    else:
+        links3 = util.get_links_from_page(
+            "Wikipedia:Vital articles",
+            sentinel=LIST_SENTINEL)
+        links_for_cat = util.get_links_from_page(LEVEL4_PAGE + category)
 
-    level4_talk_pages_for_cat = set(["Talk:" + x for x in (links_for_cat - links3)])
+        level4_talk_pages_for_cat = set(["Talk:" + x for x in (links_for_cat - links3)])
 
     # These are "talk" page links.
     current = util.get_category_members(
@@ -197,26 +347,35 @@ def update_level4_cat(category, session=None, token=None):
 
     extra = current - level4_talk_pages_for_cat
     missing = level4_talk_pages_for_cat - current
-    for link in missing:
-        # subpage = subpage_param_for_cat[category] if category in subpage_param_for_cat else None
-        subpage = None
-        update_link(link, session, token, target_level=4,
-                    topic=topic_for_cat[category], subpage=subpage)
-    for link in extra:
-        remove_link(link, session, token)
-
-def update_level5_cat(category, subcat=None, *, session=None, token=None):
+    pages, allowed = prefetch(missing | extra, session, token)
+    # subpage = subpage_param_for_cat[category] if category in subpage_param_for_cat else None
+    subpage = None
+    plans = [functools.partial(plan_update_link, link, session, token, target_level=4,
+                               topic=topic_for_cat[category], subpage=subpage,
+                               prefetched=pages.get(link), bots_allowed=allowed.get(link))
+             for link in missing]
+    plans += [functools.partial(plan_remove_link, link, session, token,
+                                prefetched=pages.get(link), bots_allowed=allowed.get(link))
+              for link in extra]
+    run_plans(plans, session, token, workers=workers)
+    metrics.dump()
+
+def update_level5_cat(category, subcat=None, *, session=None, token=None, workers=WORKERS,
+                      snapshot=None):
+    """snapshot is a level_index snapshot; without one, the lists are read."""
     if not session:
         session, token = util.init_session_with_token()
     else:
         assert token  # must pass both
 
-    links4 = util.get_links_from_page(
-        "Wikipedia:Vital articles/Level/4/" + category)
-    links_for_cat = util.get_links_from_page(
-        "Wikipedia:Vital articles/Level/5/" + category + ("/" + subcat if subcat else ""))
+    list_page = LEVEL5_PAGE + category + ("/" + subcat if subcat else "")
+    if snapshot is not None:
+        level5_talk_pages_for_cat = _listed_talk_pages(snapshot, list_page)
+    else:
+        links4 = util.get_links_from_page(LEVEL4_PAGE + category)
+        links_for_cat = util.get_links_from_page(list_page)
 
-    level5_talk_pages_for_cat = set(["Talk:" + x for x in (links_for_cat - links4)])
+        level5_talk_pages_for_cat = set(["Talk:" + x for x in (links_for_cat - links4)])
 
     # These are "talk" page links.
     current = util.get_category_members(
@@ -225,17 +384,68 @@ def update_level5_cat(category, subcat=None, *, session=None, token=None):
 
     extra = current - level5_talk_pages_for_cat
     missing = level5_talk_pages_for_cat - current
-    for link in missing:
-        # subpage = subpage_param_for_cat[category] if category in subpage_param_for_cat else None
-        subpage = subcat
-        update_link(link, session, token, target_level=5,
-                    topic=topic_for_cat[category], subpage=subpage)
-    for link in extra:
-        remove_link(link, session, token)
+    pages, allowed = prefetch(missing | extra, session, token)
+    # subpage = subpage_param_for_cat[category] if category in subpage_param_for_cat else None
+    subpage = subcat
+    plans = [functools.partial(plan_update_link, link, session, token, target_level=5,
+                               topic=topic_for_cat[category], subpage=subpage,
+                               prefetched=pages.get(link), bots_allowed=allowed.get(link))
+             for link in missing]
+    plans += [functools.partial(plan_remove_link, link, session, token,
+                                prefetched=pages.get(link), bots_allowed=allowed.get(link))
+              for link in extra]
+    run_plans(plans, session, token, workers=workers)
+    metrics.dump()
+
+def update_changed(session=None, token=None, index=None, workers=WORKERS,
+                   edit_interval=EDIT_INTERVAL):
+    """Updates the talk pages of articles whose listing changed since the last run.
+
+    The first run only records the lists; the update_* functions above
+    bring every page in line.  Articles whose talk page was not updated
+    (the edit failed, was declined or was not planned) are saved in the
+    index as pending, and tried again on the next run.
+    """
+    if not session:
+        session, token = util.init_session_with_token()
+    if index is None:
+        index = level_index.LevelIndex()
+    first_run = not index.pages
+    old = index.articles()
+    index.refresh(list_pages(), session)
+    if not first_run:
+        new = index.articles()
+        changed, removed = level_index.diff(old, new)
+        for article in index.pending:  # as the lists are now
+            if article in new:
+                changed[article] = new[article]
+            else:
+                removed.add(article)
+        talk = {"Talk:" + x: entry for x, entry in changed.items()}
+        removed = set("Talk:" + x for x in removed)
+        pages, allowed = prefetch(set(talk) | removed, session, token)
+        plans = [functools.partial(plan_update_link, link, session, token,
+                                   target_level=entry.level, topic=entry.topic,
+                                   subpage=entry.subpage, prefetched=pages.get(link),
+                                   bots_allowed=allowed.get(link))
+                 for link, entry in talk.items()]
+        plans += [functools.partial(plan_remove_link, link, session, token,
+                                    prefetched=pages.get(link),
+                                    bots_allowed=allowed.get(link))
+                  for link in removed]
+        results = run_plans(plans, session, token, workers=workers, edit_interval=edit_interval)
+        links = list(talk) + list(removed)
+        index.pending = set(link[len("Talk:"):] for link, result in zip(links, results)
+                            if result not in ("made", "unchanged"))
+    index.save()
+    metrics.dump()
 
 def bulk_update():
     session, token = util.init_session_with_token()
+    index = level_index.LevelIndex()
+    index.refresh(list_pages(), session)
+    snapshot = index.articles()
     for cat in ["Technology", "History", "Geography", "Arts", "People",
                 "Philosophy and religion", "Everyday life",
                 "Mathematics", "Biology and health sciences", "Physical sciences"]:
-        update_level4_cat(cat, session, token)
+        update_level4_cat(cat, session, token, snapshot=snapshot)
@@ -1,8 +1,16 @@
 #!/usr/bin/python3
 
+import level_index
+import level_index_test
+import metrics
+import parse_cache
 import parser
+import util
 import vital_update
 
+import os
+import tempfile
+import threading
 import unittest
 
 def test_article_class(pagename, expected_class):
@@ -44,5 +52,147 @@ class IntegrationTest(unittest.TestCase):
     with open(result_file2) as h:
         self.assertEqual(h.read(), result2)
 
+class FakeClock(object):
+  """A clock for run_plans that only moves when slept on."""
+  def __init__(self):
+    self.now = 100.0
+    self.sleeps = []
+
+  def __call__(self):
+    return self.now
+
+  def sleep(self, seconds):
+    self.sleeps.append(seconds)
+    self.now += seconds
+
+class RunPlansTest(unittest.TestCase):
+  def setUp(self):
+    self.edits = []
+    self.clock = FakeClock()
+    self.real_edit = util.edit
+    util.edit = lambda pagename, session, token, base_ts, **kwargs: self.edits.append(
+        (pagename, self.clock(), threading.get_ident()))
+
+  def tearDown(self):
+    util.edit = self.real_edit
+
+  def plan(self, pagename, barrier=None):
+    if barrier is not None:
+      barrier.wait()  # raises unless every plan is running at once
+    if pagename is None:
+      return None
+    if pagename == "raise":
+      raise ValueError(pagename)
+    return vital_update.PlannedEdit(pagename, "ts", "message", "new", "old")
+
+  def run_plans(self, pages, **kwargs):
+    barrier = kwargs.pop("barrier", None)
+    vital_update.run_plans([lambda p=p: self.plan(p, barrier) for p in pages], None, None,
+                           clock=self.clock, sleep=self.clock.sleep, **kwargs)
+
+  def test_edits_on_one_thread(self):
+    skipped = util.EDITS.value(result="skipped")
+    pages = ["Talk:%d" % i for i in range(8)]
+    self.run_plans(pages + [None], workers=9, edit_interval=0,
+                   barrier=threading.Barrier(9, timeout=10))
+    self.assertEqual(sorted(pages), sorted(e[0] for e in self.edits))
+    self.assertEqual({threading.get_ident()}, {e[2] for e in self.edits})
+    self.assertEqual(skipped + 1, util.EDITS.value(result="skipped"))
+
+  def test_edit_interval(self):
+    self.run_plans(["Talk:A", "Talk:B", "Talk:C"], edit_interval=6)
+    times = [e[1] for e in self.edits]
+    self.assertEqual([100, 106, 112], times)
+    self.assertEqual([6, 6], self.clock.sleeps)
+
+  def test_plan_raises(self):
+    failed = util.EDITS.value(result="failed")
+    self.run_plans(["Talk:A", "raise", "Talk:B"], workers=1, edit_interval=0)
+    self.assertEqual(["Talk:A", "Talk:B"], sorted(e[0] for e in self.edits))
+    self.assertEqual(failed + 1, util.EDITS.value(result="failed"))
+
+class UpdateChangedTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.edits = {}
+    self.fail = set()  # pages whose edits fail
+    self.real = (util.edit, vital_update.list_pages)
+    util.edit = self.edit
+    vital_update.list_pages = lambda: level_index_test.LIST_PAGES
+    self.wiki = level_index_test.FakeWiki({
+        "Level 3": (1, "<!-- start --> [[Music]]"),
+        "Level 4/Arts": (2, "[[Music]] [[Opera]]"),
+        "Level 5/Arts": (3, "[[Jazz]]"),
+        "Level 5/People/Writers": (4, ""),
+        "Talk:Opera": (5, "{{WikiProject Opera|class=B}}\n{{Vital article|level=4|topic=Art|class=B}}"),
+        "Talk:Music": (6, "{{WikiProject Music|class=GA}}\n{{Vital article|level=4|topic=Art|class=GA}}"),
+        "Talk:Jazz": (7, "{{WikiProject Jazz|class=C}}\n{{Vital article|level=5|topic=Art|class=C}}"),
+    })
+    self.index = level_index.LevelIndex(os.path.join(self.tmp.name, "index.json"))
+    self.metrics_path = metrics.METRICS_PATH
+    metrics.METRICS_PATH = os.path.join(self.tmp.name, "metrics.prom")
+    self.parse_cache = parse_cache._cache
+    parse_cache._cache = parse_cache.ParseCache(os.path.join(self.tmp.name, "parse"))
+
+  def tearDown(self):
+    util.edit, vital_update.list_pages = self.real
+    metrics.METRICS_PATH = self.metrics_path
+    parse_cache._cache = self.parse_cache
+    self.tmp.cleanup()
+
+  def edit(self, pagename, session, token, base_ts, message, new_content, old_content):
+    if pagename in self.fail:
+      return "failed"
+    self.edits[pagename] = new_content
+    return "made"
+
+  def update(self):
+    vital_update.update_changed(self.wiki, "token", index=self.index, workers=2,
+                                edit_interval=0)
+
+  def test_changes(self):
+    self.update()
+    self.assertEqual({}, self.edits)  # the first run only records the lists
+
+    self.wiki.pages["Level 3"] = (8, "<!-- start --> [[Music]] [[Opera]]")
+    self.wiki.pages["Level 5/Arts"] = (9, "")
+    self.update()
+    self.assertEqual(
+        {"Talk:Opera": "{{WikiProject Opera|class=B}}\n{{Vital article|level=3|class=B}}",
+         "Talk:Jazz": "{{WikiProject Jazz|class=C}}\n"}, self.edits)
+
+    self.edits = {}
+    self.update()
+    self.assertEqual({}, self.edits)
+    with open(metrics.METRICS_PATH) as f:
+      self.assertIn("wiki_render_seconds_count ", f.read())
+
+  def test_retried(self):
+    self.update()
+    self.wiki.pages["Level 3"] = (8, "<!-- start --> [[Music]] [[Opera]]")
+    self.wiki.pages["Level 5/Arts"] = (9, "")
+    self.fail = {"Talk:Opera"}
+    self.update()
+    self.assertEqual({"Talk:Jazz"}, set(self.edits))
+    self.assertEqual({"Opera"}, level_index.LevelIndex(self.index.path).pending)
+
+    self.edits = {}
+    self.fail = set()
+    self.update()
+    self.assertEqual({"Talk:Opera"}, set(self.edits))
+    self.assertEqual(set(), self.index.pending)
+
+    self.edits = {}
+    self.update()
+    self.assertEqual({}, self.edits)
+
+  def test_nobots_after_the_lead(self):
+    self.update()
+    self.wiki.pages["Talk:Opera"] = (10, self.wiki.pages["Talk:Opera"][1] +
+                                     "\n== Bots ==\n{{nobots}}")
+    self.wiki.pages["Level 3"] = (8, "<!-- start --> [[Music]] [[Opera]]")
+    self.update()
+    self.assertEqual({}, self.edits)
+
 if __name__ == '__main__':
     unittest.main()